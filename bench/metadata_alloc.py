@@ -0,0 +1,73 @@
+# metadata_alloc.py
+# times BlobsRPC.get_blob_metadata on a synthetic database (the one
+# query_plans.py seeds) and measures the objects it makes per row
+#
+# usage: python2.7 bench/metadata_alloc.py [--blobs=100000] [--db=bench.db] [--uuids=2000]
+
+import sys
+import os
+import time
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import models
+import relations
+import methods
+import query_plans
+
+def size_of(obj) :
+    """The bytes of an object along with its __dict__ (if it isn't a __slots__
+    object) and its date_created (if that has been made into a datetime)."""
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__") :
+        size += sys.getsizeof(obj.__dict__)
+        created = obj.__dict__.get("date_created")
+    else :
+        created = getattr(obj, "_date_created", None)
+    if created != None :
+        size += sys.getsizeof(created)
+    return size
+
+def main() :
+    parser = optparse.OptionParser()
+    parser.add_option("--blobs", type="int", default=100000, help="the number of blobs to seed")
+    parser.add_option("--db", default="bench.db", help="the database file to (re)create")
+    parser.add_option("--uuids", type="int", default=2000, help="the number of uuids asked for per call")
+    parser.add_option("--repeat", type="int", default=20, help="the number of timed calls")
+    options, args = parser.parse_args()
+
+    query_plans.seed(options.db, options.blobs)
+    models.db_connect(options.db)
+    user = models.User.get_by_id(1)
+    web_id = 2 # user 1 can access it, and it has the blobs 1000-1999, 21000-21999, ...
+    uuids = ["%032x" % i for i in xrange(1, options.blobs + 1)
+             if 1 + (i // 1000) % query_plans.NUM_WEBS == web_id][:options.uuids]
+    rpc = methods.BlobsRPC(None, None)
+    rpc.get_blob_metadata(user, web_id, uuids) # resolves the inherited relations
+
+    # the objects behind one response, before it is turned into dicts
+    found = models.Blob.get_by_uuids(set(uuids))
+    srels = relations.get_inherited_relations_for(web_id, found.keys())
+    orels = relations.CachedRelation.get_for_objects(web_id, found.keys())
+    rels = [r for rs in srels.values() + orels.values() for r in rs]
+    rows = len(found) + len(rels)
+    print "%d blobs and %d relations per call" % (len(found), len(rels))
+    print "  bytes per Blob:           %6.1f" % (sum(size_of(b) for b in found.itervalues()) / float(len(found)))
+    print "  bytes per CachedRelation: %6.1f" % (sum(size_of(r) for r in rels) / float(len(rels)))
+
+    t = time.time()
+    for i in xrange(options.repeat) :
+        rpc.get_blob_metadata(user, web_id, uuids)
+    elapsed = (time.time() - t) / options.repeat
+    print "get_blob_metadata: %.1f ms per call, %.2f us per row" % (elapsed * 1000, elapsed * 1e6 / rows)
+    t = time.time()
+    for i in xrange(options.repeat) :
+        models.Blob.get_by_uuids(uuids)
+        relations.get_inherited_relations_for(web_id, uuids)
+        relations.CachedRelation.get_for_objects(web_id, uuids)
+    elapsed = (time.time() - t) / options.repeat
+    print "  of which loading: %.1f ms per call, %.2f us per row" % (elapsed * 1000, elapsed * 1e6 / rows)
+
+if __name__ == "__main__" :
+    main()
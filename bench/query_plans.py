@@ -0,0 +1,242 @@
+# query_plans.py
+# seeds a synthetic database and records the query plan and timing of
+# every query in models.py, relations.py, plugin_inbox.py and search.py
+#
+# usage: python2.7 bench/query_plans.py [--blobs=1000000] [--db=bench.db]
+#
+# Exits with status 1 if any query scans one of the large tables rather
+# than searching it with an index.
+
+import sys
+import os
+import re
+import time
+import sqlite3
+import optparse
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+import models
+
+# tables which are small enough that a scan is fine (or temporary
+# tables which are scanned on purpose to drive a bulk query)
+SMALL_TABLES = set(["webs", "users", "relation_types", "uuid_set", "blob_id_set"])
+
+# the indexes which the plan of each call must use (a missing composite
+# index usually degrades to a search on a prefix of another index rather
+# than to a scan)
+EXPECTED_INDEXES = {
+    "WebBlobAccess.can_user_access" : ["blobs_web_blob"],
+    "authorization.can_read" : ["sqlite_autoindex_user_web_access_1"],
+    "authorization.is_member" : ["sqlite_autoindex_user_web_access_1"],
+    "WebBlobAccess.users_can_access" : ["blobs_web_blob"],
+    "WebBlobAccess.get_webs_for_blob" : ["blobs_web_blob"],
+    "WebBlobAccess.get_web_users_for_blob" : ["blobs_web_blob"],
+    "CachedRelation.get_for_subject" : ["relations_subject"],
+    "CachedRelation.get_for_object" : ["relations_object"],
+    "CachedRelation.get_for_subjects" : ["relations_subject"],
+    "CachedRelation.get_for_objects" : ["relations_object"],
+    "compute_inherited_relations" : ["relations_subject"],
+    "get_inherited_relations" : ["inherited_relations_blob"],
+    "get_inherited_relations_for" : ["inherited_relations_blob"],
+    "InheritedRelationCache.refresh" : ["inherited_relations_source", "inherited_relations_blob"],
+    "Inbox.get_page" : ["plugin_inbox_date"],
+    "Inbox.get_page unread" : ["plugin_inbox_unread_date"],
+    "Inbox.mark_read" : ["plugin_inbox_unread_date"],
+    "Inbox.add_to_inboxes" : ["blobs_web_blob", "sqlite_autoindex_user_web_access_1"],
+    "WebBlobAccess.list_blobs" : ["blobs_web_date"],
+    "SearchIndex.search" : ["inherited_relations_blob", "relations_object"],
+    }
+
+NUM_WEBS = 20
+NUM_USERS = 200
+CHAIN_LENGTH = 5 # each blob revises the previous one in chains of this length
+
+def seed(dbfile, num_blobs) :
+    """Creates a database with num_blobs blobs.  Half of the blobs are text blobs,
+    and each of the other half is a relation blob backing one row of the relations
+    cache (a 'revises' or a 'title' relation)."""
+    if os.path.exists(dbfile) :
+        os.remove(dbfile)
+    db = sqlite3.connect(dbfile)
+    with open(os.path.join(SRC, "sql", "createdb.sql")) as f :
+        db.executescript(f.read())
+    with db :
+        db.executemany("insert into webs (id, web_name, public) values (?,?,?)",
+                       ((i, "web%d" % i, int(i % 5 == 0)) for i in xrange(1, NUM_WEBS + 1)))
+        db.executemany("insert into users (email, first_name) values (?,?)",
+                       (("user%d@example.com" % i, "User%d" % i) for i in xrange(NUM_USERS)))
+        db.executemany("insert into user_web_access (web_id, user_id) values (?,?)",
+                       ((1 + (u + k) % NUM_WEBS, u) for u in xrange(1, NUM_USERS + 1) for k in xrange(3)))
+        db.executemany("insert into content (hash, stuff) values (?,?)",
+                       (("%040x" % i, "text number %d\n" % i * 20) for i in xrange(1000)))
+        db.executemany("insert into relation_types (id, relation_type_name) values (?,?)",
+                       [(1, "revises"), (2, "title")])
+        def blobs() :
+            for i in xrange(1, num_blobs + 1) :
+                if i % 2 :
+                    yield (i, "%032x" % i, 1000000 + i, "kmill31415@gmail.com", "mime:text/plain", "%040x" % (i % 1000))
+                else :
+                    yield (i, "%032x" % i, 1000000 + i, "kmill31415@gmail.com", "relation:revises", "%040x" % (i % 1000))
+        db.executemany("insert into blobs (id, uuid, date_created, editor_email, content_type, content_hash) values (?,?,?,?,?,?)",
+                       blobs())
+        db.executemany("insert into blobs_web (web_id, blob_id, date_created) values (?,?,?)",
+                       ((1 + (i // 1000) % NUM_WEBS, i, 1000000 + i) for i in xrange(1, num_blobs + 1)))
+        def rels() :
+            for i in xrange(2, num_blobs + 1, 2) :
+                subject = i - 1
+                web = 1 + (subject // 1000) % NUM_WEBS
+                if (subject // 2) % CHAIN_LENGTH and subject > 2 :
+                    yield (web, i, subject, 1, subject - 2, None)
+                else :
+                    yield (web, i, subject, 2, None, "title %d" % subject)
+        db.executemany("insert into relations (web_id, blob_id, subject_id, relation, object_id, payload) values (?,?,?,?,?,?)",
+                       rels())
+        db.executemany("insert into plugin_inbox (user_id, web_id, blob_id, date_created) values (?,?,?,?)",
+                       ((1 + i % NUM_USERS, 1 + (i // 1000) % NUM_WEBS, i, 1000000 + i) for i in xrange(1, num_blobs + 1, 2)))
+    db.execute("analyze")
+    db.close()
+
+class TracingDB(object) :
+    """Wraps the connection to record each statement that runs through it."""
+    def __init__(self, db) :
+        self.db = db
+        self.statements = []
+    def execute(self, sql, params=()) :
+        self.statements.append((sql, params))
+        return self.db.execute(sql, params)
+    def execute_tuples(self, sql, params=()) :
+        self.statements.append((sql, params))
+        return self.db.execute_tuples(sql, params)
+    def executemany(self, sql, seq) :
+        seq = list(seq)
+        self.statements.append((sql, seq[0] if seq else None))
+        return self.db.executemany(sql, seq)
+    def __getattr__(self, name) :
+        return getattr(self.db, name)
+    def __enter__(self) :
+        return self.db.__enter__()
+    def __exit__(self, *args) :
+        return self.db.__exit__(*args)
+
+def calls() :
+    """The model calls to benchmark, as (name, thunk) pairs."""
+    import relations
+    import plugin_inbox
+    import authorization
+    import search
+    user = models.User.get_by_id(1)
+    web = models.Web.get_by_id(2)
+    uuid = "%032x" % 1999 # a text blob at the end of a revision chain in web 2
+    uuids = ["%032x" % i for i in xrange(1001, 1400, 2)]
+    blob = models.Blob.get_by_uuid(uuid)
+    CR = relations.CachedRelation
+    return [
+        ("Web.get_all", lambda : models.Web.get_all()),
+        ("Web.get_by_id", lambda : models.Web.get_by_id(2)),
+        ("Web.get_by_name", lambda : models.Web.get_by_name("web2")),
+        ("UserWebAccess.get_for_user", lambda : models.UserWebAccess.get_for_user(user)),
+        ("UserWebAccess.can_user_access", lambda : models.UserWebAccess.can_user_access(user, web)),
+        ("authorization.can_read", lambda : authorization.can_read(user, web.id)),
+        ("authorization.is_member", lambda : authorization.is_member(user, web.id)),
+        ("UserWebAccess.users_for_web", lambda : models.UserWebAccess.users_for_web(web)),
+        ("User.get_by_email", lambda : models.User.get_by_email("user7@example.com")),
+        ("User.get_by_id", lambda : models.User.get_by_id(7)),
+        ("User.get_all", lambda : models.User.get_all()),
+        ("Content.get_by_hash", lambda : models.Content.get_by_hash(blob.content_hash)),
+        ("Blob.get_by_uuid", lambda : models.Blob.get_by_uuid(uuid)),
+        ("Blob.get_by_uuids", lambda : models.Blob.get_by_uuids(uuids)),
+        ("Blob.get_created_by_uuid", lambda : models.Blob.get_created_by_uuid(uuid)),
+        ("WebBlobAccess.can_user_access", lambda : models.WebBlobAccess.can_user_access(user, blob)),
+        ("WebBlobAccess.users_can_access", lambda : models.WebBlobAccess.users_can_access(blob)),
+        ("WebBlobAccess.does_web_have_blobs", lambda : models.WebBlobAccess.does_web_have_blobs(web)),
+        ("WebBlobAccess.get_webs_for_blob", lambda : models.WebBlobAccess.get_webs_for_blob(blob)),
+        ("WebBlobAccess.get_web_users_for_blob", lambda : models.WebBlobAccess.get_web_users_for_blob(blob)),
+        ("UserWebAccess.user_ids_for_web", lambda : models.UserWebAccess.user_ids_for_web(web)),
+        ("WebBlobAccess.list_blobs", lambda : models.WebBlobAccess.list_blobs(web, (1001500, 1500), 50, deleted=False)),
+        ("CachedRelation.get_for_subject", lambda : CR.get_for_subject(web.id, uuid)),
+        ("CachedRelation.get_for_object", lambda : CR.get_for_object(web.id, uuid)),
+        ("CachedRelation.get_for_subjects", lambda : CR.get_for_subjects(web.id, uuids)),
+        ("CachedRelation.get_for_objects", lambda : CR.get_for_objects(web.id, uuids)),
+        ("compute_inherited_relations", lambda : relations.compute_inherited_relations(web.id, uuids)),
+        ("get_inherited_relations", lambda : relations.get_inherited_relations(web.id, uuid)),
+        ("get_inherited_relations_for", lambda : relations.get_inherited_relations_for(web.id, uuids)),
+        ("InheritedRelationCache.refresh", lambda : relations.InheritedRelationCache.refresh(web.id, blob)),
+        ("Inbox.get_page", lambda : plugin_inbox.Inbox.get_page(user, web, (1001500, 1500), 50)),
+        ("Inbox.get_page unread", lambda : plugin_inbox.Inbox.get_page(user, web, None, 50, unread_only=True)),
+        ("Inbox.get_position", lambda : plugin_inbox.Inbox.get_position(user, web, uuid)),
+        ("Inbox.unread_count", lambda : plugin_inbox.Inbox.unread_count(user, web)),
+        ("Inbox.mark_read", lambda : plugin_inbox.Inbox.mark_read(user, web, (1001500, 1500))),
+        ("Inbox.add_to_inboxes", lambda : plugin_inbox.Inbox.add_to_inboxes(range(1001, 1400, 2))),
+        ("SearchIndex.search", lambda : search.SearchIndex.search(web.id, "title")),
+        ]
+
+def full_scans(db, sql, params) :
+    """Gets the details of the plan steps which scan one of the large tables."""
+    aliases = dict((alias, table) for table, alias in re.findall(r"([\w.]+) as (\w+)", sql))
+    scans = []
+    for row in db.execute("explain query plan " + sql, params or ()) :
+        detail = row[-1]
+        words = detail.split()
+        if re.search(r"VIRTUAL TABLE INDEX \d+:\S", detail) :
+            continue # a virtual table (search_index) looked up with a constraint
+        if detail == "SCAN CONSTANT ROW" :
+            continue # a select without a from, such as "select exists (...)"
+        if words and words[0] == "SCAN" :
+            table = words[2] if words[1] == "TABLE" else words[1]
+            table = aliases.get(table, table).split(".")[-1]
+            if table not in SMALL_TABLES :
+                scans.append(detail)
+    return scans
+
+def main() :
+    parser = optparse.OptionParser()
+    parser.add_option("--blobs", type="int", default=1000000, help="the number of blobs to seed")
+    parser.add_option("--db", default="bench.db", help="the database file to (re)create")
+    parser.add_option("--repeat", type="int", default=20, help="the number of timed runs of each call")
+    options, args = parser.parse_args()
+
+    t = time.time()
+    seed(options.db, options.blobs)
+    print "seeded %d blobs in %.1fs" % (options.blobs, time.time() - t)
+    models.db_connect(options.db)
+    raw = models.DB
+    models.DB = TracingDB(raw)
+
+    failures = []
+    for name, thunk in calls() :
+        thunk() # warm up the sqlite caches (and the inherited_relations table)
+        for cache in models.CACHES.itervalues() :
+            cache.clear()
+        del models.DB.statements[:]
+        thunk() # the queries behind the caches of models.CACHES
+        cold = list(models.DB.statements)
+        t = time.time()
+        for i in xrange(options.repeat) :
+            thunk()
+        elapsed = (time.time() - t) / options.repeat
+        seen = set()
+        plan = []
+        print "%-36s %9.3f ms" % (name, elapsed * 1000)
+        for sql, params in cold + models.DB.statements :
+            if sql in seen or not sql.strip().lower().startswith(("select", "insert", "update", "delete")) :
+                continue
+            seen.add(sql)
+            for row in raw.execute("explain query plan " + sql, params or ()) :
+                print "    %s" % row[-1]
+                plan.append(row[-1])
+            for scan in full_scans(raw, sql, params) :
+                failures.append((name, scan))
+        for index in EXPECTED_INDEXES.get(name, []) :
+            if not any(index in detail.split() for detail in plan) :
+                failures.append((name, "does not use %s" % index))
+    if failures :
+        print
+        print "FAILED: missing indexes"
+        for name, failure in failures :
+            print "  %s: %s" % (name, failure)
+        sys.exit(1)
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,55 @@
+# authorization.py
+# who may do what with a web, each checked with one indexed lookup
+
+import functools
+import inspect
+
+import models
+
+READ = "read" # the web is public, or the user has been granted it
+MEMBER = "member" # the user has been granted the web
+
+def can_read(user, web_id) :
+    """Whether the user can see the web.  This is a memory lookup if the set of webs
+    the user can access is cached (see models.CACHES), and otherwise asks the db
+    about just this web."""
+    web_ids = models.CACHES["access"].peek(user.id)
+    if web_ids != None :
+        return web_id in web_ids
+    return 1 == models.DB.execute("""
+    select exists (select 1 from webs where id=? and public)
+        or exists (select 1 from user_web_access where web_id=? and user_id=?)""",
+                                  (web_id, web_id, user.id)).fetchone()[0]
+
+def is_member(user, web_id) :
+    """Whether the user has been granted the web (which being public isn't enough
+    for, e.g., to add blobs to it)."""
+    return 1 == models.DB.execute("select exists (select 1 from user_web_access where web_id=? and user_id=?)",
+                                  (web_id, user.id)).fetchone()[0]
+
+CHECKS = {READ : can_read, MEMBER : is_member}
+
+def check(user, web_id, level) :
+    """Raises the same exception as for a web which doesn't exist unless the user
+    has the level of access to it."""
+    if user == None or not CHECKS[level](user, int(web_id)) :
+        raise Exception("no such web")
+
+def requires(level, web="web_id") :
+    """Declares the level of access an rpc method needs to the web which is its
+    argument named web, and checks it before each call.  It goes under @rpcmethod
+    and @models.read_only (so that a read-only method checks on the reader
+    connection too):
+
+      @rpcmethod
+      @authorization.requires(authorization.MEMBER)
+      def add_tag(self, user, web_id, uuid, tag) : ..."""
+    def _requires(f) :
+        @functools.wraps(f)
+        def _checked(*args, **kwargs) :
+            callargs = inspect.getcallargs(f, *args, **kwargs)
+            check(callargs["user"], callargs[web], level)
+            return f(*args, **kwargs)
+        _checked.access = (level, web)
+        return _checked
+    return _requires
@@ -0,0 +1,196 @@
+# backplane.py
+# connects the ChannelSets of several server processes, so that a
+# message broadcast in one reaches the channels of all of them
+
+import os
+import os.path
+import errno
+import json
+import time
+import socket
+import ctypes
+import multiprocessing
+import collections
+
+from tornado.ioloop import IOLoop
+
+import logging
+logger = logging.getLogger(__name__)
+
+class LocalBackplane(object) :
+    """The backplane of a server with only one process.  Besides passing messages
+    on, a backplane gives out sequence numbers and channel ids, which must be
+    unique across processes.  They start from the time the server started so that
+    those from before a restart are never reused."""
+    def __init__(self) :
+        self.first_seq = int(time.time() * 1000000)
+        self.seq = self.first_seq - 1
+        self.channel_id = int(time.time() * 1000)
+    def start(self, receive, resync) :
+        """Starts calling receive with the (wire format) messages published by the
+        other processes, and resync when some of those were lost.  Called in each
+        process after forking."""
+        pass
+    def publish(self, wire_messages) :
+        pass
+    def next_seq(self) :
+        self.seq += 1
+        return self.seq
+    def current_seq(self) :
+        return self.seq
+    def next_channel_id(self) :
+        self.channel_id += 1
+        return self.channel_id
+
+class UnixSocketBackplane(LocalBackplane) :
+    """The backplane for processes forked from one server.  Each process has a unix
+    datagram socket in the directory path, and publishing sends the messages to
+    all of the other sockets there.  The counters are in shared memory, so this
+    must be made before forking.
+
+    A datagram is {"from" : socket name, "n" : count, "messages" : [...]}, where
+    the count goes up by one for each datagram a process sends to another, and
+    datagrams are split by size to fit in the socket's send buffer.  Datagrams a
+    receiver isn't ready for wait in a queue for it.  If that queue passes
+    MAX_PENDING bytes (or a single message is too big to send) datagrams are
+    dropped and an empty one is queued after them, and the receiver finds the gap
+    in the counts and has its clients resync."""
+    MAX_DATAGRAM = 1 << 20
+    MAX_PENDING = 16 << 20 # bytes queued for one receiver
+    RETRY_INTERVAL = 0.05 # seconds
+    def __init__(self, path) :
+        LocalBackplane.__init__(self)
+        self.path = path
+        self.shared_seq = multiprocessing.Value(ctypes.c_longlong, self.first_seq - 1)
+        self.shared_channel_id = multiprocessing.Value(ctypes.c_longlong, self.channel_id)
+        self.sock = None
+        self.name = None
+        self.sent = {} # socket name -> count of the last datagram queued for it
+        self.pending = {} # socket name -> deque of datagrams waiting to be sent
+        self.retrying = False
+        self.received = {} # socket name -> count of the last datagram received from it
+        if not os.path.isdir(path) :
+            os.makedirs(path, 0700)
+        for name in os.listdir(path) : # left by a previous server
+            if name.endswith(".sock") :
+                os.remove(os.path.join(path, name))
+    def start(self, receive, resync) :
+        self.receive = receive
+        self.resync = resync
+        self.name = "%d.sock" % os.getpid()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(os.path.join(self.path, self.name))
+        self.sock.setblocking(0)
+        # (linux reports double the usable size, and a datagram must fit in it whole)
+        self.max_datagram = min(self.MAX_DATAGRAM, self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) // 2)
+        IOLoop.instance().add_handler(self.sock.fileno(), self.on_readable, IOLoop.READ)
+    def on_readable(self, fd, events) :
+        while True :
+            try :
+                data = self.sock.recv(self.MAX_DATAGRAM)
+            except socket.error as e :
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK) :
+                    return
+                raise
+            try :
+                datagram = json.loads(data)
+                last = self.received.get(datagram["from"], 0)
+                self.received[datagram["from"]] = datagram["n"]
+                if datagram["n"] != last + 1 :
+                    logger.warning("Missed %d datagrams from %s; resyncing", datagram["n"] - last - 1, datagram["from"])
+                    self.resync()
+                if datagram["messages"] :
+                    self.receive(datagram["messages"])
+            except Exception :
+                logger.exception("Could not take messages from the backplane")
+    def pack(self, wire_messages) :
+        """Gets the JSON of the lists of messages for each datagram, each short enough
+        to go in one along with "from" and "n".  A message which is too long by
+        itself is None (and is dropped)."""
+        room = self.max_datagram - 200
+        packed = []
+        current = []
+        size = 2
+        for m in wire_messages :
+            encoded = json.dumps(m)
+            if len(encoded) + 2 > room :
+                logger.error("Dropped a %s of %d bytes, which is too big for the backplane", m.get("type"), len(encoded))
+                packed.append(None)
+                continue
+            if current and size + len(encoded) + 1 > room :
+                packed.append("[" + ",".join(current) + "]")
+                current = []
+                size = 2
+            current.append(encoded)
+            size += len(encoded) + 1
+        if current :
+            packed.append("[" + ",".join(current) + "]")
+        return packed
+    def publish(self, wire_messages) :
+        packed = self.pack(wire_messages)
+        for name in os.listdir(self.path) :
+            if name == self.name or not name.endswith(".sock") :
+                continue
+            pending = self.pending.setdefault(name, collections.deque())
+            for messages in packed :
+                self.queue(name, messages)
+            if sum(len(data) for data in pending) > self.MAX_PENDING :
+                logger.warning("Dropped %d datagrams for the backplane socket %s, which is behind", len(pending), name)
+                pending.clear()
+                self.queue(name, None)
+            self.flush(name)
+    def queue(self, name, messages) :
+        """Queues a datagram with the (packed) messages for the socket.  None means
+        that messages were dropped: its count is skipped, and an empty datagram goes
+        after it so that the receiver finds out."""
+        self.sent[name] = n = self.sent.get(name, 0) + 1
+        if messages == None :
+            self.sent[name] = n = n + 1
+            messages = "[]"
+        self.pending[name].append('{"from":%s,"n":%d,"messages":%s}' % (json.dumps(self.name), n, messages))
+    def flush(self, name) :
+        """Sends the datagrams queued for the socket until it is full."""
+        pending = self.pending[name]
+        address = os.path.join(self.path, name)
+        while pending :
+            try :
+                self.sock.sendto(pending[0], address)
+            except socket.error as e :
+                if e.args[0] in (errno.ECONNREFUSED, errno.ENOENT) :
+                    # the process is gone (fork_processes will have started another)
+                    logger.info("Removing the backplane socket %s", name)
+                    del self.pending[name]
+                    self.sent.pop(name, None)
+                    try :
+                        os.remove(address)
+                    except OSError :
+                        pass
+                    return
+                elif e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS) :
+                    self.retry()
+                    return
+                else :
+                    raise
+            pending.popleft()
+    def retry(self) :
+        if self.retrying :
+            return
+        self.retrying = True
+        def flush_all() :
+            self.retrying = False
+            for name in [name for name, pending in self.pending.iteritems() if pending] :
+                try :
+                    self.flush(name)
+                except socket.error :
+                    logger.exception("Could not send to the backplane socket %s", name)
+        IOLoop.instance().add_timeout(time.time() + self.RETRY_INTERVAL, flush_all)
+    def next_seq(self) :
+        with self.shared_seq.get_lock() :
+            self.shared_seq.value += 1
+            return self.shared_seq.value
+    def current_seq(self) :
+        return self.shared_seq.value
+    def next_channel_id(self) :
+        with self.shared_channel_id.get_lock() :
+            self.shared_channel_id.value += 1
+            return self.shared_channel_id.value
@@ -1,29 +1,43 @@
 # channel.py
 # support for pushing updates through channels
 
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
 
 import time
+import heapq
+import collections
+import threading
 
 import logging
 logger = logging.getLogger(__name__)
 
 import models
+import backplane
 
 class Channel(object) :
     """Represents a channel which can get messages.  It queues
     messages and sends them all out on the next ioloop.  MAYBETODO:
-    why is user here?"""
+    why is user here?
+
+    A client which doesn't keep up (or has gone away without the channel having
+    expired yet) could make the queue grow without bound, so once more than
+    HIGH_WATER messages are waiting they are replaced by a ResyncMessage, and
+    the messages after it are dropped until it has been sent."""
+    HIGH_WATER = 1000
     def __init__(self, channel_id, user=None, ttl=60*2) :
         self.channel_id = channel_id
         self.user = user
         self.callbacks = set()
         self.message_queue = []
+        self.dequeue_scheduled = False
+        self.overflowed = False
         self.last_used = time.time()
         self.ttl = ttl
+        self.web_ids = set() # the webs it is subscribed to in the ChannelSet
     def update_last_used(self) :
         self.last_used = time.time()
     def maybe_dequeue(self) :
+        self.dequeue_scheduled = False
         if self.message_queue and self.callbacks :
             messages = self.message_queue
             self.message_queue = []
@@ -33,79 +47,351 @@ class Channel(object) :
                 handled = callback(messages)
             if handled :
                 self.update_last_used()
+                self.overflowed = False
             else :
                 self.message_queue = messages
     def add_messages(self, messages) :
-        for message in messages :
-            if self.user == None or message.appropriate_for(self.user) :
-                self.message_queue.append(message)
-        IOLoop.instance().add_callback(self.maybe_dequeue)
+        """Queues messages which ChannelSet.broadcast has found to be for this
+        channel."""
+        if self.overflowed :
+            return
+        self.message_queue.extend(messages)
+        if len(self.message_queue) > self.HIGH_WATER :
+            logger.warning("Channel %s passed %d messages; the client must resync",
+                           self.channel_id, self.HIGH_WATER)
+            self.resync()
+        if not self.dequeue_scheduled :
+            self.dequeue_scheduled = True
+            IOLoop.instance().add_callback(self.maybe_dequeue)
+    def resync(self) :
+        """Replaces the queued messages with a ResyncMessage."""
+        self.message_queue = [ResyncMessage()]
+        self.overflowed = True
+        if not self.dequeue_scheduled :
+            self.dequeue_scheduled = True
+            IOLoop.instance().add_callback(self.maybe_dequeue)
     def add_callback(self, callback) :
         self.update_last_used()
         self.callbacks.add(callback)
         self.maybe_dequeue()
     def remove_callback(self, callback) :
         self.update_last_used() # because it might have been a timeout
-        self.callbacks.remove(callback)
+        self.callbacks.discard(callback) # it may have been called already
+    def expires_at(self) :
+        """When the channel expires if nothing else happens (None while it has a
+        callback waiting)."""
+        if self.callbacks :
+            return None
+        return self.last_used + self.ttl
     def is_expired(self) :
         return not self.callbacks and time.time() - self.last_used > self.ttl
     def verify(self, user) :
         return self.user.id == user.id
 
+class ReplayLog(object) :
+    """The last size messages about one web, for clients which come back after
+    their channel has gone away (see ChannelSet.resume)."""
+    def __init__(self, size, evicted_through) :
+        self.messages = collections.deque(maxlen=size)
+        self.evicted_through = evicted_through # the seq of the last message dropped
+    def append(self, message) :
+        if len(self.messages) == self.messages.maxlen :
+            self.evicted_through = self.messages[0].seq
+        self.messages.append(message)
+    def since(self, seq) :
+        """Gets the messages after seq, or None if some of them have been dropped."""
+        if seq < self.evicted_through :
+            return None
+        return [m for m in self.messages if m.seq > seq]
+
 class ChannelSet(object) :
+    """Keeps the open channels, indexed by the webs their users can see, so that
+    a message about some webs is only considered for the channels subscribed to
+    them.
+
+    Each broadcast message gets the next sequence number, and the last few
+    messages about each web are kept in a ReplayLog.
+
+    When the server runs as several processes, each has a ChannelSet for its own
+    clients, and the backplane (see backplane.py) passes the messages broadcast in
+    one process to the others, which deliver them to their channels.  The firehose
+    listeners only hear the messages broadcast in their own process, so that
+    what they do is done once."""
+    REPLAY_SIZE = 256
     def __init__(self) :
         self.channels = dict()
+        self.subscribers = dict() # web_id -> set of channels
+        self.unfiltered = set() # channels without a user, which get everything
         self.firehoseListeners = []
-        self.next_channel_id = 1
+        self.replay = dict() # web_id (None for messages about every web) -> ReplayLog
+        self.set_backplane(backplane.LocalBackplane())
+        self.thread = threading.current_thread() # the thread of the IOLoop
+        self.expiry = [] # heap of (time to check, channel_id), one per channel
+        self.reaper = None
+        self.num_reaped = 0
+    def set_backplane(self, backplane) :
+        self.backplane = backplane
+        self.first_seq = backplane.first_seq
+    def start_backplane(self) :
+        """Starts taking messages from the other processes (after forking)."""
+        self.thread = threading.current_thread()
+        self.backplane.start(self.receive, self.resync)
     def add_channel(self, user=None) :
-        i = self.next_channel_id
-        self.next_channel_id += 1
+        i = self.backplane.next_channel_id()
         c = Channel(i, user)
         self.channels[i] = c
+        heapq.heappush(self.expiry, (c.expires_at(), i))
+        if user == None :
+            self.unfiltered.add(c)
+        else :
+            for web_id in models.UserWebAccess.web_ids_for_user(user) :
+                self.subscribe(c, web_id)
         logger.info("Added channel_id=%s", i)
         return c
+    def remove_channel(self, i) :
+        c = self.channels.pop(i)
+        self.unfiltered.discard(c)
+        for web_id in c.web_ids :
+            self.subscribers[web_id].discard(c)
+            if not self.subscribers[web_id] :
+                del self.subscribers[web_id]
+    def subscribe(self, c, web_id) :
+        c.web_ids.add(web_id)
+        self.subscribers.setdefault(web_id, set()).add(c)
+    def resubscribe(self, web_id, channels) :
+        """Makes exactly the channels be subscribed to the web."""
+        for c in self.subscribers.pop(web_id, ()) :
+            c.web_ids.discard(web_id)
+        for c in channels :
+            if c.user != None :
+                self.subscribe(c, web_id)
     def get_channel(self, i) :
         return self.channels.get(i, None)
+    def resume(self, user, last_seq) :
+        """Opens a new channel for a client which has seen the messages up to
+        last_seq on a channel which is gone (it expired, or the server restarted),
+        and queues the messages it missed.  Returns None if some of those have been
+        dropped from the replay logs, in which case the client must resync."""
+        if last_seq < self.first_seq - 1 :
+            return None
+        c = self.add_channel(user)
+        missed = dict()
+        for web_id in list(c.web_ids) + [None] :
+            log = self.replay.get(web_id)
+            if log == None :
+                continue
+            messages = log.since(last_seq)
+            if messages == None :
+                self.remove_channel(c.channel_id)
+                return None
+            for m in messages :
+                if m.appropriate_for(user) :
+                    missed[m.seq] = m
+        logger.info("Resumed from seq %s as channel_id=%s with %d messages", last_seq, c.channel_id, len(missed))
+        if missed :
+            c.add_messages([missed[seq] for seq in sorted(missed)])
+        return c
     def add_firehose_listener(self, callback) :
         self.firehoseListeners.append(callback)
+    def recipients(self, message) :
+        """Gets the channels which should get the message.  The access set of the
+        message is computed once here rather than once per channel."""
+        web_ids = message.web_ids()
+        if web_ids == None :
+            candidates = self.channels.values()
+        else :
+            candidates = set(self.unfiltered)
+            for web_id in web_ids :
+                candidates.update(self.subscribers.get(web_id, ()))
+        user_ids = message.user_ids()
+        if user_ids == None :
+            return list(candidates)
+        return [c for c in candidates if c.user == None or c.user.id in user_ids]
     def broadcast(self, messages) :
-        for i, channel in self.channels.iteritems() :
-            channel.add_messages(messages)
+        if threading.current_thread() is not self.thread :
+            # channels are only touched from the IOLoop (rpc methods run on workers)
+            IOLoop.instance().add_callback(self.broadcast, messages)
+            return
+        for message in messages :
+            message.seq = self.backplane.next_seq()
+        self.deliver(messages)
+        try :
+            self.backplane.publish([message.to_wire() for message in messages])
+        except Exception :
+            # the other processes find out from the backplane that they missed these
+            logger.exception("Could not publish %d messages on the backplane", len(messages))
         for listener in self.firehoseListeners :
             listener(messages)
-        to_remove = set()
-        for i, channel in self.channels.iteritems() :
-            if channel.is_expired() :
-                to_remove.add(i)
-        for i in to_remove :
-            del self.channels[i]
+    def receive(self, wire_messages) :
+        """Delivers messages which were broadcast in another process.  A web having
+        changed there means the copy of it cached here (see models.CACHES) is out of
+        date."""
+        messages = [message_from_wire(m) for m in wire_messages]
+        for message in messages :
+            if isinstance(message, WebChangeMessage) :
+                models.Web.invalidate(message.web_id)
+        self.deliver(messages)
+    def resync(self) :
+        """Has every client of this process reload, because messages broadcast in
+        another process were lost on the way here.  Those clients can't resume from
+        before now either, since the replay logs are missing the messages too."""
+        self.first_seq = self.backplane.current_seq() + 1
+        for c in self.channels.values() :
+            c.resync()
+    def deliver(self, messages) :
+        """Queues the messages on the channels of this process."""
+        queued = dict() # channel -> messages, in order
+        for message in messages :
+            self.log(message)
+            recipients = self.recipients(message)
+            for c in recipients :
+                queued.setdefault(c, []).append(message)
+            if isinstance(message, WebChangeMessage) :
+                # the recipients are exactly the channels which can now see the web
+                self.resubscribe(message.web_id, recipients if message.web_name != None else [])
+        for c, channel_messages in queued.iteritems() :
+            c.add_messages(channel_messages)
+    def log(self, message) :
+        web_ids = message.web_ids()
+        for web_id in ([None] if web_ids == None else web_ids) :
+            if web_id not in self.replay :
+                self.replay[web_id] = ReplayLog(self.REPLAY_SIZE, self.first_seq - 1)
+            self.replay[web_id].append(message)
+    def start_reaper(self, interval=10) :
+        """Removes expired channels every interval seconds."""
+        self.reaper = PeriodicCallback(self.reap, interval * 1000)
+        self.reaper.start()
+    def reap(self) :
+        """Removes the channels which have expired.  Each channel has one entry in the
+        expiry heap, which is only looked at once its time has come; if the channel
+        was used in the meantime, the entry is put back with the new time.  Returns
+        the number of channels removed."""
+        now = time.time()
+        reaped = 0
+        while self.expiry and self.expiry[0][0] <= now :
+            t, i = heapq.heappop(self.expiry)
+            c = self.channels.get(i)
+            if c == None :
+                continue
+            expires = c.expires_at()
+            if expires != None and expires <= now :
+                self.remove_channel(i)
+                reaped += 1
+            else :
+                # in use: check again a ttl from now or from when it was last used
+                heapq.heappush(self.expiry, (expires or now + c.ttl, i))
+        if reaped :
+            logger.info("Reaped %d expired channels", reaped)
+        self.num_reaped += reaped
+        return reaped
+    def stats(self) :
+        return {"channels" : len(self.channels),
+                "waiting" : sum(1 for c in self.channels.itervalues() if c.callbacks),
+                "queued_messages" : sum(len(c.message_queue) for c in self.channels.itervalues()),
+                "subscriptions" : sum(len(s) for s in self.subscribers.itervalues()),
+                "seq" : self.backplane.current_seq(),
+                "replay_messages" : sum(len(log.messages) for log in self.replay.itervalues()),
+                "reaped" : self.num_reaped}
 
 class Message(object) :
-    def appropriate_for(self, user) :
+    """Who gets a message is given by web_ids, the webs it concerns (None for all
+    of them), and user_ids, the set of ids of the users who may see it (None for
+    anyone who can see those webs).  ChannelSet.broadcast sets seq.
+
+    To go through the backplane, a message is turned into a dictionary by to_wire
+    and back by the from_wire of its class, which must be registered with
+    @message_type.  The wire format includes the access sets, so that they are
+    still only computed once."""
+    seq = None
+    batch = False # whether a run of these can be sent as one (see serialize_messages)
+    def to_wire(self) :
         raise NotImplemented
+    def web_ids(self) :
+        return None
+    def user_ids(self) :
+        return None
+    def appropriate_for(self, user) :
+        user_ids = self.user_ids()
+        return user_ids == None or user.id in user_ids
     def serialize(self) :
         raise NotImplemented
 
+MESSAGE_TYPES = {}
+def message_type(cls) :
+    MESSAGE_TYPES[cls.__name__] = cls
+    return cls
+
+def message_from_wire(wire) :
+    message = MESSAGE_TYPES[wire["type"]].from_wire(wire)
+    message.seq = wire["seq"]
+    return message
+
+def serialize_messages(messages) :
+    """Serializes messages for a client, with their sequence numbers.  Since each
+    WebChangeMessage has the whole state of its web, only the last one for each
+    web is sent.  A run of messages of a type with batch = True is sent as one,
+    with the args of each in 'batch' and the highest seq."""
+    last_change = dict((m.web_id, m) for m in messages if isinstance(m, WebChangeMessage))
+    serialized = []
+    for m in messages :
+        if isinstance(m, WebChangeMessage) and last_change[m.web_id] is not m :
+            continue
+        d = m.serialize()
+        if m.batch and serialized and serialized[-1]["type"] == d["type"] :
+            last = serialized[-1]
+            if "batch" not in last :
+                last["batch"] = [last.pop("args")]
+            last["batch"].append(d["args"])
+            last["seq"] = max(last["seq"], m.seq)
+        else :
+            d["seq"] = m.seq
+            serialized.append(d)
+    return serialized
+
+@message_type
 class TextMessage(Message) :
     def __init__(self, user, m) :
         self.user = user
         self.m = m
-    def appropriate_for(self, user) :
-        return True
+    def to_wire(self) :
+        return {"type" : "TextMessage", "seq" : self.seq,
+                "user" : self.user, "m" : self.m}
+    @staticmethod
+    def from_wire(wire) :
+        return TextMessage(wire["user"], wire["m"])
     def serialize(self) :
         return {"type" : "TextMessage",
                 "args" : {"user" : self.user,
                           "m" : self.m}}
 
+@message_type
 class NewBlobMessage(Message) :
+    batch = True
     def __init__(self, blob) :
         self.blob = blob
-    def appropriate_for(self, user) :
-        return models.WebBlobAccess.can_user_access(user, self.blob)
+        self._access = None
+    def to_wire(self) :
+        return {"type" : "NewBlobMessage", "seq" : self.seq,
+                "blob_id" : self.blob.id, "uuid" : self.blob.uuid, "access" : self.access()}
+    @staticmethod
+    def from_wire(wire) :
+        m = NewBlobMessage(models.Blob(id=wire["blob_id"], uuid=wire["uuid"]))
+        m._access = [tuple(a) for a in wire["access"]]
+        return m
+    def access(self) :
+        """The (web_id, user_id) pairs of the users who can access the blob."""
+        if self._access == None :
+            self._access = models.WebBlobAccess.get_web_users_for_blob(self.blob)
+        return self._access
+    def web_ids(self) :
+        return set(web_id for web_id, user_id in self.access())
+    def user_ids(self) :
+        return set(user_id for web_id, user_id in self.access())
     def serialize(self) :
         return {"type" : "NewBlobMessage",
                 "args" : {"uuid" : self.blob.uuid}}
 
+@message_type
 class WebChangeMessage(Message) :
     def __init__(self, web_id, web_name=None, web_public=None, was_public=False) :
         """web_name being None represents web deletion."""
@@ -113,10 +399,37 @@ class WebChangeMessage(Message) :
         self.web_name = web_name
         self.web_public = web_public
         self.was_public = was_public
-    def appropriate_for(self, user) :
-        return self.web_name == None or self.web_id in [w.id for w in models.UserWebAccess.get_for_user(user)]
+        self._user_ids = None
+    def to_wire(self) :
+        user_ids = self.user_ids()
+        return {"type" : "WebChangeMessage", "seq" : self.seq,
+                "web_id" : self.web_id, "web_name" : self.web_name,
+                "web_public" : self.web_public, "was_public" : self.was_public,
+                "user_ids" : None if user_ids == None else list(user_ids)}
+    @staticmethod
+    def from_wire(wire) :
+        m = WebChangeMessage(wire["web_id"], wire["web_name"], wire["web_public"], wire["was_public"])
+        if wire["user_ids"] != None :
+            m._user_ids = set(wire["user_ids"])
+        return m
+    def user_ids(self) :
+        """Everyone hears about deleted and public webs, but only the users of a
+        private web hear about it.  (This is sent to all channels since it may be
+        about a change in who can see the web.)"""
+        if self.web_name == None or self.web_public :
+            return None
+        if self._user_ids == None :
+            self._user_ids = set(models.UserWebAccess.user_ids_for_web(self.web_id))
+        return self._user_ids
     def serialize(self) :
         return {"type" : "WebChangeMessage",
                 "args" : {"web_id" : self.web_id,
                           "web_name" : self.web_name,
                           "web_public" : self.web_public}}
+
+class ResyncMessage(Message) :
+    """Tells the client that it missed messages and must reload everything (see
+    Channel.HIGH_WATER and ChannelSet.resync)."""
+    def serialize(self) :
+        return {"type" : "ResyncMessage",
+                "args" : {}}
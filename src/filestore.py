@@ -0,0 +1,126 @@
+# filestore.py
+# a content-addressed store for large content, on disk rather than in
+# the content table
+
+import os
+import os.path
+import re
+import tempfile
+import hashlib
+
+import logging
+logger = logging.getLogger(__name__)
+
+import models
+import migrations
+
+_HASH_RE = re.compile(r"^[0-9a-f]{40}$")
+
+class FileStore(object) :
+    """Keeps content in files named by their SHA-1 hash (the same hash as in the
+    content table), sharded by the first two pairs of hex digits so that no
+    directory gets too large: root/ab/cd/abcd....  Since a file's name is its
+    hash, files are never modified once written."""
+    def __init__(self, root) :
+        self.root = root
+    def path(self, hash) :
+        if not _HASH_RE.match(hash) :
+            raise ValueError("not a content hash: %r" % hash)
+        return os.path.join(self.root, hash[0:2], hash[2:4], hash)
+    def has(self, hash) :
+        return os.path.isfile(self.path(hash))
+    def size(self, hash) :
+        return os.path.getsize(self.path(hash))
+    def open(self, hash) :
+        return open(self.path(hash), "rb")
+    def temp_dir(self) :
+        """The directory for files which are still being written (on the same file
+        system as the store, so they can be renamed into it)."""
+        dirname = os.path.join(self.root, "tmp")
+        self._makedirs(dirname)
+        return dirname
+    def _makedirs(self, dirname) :
+        if not os.path.isdir(dirname) :
+            try :
+                os.makedirs(dirname)
+            except OSError :
+                if not os.path.isdir(dirname) : # not just another thread making it
+                    raise
+    def put_file(self, hash, filename) :
+        """Moves the file into the store under the hash, or removes it if the hash
+        is already there."""
+        path = self.path(hash)
+        if os.path.isfile(path) :
+            os.remove(filename)
+            return
+        self._makedirs(os.path.dirname(path))
+        os.rename(filename, path)
+    def put(self, hash, stuff) :
+        """Writes the string (or buffer) under the hash unless it is already there.
+        The file is written to a temporary name and then renamed, so a reader never
+        sees part of a file."""
+        path = self.path(hash)
+        if os.path.isfile(path) :
+            return
+        dirname = os.path.dirname(path)
+        self._makedirs(dirname)
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+        try :
+            with os.fdopen(fd, "wb") as f :
+                f.write(stuff)
+            os.rename(tmpname, path)
+        except :
+            os.remove(tmpname)
+            raise
+
+class SpillFile(object) :
+    """Takes content a chunk at a time (e.g. an upload as it arrives), computing its
+    hash as it goes and writing it to a temporary file in the store, so that memory
+    use doesn't depend on its size.  See models.Content.get_by_spill_file."""
+    def __init__(self, store) :
+        fd, self.filename = tempfile.mkstemp(dir=store.temp_dir(), prefix=".upload-")
+        self.f = os.fdopen(fd, "wb")
+        self.sha1 = hashlib.sha1()
+        self.length = 0
+        self.hash = None
+    def write(self, chunk) :
+        self.sha1.update(chunk)
+        self.length += len(chunk)
+        self.f.write(chunk)
+    def close(self) :
+        """Finishes writing.  Returns the hash of the content."""
+        if not self.f.closed :
+            self.f.close()
+            self.hash = self.sha1.hexdigest()
+        return self.hash
+    def read(self) :
+        with open(self.filename, "rb") as f :
+            return f.read()
+    def discard(self) :
+        """Removes the temporary file if it hasn't been moved into the store."""
+        self.f.close()
+        if os.path.isfile(self.filename) :
+            os.remove(self.filename)
+
+@migrations.backfill("filestore")
+def backfill_filestore(position, chunk_size) :
+    """Moves the content which is at least Content.FILE_THRESHOLD bytes long from the
+    content table into the file store, chunk_size rows at a time."""
+    position = position or 0
+    rows = models.DB.execute("select rowid, hash, stuff, stored from content where rowid > ? order by rowid limit ?",
+                             (position, chunk_size)).fetchall()
+    if not rows :
+        return None
+    moved = []
+    for r in rows :
+        stuff = r['stuff']
+        if isinstance(stuff, unicode) :
+            stuff = stuff.encode("utf-8") # the bytes which were hashed
+        if not r['stored'] and len(stuff) >= models.Content.FILE_THRESHOLD :
+            models.FILE_STORE.put(r['hash'], stuff)
+            moved.append((r['hash'],))
+    if moved :
+        with models.DB :
+            models.DB.executemany("update content set stuff='', stored=1 where hash=?", moved)
+        logger.info("Moved %d contents to the file store", len(moved))
+    return rows[-1]['rowid']
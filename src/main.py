@@ -5,11 +5,21 @@ import tornado.template
 import tornado.httputil
 import tornado.httpclient
 import tornado.auth
+import tornado.websocket
+import tornado.httpserver
+import tornado.netutil
+import tornado.process
 import httplib
 import tornado.options
+from tornado import gen
+from tornado.concurrent import Future
 
+import os.path
+import tempfile
 import json
 import urllib
+import urlparse
+import re
 
 import uuid
 import base64
@@ -29,17 +39,30 @@ import channel
 import minirpc
 import rpcmodules
 import methods
+import migrations
+import workers
+import backplane
+import filestore
+import authorization
 
 channels = channel.ChannelSet()
 
 import plugin_inbox
+import search
 plugin_inbox.add_inbox_plugin(channels)
 
 tornado.options.define("port", default=8222, help="the port number to run on", type=int)
 tornado.options.define("googckey", default=None, help="the google consumer key", type=str)
 tornado.options.define("googcsecret", default=None, help="the google consumer secret", type=str)
+tornado.options.define("workers", default=4, help="the number of threads for db work", type=int)
+tornado.options.define("backfill", default=[], multiple=True, help="backfills to (re)start, e.g. relations", type=str)
+tornado.options.define("processes", default=1, help="the number of server processes (0 for one per cpu)", type=int)
+tornado.options.define("bus", default=None, help="the directory for the sockets between processes", type=str)
 
-models.db_connect("mv.db")
+DB_FILE = "mv.db"
+models.db_connect(DB_FILE)
+
+pool = None # the workers.WorkerPool, started in main
 
 def random256() :
     return base64.b64encode(uuid.uuid4().bytes + uuid.uuid4().bytes)
@@ -122,33 +145,50 @@ class MainHandler(MVRequestHandler) :
     @tornado.web.authenticated
     def get(self) :
         channel = channels.add_channel(self.current_user)
-        self.render("index.html", channel_id=channel.channel_id)
+        self.render("index.html", channel_id=channel.channel_id, last_seq=channels.backplane.current_seq())
+
+def open_channel(user, channel_id, last_seq=None) :
+    """Gets the user's channel.  If it is gone and the client says which messages
+    it has seen (last_seq), it gets a new channel with the messages it missed (see
+    ChannelSet.resume).  Returns (channel, error)."""
+    channel = channels.get_channel(channel_id)
+    if channel != None and channel.verify(user) :
+        return channel, None
+    if last_seq == None :
+        logger.warning("User %s got empty channel", user)
+        return None, "no such channel"
+    channel = channels.resume(user, last_seq)
+    if channel == None :
+        logger.warning("User %s must resync from seq %s", user, last_seq)
+        return None, "resync required"
+    return channel, None
 
 class PollHandler(MVRequestHandler) :
+    """Long polling, for clients without WebSockets or server-sent events.  The
+    response includes the channel id, which changes if the channel was resumed."""
     @tornado.web.authenticated
     @tornado.web.asynchronous
     def post(self) :
         logger.info("Poll request for %s", self.current_user)
-        channel = None
         try :
-            logger.info("channel_id=%s", self.get_argument("channel_id", None))
-            self.channel_id = int(self.get_argument("channel_id", None))
-            channel = channels.get_channel(self.channel_id)
-        except TypeError, ValueError :
-            pass
-        if channel != None and not channel.verify(self.current_user) :
-            channel = None
-        if channel == None :
-            logger.warning("User %s got empty channel", self.current_user)
+            channel_id = int(self.get_argument("channel_id", None))
+            last_seq = self.get_argument("last_seq", None)
+            last_seq = None if last_seq in (None, "") else int(last_seq)
+        except (TypeError, ValueError) :
             self.finish({"error" : "no such channel"})
             return
+        channel, error = open_channel(self.current_user, channel_id, last_seq)
+        if error != None :
+            self.finish({"error" : error})
+            return
+        self.channel_id = channel.channel_id
         channel.add_callback(self.on_new_messages)
     def on_new_messages(self, messages) :
         logger.info("Sending messages to %s", self.current_user)
         if self.request.connection.stream.closed() :
             return False
         else :
-            self.finish(dict(messages=[m.serialize() for m in messages]))
+            self.finish(dict(channel_id=self.channel_id, messages=channel.serialize_messages(messages)))
             return True
     def on_connection_close(self) :
         logger.info("client closed the connection")
@@ -156,6 +196,103 @@ class PollHandler(MVRequestHandler) :
         if channel != None :
             channel.remove_callback(self.on_new_messages)
 
+class ChannelStream(object) :
+    """A mixin for handlers which keep a connection open and send each batch of
+    messages from a channel as soon as it is queued, rather than finishing after
+    one batch like PollHandler.  The handler registers itself as a callback on the
+    Channel again once a batch has been written to the socket, so that the
+    messages for a slow client wait in the Channel (which bounds them; see
+    Channel.HIGH_WATER) rather than in the socket's buffer."""
+    def attach_channel(self, channel_id, last_seq=None) :
+        """Starts sending the messages of the channel (or of a resumed channel, whose
+        id is sent first).  The arguments are as the client sent them.  Returns an
+        error if there is no channel."""
+        self.channel = None
+        try :
+            channel_id = int(channel_id)
+            last_seq = None if last_seq in (None, "") else int(last_seq)
+        except (TypeError, ValueError) :
+            return "no such channel"
+        self.channel, error = open_channel(self.current_user, channel_id, last_seq)
+        if error != None :
+            return error
+        if self.channel.channel_id != channel_id :
+            self.send_messages({"channel_id" : self.channel.channel_id})
+        self.channel.add_callback(self.on_new_messages)
+        return None
+    def get_last_seq(self) :
+        return self.get_argument("last_seq", None)
+    def detach_channel(self) :
+        if getattr(self, "channel", None) != None :
+            self.channel.remove_callback(self.on_new_messages)
+            self.channel = None
+    def on_new_messages(self, messages) :
+        if self.channel == None or self.request.connection.stream.closed() :
+            return False
+        self.send_messages(dict(messages=channel.serialize_messages(messages)),
+                           max(m.seq for m in messages), callback=self.on_sent)
+        return True
+    def on_sent(self) :
+        if self.channel == None :
+            return
+        if channels.get_channel(self.channel.channel_id) is not self.channel :
+            # it expired while the socket was busy; the client will resume
+            self.detach_channel()
+            self.end_stream()
+            return
+        self.channel.add_callback(self.on_new_messages)
+
+class ChannelSocketHandler(ChannelStream, tornado.websocket.WebSocketHandler, MVRequestHandler) :
+    """Streams the messages of a channel over a WebSocket."""
+    def open(self, channel_id) :
+        origin = self.request.headers.get("Origin", self.request.headers.get("Sec-Websocket-Origin"))
+        if origin != None and urlparse.urlparse(origin).netloc != self.request.host :
+            logger.warning("Refused a channel socket from %s", origin)
+            self.close()
+        elif self.current_user == None :
+            self.write_message({"error" : "no such channel"})
+            self.close()
+        else :
+            error = self.attach_channel(channel_id, self.get_last_seq())
+            if error != None :
+                self.write_message({"error" : error})
+                self.close()
+    def send_messages(self, data, seq=None, callback=None) :
+        self.write_message(data)
+        if callback != None :
+            self.stream.write(b"", callback) # called once the frame has been written
+    def end_stream(self) :
+        self.close()
+    def on_close(self) :
+        self.detach_channel()
+
+class ChannelEventsHandler(ChannelStream, MVRequestHandler) :
+    """Streams the messages of a channel as server-sent events (for browsers or
+    proxies without WebSockets).  The id of each event is the seq of its last
+    message, so a browser which reconnects by itself sends it back in the
+    Last-Event-ID header."""
+    @tornado.web.authenticated
+    @tornado.web.asynchronous
+    def get(self, channel_id) :
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        last_seq = self.request.headers.get("Last-Event-ID") or self.get_last_seq()
+        error = self.attach_channel(channel_id, last_seq)
+        if error != None :
+            self.send_messages({"error" : error})
+            self.finish()
+            return
+        self.flush()
+    def send_messages(self, data, seq=None, callback=None) :
+        if seq != None :
+            self.write("id: %s\n" % seq)
+        self.write("data: %s\n\n" % json.dumps(data))
+        self.flush(callback=callback)
+    def end_stream(self) :
+        self.finish()
+    def on_connection_close(self) :
+        self.detach_channel()
+
 class PushHandler(MVRequestHandler) :
     def get(self) :
         from channel import TextMessage
@@ -163,8 +300,20 @@ class PushHandler(MVRequestHandler) :
         channels.broadcast([TextMessage("no one", msg)])
         self.finish("Wrote out: %s" % msg)
 
+class ChannelStatsHandler(MVRequestHandler) :
+    @tornado.web.authenticated
+    def get(self) :
+        self.finish(channels.stats())
+
+class CacheStatsHandler(MVRequestHandler) :
+    """The size, hits and misses of the caches of this process (see models.CACHES)."""
+    @tornado.web.authenticated
+    def get(self) :
+        self.finish(models.cache_stats())
+
 class RpcHandler(MVRequestHandler) :
     @tornado.web.authenticated
+    @gen.coroutine
     def post(self, module) :
         def getMessage() :
             args = json.loads(self.get_argument("message", None))
@@ -176,62 +325,235 @@ class RpcHandler(MVRequestHandler) :
             self.finish(minirpc.render_exception(KeyError(module)))
         else :
             const_args = {"handler" : self, "channels" : channels}
-            self.finish(minirpc.handle_request(rpcmodules.RPC_MODULES[module](**const_args),
-                                               getMessage))
+            response = minirpc.handle_request(rpcmodules.RPC_MODULES[module](**const_args),
+                                              getMessage, caller=pool.submit)
+            if isinstance(response, Future) :
+                response = yield response
+            self.finish(response)
 
-class BlobHandler(MVRequestHandler) :
+class BatchRpcHandler(MVRequestHandler) :
+    """Takes a list of rpc messages (each with the 'module' it is for) and runs them
+    on one worker in one read transaction, so that for instance everything the page
+    needs when it loads comes from one request and one version of the db.  Responds
+    with {"responses" : {id : response}}."""
     @tornado.web.authenticated
-    def head(self, blob_id) :
-        self.get(blob_id, include_body=False)
+    @gen.coroutine
+    def post(self) :
+        try :
+            messages = json.loads(self.get_argument("messages"))
+            if type(messages) != list :
+                raise ValueError("Expecting a list of messages")
+            for message in messages :
+                message.setdefault("kwargs", {})["user"] = self.current_user
+        except Exception as x :
+            self.finish(minirpc.render_exception(x))
+            return
+        const_args = {"handler" : self, "channels" : channels}
+        servables = dict((name, rpcmodules.RPC_MODULES[name](**const_args))
+                         for name in set(m.get("module") for m in messages)
+                         if name in rpcmodules.RPC_MODULES)
+        def run_batch() :
+            with models.DB.snapshot() :
+                return minirpc.handle_batch(servables, messages)
+        responses = yield pool.submit(run_batch)
+        self.finish({"responses" : responses})
+
+def parse_http_date(value) :
+    date_tuple = email.utils.parsedate(value)
+    if date_tuple == None :
+        return None
+    return datetime.datetime.fromtimestamp(time.mktime(date_tuple))
+
+def parse_byte_range(header, length) :
+    """Parses a Range header with a single byte range into (start, end), where end
+    is exclusive and at most length.  Returns None if the header isn't such a range
+    (in which case all of the content is sent), and raises ValueError if the range
+    can't be satisfied."""
+    m = re.match(r"^bytes=(\d*)-(\d*)$", header.strip())
+    if m == None or m.group(1) == m.group(2) == "" :
+        return None
+    if m.group(1) == "" : # the last n bytes
+        n = int(m.group(2))
+        if n == 0 :
+            raise ValueError(header)
+        return max(0, length - n), length
+    start = int(m.group(1))
+    if m.group(2) != "" and int(m.group(2)) < start :
+        return None
+    if start >= length :
+        raise ValueError(header)
+    end = length if m.group(2) == "" else min(length, int(m.group(2)) + 1)
+    return start, end
+
+class BlobHandler(MVRequestHandler) :
+    """Serves the content of a blob, a piece at a time, with support for Range
+    requests.  The ETag is the hash of the content."""
+    CHUNK_SIZE = 64*1024
+    CACHE_MAX_AGE = 86400*365*10 # 10 years
 
     @tornado.web.authenticated
-    def get(self, blob_id, filename=None, include_body=True) :
+    def head(self, blob_id, filename=None) :
+        return self.get(blob_id, filename, include_body=False)
+
+    @staticmethod
+    def load_blob(user, blob_id) :
+        """Gets the blob and its content, without reading a stored content (run on a
+        worker)."""
         blob = models.Blob.get_by_uuid(blob_id)
-        if not blob :
-            raise tornado.web.HTTPError(404)
-        content = str(blob.content.stuff)
-        if not blob or not models.WebBlobAccess.can_user_access(self.current_user, blob) :
+        if not blob or not models.WebBlobAccess.can_user_access(user, blob) :
             raise tornado.web.HTTPError(404)
+        blob.content.length # so the file store isn't touched on the IOLoop
+        return blob, blob.content
+
+    def is_not_modified(self, blob) :
+        if self.request.headers.get("If-None-Match") != None :
+            return self.check_etag_header()
+        if_since = parse_http_date(self.request.headers.get("If-Modified-Since", ""))
+        return if_since != None and if_since >= blob.date_created
+
+    def is_range_current(self, blob) :
+        """Whether the If-Range header (if any) still matches the blob."""
+        if_range = self.request.headers.get("If-Range")
+        if if_range == None :
+            return True
+        if if_range.startswith(("\"", "W/")) :
+            return if_range == '"%s"' % blob.content_hash # the Etag
+        return parse_http_date(if_range) == blob.date_created
+
+    @tornado.web.authenticated
+    @gen.coroutine
+    def get(self, blob_id, filename=None, include_body=True) :
+        blob, content = yield pool.submit(self.load_blob, self.current_user, blob_id)
         if blob.content_type.startswith("mime:") :
             self.set_header("Content-Type", blob.content_type[len("mime:"):])
-        self.set_header("Content-Length", len(content))
+        self.set_header("Accept-Ranges", "bytes")
+        self.set_header("Etag", '"%s"' % blob.content_hash)
         self.set_header("Last-Modified", blob.date_created)
-        CACHE_MAX_AGE = 86400*365*10 # 10 years
-        self.set_header("Expires", (datetime.datetime.utcnow() + datetime.timedelta(seconds=CACHE_MAX_AGE)))
-        self.set_header("Cache-Control", "max-age=" + str(CACHE_MAX_AGE))
-        ims_value = self.request.headers.get("If-Modified-Since")
-        if ims_value is not None :
-            date_tuple = email.utils.parsedate(ims_value)
-            if_since = datetime.datetime.fromtimestamp(time.mktime(date_tuple))
-            if if_since >= blob.date_created :
-                self.set_status(304)
+        self.set_header("Expires", (datetime.datetime.utcnow() + datetime.timedelta(seconds=self.CACHE_MAX_AGE)))
+        self.set_header("Cache-Control", "max-age=" + str(self.CACHE_MAX_AGE))
+        if self.is_not_modified(blob) :
+            self.set_status(304)
+            return
+        length = content.length
+        start, end = 0, length
+        range_header = self.request.headers.get("Range")
+        if range_header != None and self.is_range_current(blob) :
+            try :
+                byte_range = parse_byte_range(range_header, length)
+            except ValueError :
+                self.set_status(416)
+                self.set_header("Content-Range", "bytes */%d" % length)
                 return
+            if byte_range != None :
+                start, end = byte_range
+                self.set_status(206)
+                self.set_header("Content-Range", "bytes %d-%d/%d" % (start, end - 1, length))
+        self.set_header("Content-Length", end - start)
         if not include_body :
             return
-        self.write(content)
-        self.flush()
-        return
+        with content.open() as f :
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0 :
+                chunk = f.read(min(self.CHUNK_SIZE, remaining))
+                if not chunk or self.request.connection.stream.closed() :
+                    break
+                remaining -= len(chunk)
+                yield self.write_chunk(chunk)
+
+    def write_chunk(self, chunk) :
+        """Writes and flushes the chunk.  Returns a future which is resolved when the
+        chunk has been written to the socket (or the client has gone away)."""
+        flushed = self.flushed = Future()
+        self.write(chunk)
+        self.flush(callback=lambda : flushed.done() or flushed.set_result(None))
+        return flushed
+
+    def on_connection_close(self) :
+        flushed = getattr(self, "flushed", None)
+        if flushed != None and not flushed.done() :
+            flushed.set_result(None)
 
 class UploadHandler(MVRequestHandler) :
+    """Takes a multipart form with the files in 'files'.  Tornado holds the whole
+    request in memory, so StreamUploadHandler is better for large files."""
+    @staticmethod
+    def check_member(user, web_id) :
+        """Raises a 404 unless the user may add blobs to the web.  This comes before
+        any of the content is stored."""
+        if not authorization.is_member(user, web_id) :
+            raise tornado.web.HTTPError(404)
+
+    @staticmethod
+    def add_blob(user, web_id, content_type, content, filename=None) :
+        """Makes a blob with the stored content (see check_member)."""
+        web = models.Web.get_by_id(web_id)
+        b = models.Blob.make_blob(user, "mime:" + (content_type or "plain/text"), content)
+        models.WebBlobAccess.add_for_blob(web, b)
+        if filename :
+            relations.BinaryRelation.make(web, user, "filename", b, filename)
+        return b
+
+    @staticmethod
+    def store_files(user, web_id, files) :
+        """Makes a blob for each uploaded file (run on a worker)."""
+        UploadHandler.check_member(user, web_id)
+        return [UploadHandler.add_blob(user, web_id, f.content_type,
+                                       models.Content.get_by_stuff(buffer(f.body)), f.filename)
+                for f in files]
+
     @tornado.web.authenticated
+    @gen.coroutine
     def post(self, web_id) :
-        web_id = int(web_id)
-        users_webs = models.UserWebAccess.get_for_user(self.current_user)
-        web = [w for w in users_webs if w.id == web_id][0]
-        uuids = []
-        blobs = []
-        for f in self.request.files["files"] :
-            content_type = "mime:" + (f.content_type or "plain/text")
-            c = models.Content.get_by_stuff(buffer(f.body))
-            b = models.Blob.make_blob(self.current_user, content_type, c)
-            blobs.append(b)
-            models.WebBlobAccess.add_for_blob(web, b)
-            if f.filename :
-                relations.BinaryRelation.make(web, self.current_user, "filename", b, f.filename)
-            uuids.append(b.uuid)
-        self.finish({"uuids" : uuids})
+        blobs = yield pool.submit(self.store_files, self.current_user, int(web_id), self.request.files["files"])
+        self.finish({"uuids" : [b.uuid for b in blobs]})
         channels.broadcast([channel.NewBlobMessage(b) for b in blobs])
 
+STREAMING_UPLOADS = hasattr(tornado.web, "stream_request_body") # Tornado 4
+
+class StreamUploadHandler(MVRequestHandler) :
+    """Takes the body of a PUT as the content of one new blob, with the filename in
+    the 'filename' argument and the XSRF token in the X-Xsrftoken header.  The body
+    is hashed and written to a filestore.SpillFile as it arrives, so memory use
+    doesn't depend on the size of the file.  (Without stream_request_body, Tornado
+    buffers the body and it is spilled all at once.)"""
+    def prepare(self) :
+        if self.current_user == None :
+            raise tornado.web.HTTPError(403)
+        UploadHandler.check_member(self.current_user, int(self.path_args[0]))
+        self.spill = filestore.SpillFile(models.FILE_STORE)
+
+    def data_received(self, chunk) :
+        self.spill.write(chunk)
+
+    @staticmethod
+    def store_spill_file(user, web_id, content_type, spill, filename) :
+        """Makes a blob for the spilled upload (run on a worker)."""
+        return UploadHandler.add_blob(user, web_id, content_type,
+                                      models.Content.get_by_spill_file(spill), filename)
+
+    @gen.coroutine
+    def put(self, web_id) :
+        if not STREAMING_UPLOADS :
+            self.data_received(self.request.body)
+        self.spill.close()
+        content_type = self.request.headers.get("Content-Type", "").split(";")[0].strip()
+        b = yield pool.submit(self.store_spill_file, self.current_user, int(web_id), content_type,
+                              self.spill, self.get_argument("filename", None))
+        self.finish({"uuids" : [b.uuid]})
+        channels.broadcast([channel.NewBlobMessage(b)])
+
+    def on_connection_close(self) :
+        if hasattr(self, "spill") and self.spill.hash == None : # the upload didn't finish
+            self.spill.discard()
+
+    def on_finish(self) :
+        if hasattr(self, "spill") :
+            self.spill.discard()
+
+if STREAMING_UPLOADS :
+    StreamUploadHandler = tornado.web.stream_request_body(StreamUploadHandler)
+
 class MVApplication(tornado.web.Application) :
     def __init__(self) :
         settings = dict(
@@ -252,11 +574,17 @@ class MVApplication(tornado.web.Application) :
             (r"/login/google", GoogleHandler),
             (r"/logout", LogoutHandler),
             (r"/upload/(\d+)", UploadHandler),
+            (r"/upload/(\d+)/stream", StreamUploadHandler),
             (r"/ajax/poll", PollHandler),
+            (r"/ajax/channel/(\d+)/socket", ChannelSocketHandler),
+            (r"/ajax/channel/(\d+)/events", ChannelEventsHandler),
+            (r"/ajax/rpc", BatchRpcHandler),
             (r"/ajax/rpc/(.*)", RpcHandler),
             (r"/blob/([0-9a-f]+)(/.*)?", BlobHandler),
             (r"/avatar/(.*)", AvatarHandler),
             (r"/test/push", PushHandler),
+            (r"/stats/channels", ChannelStatsHandler),
+            (r"/stats/caches", CacheStatsHandler),
             ]
         
         tornado.web.Application.__init__(self, handlers, **settings)
@@ -264,8 +592,24 @@ class MVApplication(tornado.web.Application) :
 if __name__=="__main__" :
     tornado.options.parse_command_line()
     logger.info("Starting metaview...")
-    application = MVApplication()
+    for name in tornado.options.options.backfill :
+        migrations.schedule(name)
+    application = MVApplication() # before forking, so the processes share the cookie secret
     portnum = tornado.options.options.port
-    application.listen(portnum)
+    sockets = tornado.netutil.bind_sockets(portnum)
+    task_id = None
+    if tornado.options.options.processes != 1 :
+        bus = tornado.options.options.bus or os.path.join(tempfile.gettempdir(), "metaview-bus-%d" % portnum)
+        channels.set_backplane(backplane.UnixSocketBackplane(bus))
+        models.DB.close()
+        task_id = tornado.process.fork_processes(tornado.options.options.processes)
+        models.db_connect(DB_FILE)
+    channels.start_backplane()
+    pool = workers.WorkerPool(tornado.options.options.workers)
+    if task_id in (None, 0) : # one process runs the backfills
+        migrations.BackfillRunner().start()
+    channels.start_reaper()
+    server = tornado.httpserver.HTTPServer(application)
+    server.add_sockets(sockets)
     logger.info("Listening on port %s", portnum)
     tornado.ioloop.IOLoop.instance().start()
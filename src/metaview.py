@@ -0,0 +1,201 @@
+# metaview.py
+# command-line import and export of webs
+#
+# usage: python2.7 src/metaview.py import --web=NAME [--editor=EMAIL] [--db=mv.db] PATH
+#        python2.7 src/metaview.py export --web=NAME [--db=mv.db] [FILE]
+#
+# import takes either a directory, each file of which becomes a blob
+# (as if it were uploaded by the editor, with its path as its filename),
+# or an archive written by export, which has one blob per line as JSON
+# (- is stdin).  Importing an archive keeps the uuids, dates and editors
+# of the blobs.  The web is made if it doesn't exist.  The content is
+# hashed by a pool of processes and the blobs are added --batch at a
+# time, each batch in one transaction.
+#
+# export writes every blob of the web, oldest first, to FILE (by default
+# stdout) from one snapshot of the db, a blob at a time.
+#
+# The server can keep running, but its pages won't hear about imported
+# blobs until they are reloaded, and it only sees a web made here once
+# its cached copies expire (see models.LRUCache).
+
+import sys
+import os
+import os.path
+import io
+import json
+import base64
+import itertools
+import mimetypes
+import multiprocessing
+import optparse
+
+import logging
+logger = logging.getLogger("metaview")
+
+import models
+import relations
+import filestore
+
+CHUNK_SIZE = 64 * 1024
+
+def load_content(f, store) :
+    """Reads the file object into a models.Content.  Content which is large enough
+    for the file store is hashed as it is read and written there rather than kept in
+    memory."""
+    stuff = f.read(models.Content.FILE_THRESHOLD)
+    if len(stuff) < models.Content.FILE_THRESHOLD :
+        return models.Content(hash=models.Content.make_hash_from_string(stuff), stuff=stuff)
+    spill = filestore.SpillFile(store)
+    try :
+        while stuff :
+            spill.write(stuff)
+            stuff = f.read(CHUNK_SIZE)
+        hash = spill.close()
+        store.put_file(hash, spill.filename)
+    finally :
+        spill.discard()
+    return models.Content(hash=hash, stored=True)
+
+def hash_file(args) :
+    """Loads a file of a directory being imported (in a worker process)."""
+    root, path, store_root = args
+    with open(os.path.join(root, path), "rb") as f :
+        return path, load_content(f, filestore.FileStore(store_root))
+
+def hash_record(args) :
+    """Loads a line of an archive being imported (in a worker process)."""
+    line, store_root = args
+    record = json.loads(line)
+    if "content_base64" in record :
+        stuff = base64.b64decode(record.pop("content_base64"))
+    else :
+        stuff = record.pop("content").encode("utf-8")
+    record["content"] = load_content(io.BytesIO(stuff), filestore.FileStore(store_root))
+    return record
+
+def walk_files(root) :
+    for dirpath, dirnames, filenames in os.walk(root) :
+        dirnames.sort()
+        for name in sorted(filenames) :
+            path = os.path.relpath(os.path.join(dirpath, name), root)
+            if os.path.isfile(os.path.join(root, path)) :
+                yield path.replace(os.sep, "/")
+
+def batches(iterable, size) :
+    iterable = iter(iterable)
+    while True :
+        batch = list(itertools.islice(iterable, size))
+        if not batch :
+            return
+        yield batch
+
+def import_directory(web, editor, root, pool, batch_size) :
+    store_root = models.FILE_STORE.root
+    loaded = pool.imap(hash_file, ((root, path, store_root) for path in walk_files(root)), 16)
+    count = 0
+    for batch in batches(loaded, batch_size) :
+        relations.make_blobs(web, editor,
+                             [{"content" : content,
+                               "content_type" : "mime:" + (mimetypes.guess_type(path)[0] or "plain/text"),
+                               "filename" : path}
+                              for path, content in batch])
+        count += len(batch)
+        logger.info("Imported %d files", count)
+    return count
+
+def import_archive(web, lines, pool, batch_size) :
+    store_root = models.FILE_STORE.root
+    loaded = pool.imap(hash_record, ((line, store_root) for line in lines if line.strip()), 16)
+    count = 0
+    for batch in batches(loaded, batch_size) :
+        relations.import_blobs(web, batch)
+        count += len(batch)
+        logger.info("Imported %d blobs", count)
+    return count
+
+def export_web(web, out) :
+    count = 0
+    with models.DB.snapshot() :
+        q = models.DB.execute("""
+        select b.uuid, b.date_created, b.editor_email, b.content_type, c.hash, c.stuff, c.stored
+        from blobs_web as bw
+        inner join blobs as b on b.id=bw.blob_id
+        inner join content as c on c.hash=b.content_hash
+        where bw.web_id=? order by bw.blob_id""", (web.id,))
+        for r in q :
+            content = models.Content(hash=r['hash'], stuff=r['stuff'], stored=bool(r['stored']))
+            with content.open() as f :
+                stuff = f.read()
+            record = {"uuid" : r['uuid'],
+                      "date_created" : r['date_created'],
+                      "editor_email" : r['editor_email'],
+                      "content_type" : r['content_type']}
+            try :
+                record["content"] = stuff.decode("utf-8")
+            except UnicodeDecodeError :
+                record["content_base64"] = base64.b64encode(stuff)
+            out.write(json.dumps(record) + "\n")
+            count += 1
+    logger.info("Exported %d blobs", count)
+    return count
+
+def get_web(name, editor=None, create=False) :
+    web = models.Web.get_by_name(name)
+    if web != None :
+        return web
+    if not create :
+        raise SystemExit("No such web %r" % name)
+    web = models.Web(name=name, public=False)
+    models.Web.update(web)
+    if editor != None :
+        models.UserWebAccess.add_for_user(web, editor)
+    logger.info("Made the web %r", name)
+    return web
+
+def main(argv) :
+    parser = optparse.OptionParser(usage="%prog import|export --web=NAME [options] [PATH]")
+    parser.add_option("--db", default="mv.db")
+    parser.add_option("--web", help="the name of the web")
+    parser.add_option("--editor", help="the email of the user who imports a directory")
+    parser.add_option("--batch", type="int", default=1000, help="blobs per transaction")
+    parser.add_option("--processes", type="int", default=multiprocessing.cpu_count(),
+                      help="processes which hash the content")
+    options, args = parser.parse_args(argv)
+    if len(args) not in (1, 2) or args[0] not in ("import", "export") or not options.web :
+        parser.error("expecting import or export, --web, and a path")
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    command, path = args[0], (args[1] if len(args) == 2 else "-")
+    if command == "export" :
+        models.db_connect(options.db)
+        web = get_web(options.web)
+        if path == "-" :
+            export_web(web, sys.stdout)
+        else :
+            with open(path, "wb") as out :
+                export_web(web, out)
+        return
+    pool = multiprocessing.Pool(options.processes) # before connecting, so the workers have no connections
+    try :
+        models.db_connect(options.db)
+        editor = None
+        if options.editor :
+            editor = models.User.get_by_email(options.editor)
+            if editor == None :
+                raise SystemExit("No such user %r" % options.editor)
+        web = get_web(options.web, editor, create=True)
+        if os.path.isdir(path) :
+            if editor == None :
+                parser.error("importing a directory needs --editor")
+            import_directory(web, editor, path, pool, options.batch)
+        elif path == "-" :
+            import_archive(web, sys.stdin, pool, options.batch)
+        else :
+            with open(path, "rb") as lines :
+                import_archive(web, lines, pool, options.batch)
+    finally :
+        pool.close()
+        pool.join()
+
+if __name__ == "__main__" :
+    main(sys.argv[1:])
@@ -6,9 +6,12 @@ from minirpc import rpcmethod, RPCServable
 from rpcmodules import rpc_module
 import relations
 from tornado import httputil
+import sqlite3
 
 import models
 import channel
+import authorization
+from authorization import requires, READ, MEMBER
 
 @rpc_module("webs")
 class WebsRPC(RPCServable) :
@@ -18,56 +21,58 @@ class WebsRPC(RPCServable) :
     @rpcmethod
     def create_web(self, user, webname) :
         webname = str(webname).strip()
-        if not webname or webname in [w.name for w in models.Web.get_all()] :
+        if not webname :
             return None
         web = models.Web(name=webname, public=False)
-        models.Web.update(web)
+        try :
+            models.Web.update(web)
+        except sqlite3.IntegrityError :
+            return None # there is already a web with the name
         models.UserWebAccess.add_for_user(web, user)
         self.channels.broadcast([channel.WebChangeMessage(web.id, web.name, web.public)])
         return web.id
     @rpcmethod
+    @requires(MEMBER, web="id")
     def rename_web(self, user, id, newwebname) :
         newwebname = str(newwebname).strip()
-        if not newwebname or newwebname in [w.name for w in models.Web.get_all()] :
+        if not newwebname :
             return None
         web = models.Web.get_by_id(id)
-        if not web or user.id not in [u.id for u in models.UserWebAccess.users_for_web(id)] :
-            raise Exception("no such web") # makes sure has explicit access
-        web.name = newwebname
-        models.Web.update(web)
-        self.channels.broadcast([channel.WebChangeMessage(web.id, web.name, web.public)])
-        return web.id
+        renamed = models.Web(id=web.id, name=newwebname, public=web.public) # web is shared (see models.CACHES)
+        try :
+            models.Web.update(renamed)
+        except sqlite3.IntegrityError :
+            return None # there is already a web with the name
+        self.channels.broadcast([channel.WebChangeMessage(renamed.id, renamed.name, renamed.public)])
+        return renamed.id
     @rpcmethod
+    @requires(MEMBER, web="id")
     def set_public(self, user, id, isPublic) :
         web = models.Web.get_by_id(id)
-        if not web or user.id not in [u.id for u in models.UserWebAccess.users_for_web(id)] :
-            raise Exception("no such web") # makes sure has explicit access
-        wasPublic = web.public
-        web.public = bool(isPublic)
-        models.Web.update(web)
-        self.channels.broadcast([channel.WebChangeMessage(web.id, web.name, web.public, was_public=wasPublic)])
+        changed = models.Web(id=web.id, name=web.name, public=bool(isPublic))
+        models.Web.update(changed)
+        self.channels.broadcast([channel.WebChangeMessage(changed.id, changed.name, changed.public, was_public=web.public)])
         return
     @rpcmethod
+    @models.read_only
     def get_webs(self, user) :
         return {w.id : {'name' : w.name, 'isPublic' : w.public}
                 for w in models.UserWebAccess.get_for_user(user)}
     @rpcmethod
+    @models.read_only
+    @requires(READ, web="id")
     def get_web_users(self, user, id) :
-        if not models.UserWebAccess.can_user_access(user, id) :
-            raise Exception("no such web") # public is ok
         return [u.email for u in models.UserWebAccess.users_for_web(id)]
     @rpcmethod
+    @requires(MEMBER, web="id")
     def delete_web(self, user, id) :
         web = models.Web.get_by_id(id)
-        if not web or id not in [w.id for w in models.UserWebAccess.get_for_user(user)] :
-            raise Exception("no such web") # makes sure has explicit access
         if models.WebBlobAccess.does_web_have_blobs(web) :
             return False
         for user in models.UserWebAccess.users_for_web(web) :
             models.UserWebAccess.remove_for_user(web, user)
-        old_id = web.id
-        web.remove()
-        self.channels.broadcast([channel.WebChangeMessage(old_id, None, web.public)])
+        models.Web.remove(web.id)
+        self.channels.broadcast([channel.WebChangeMessage(web.id, None, web.public)])
         return True
     @rpcmethod
     def set_default_web(self, user, web_id) :
@@ -85,6 +90,7 @@ class UsersRPC(RPCServable) :
                 "last_name" : user.last_name,
                 "avatar" : None}
     @rpcmethod
+    @models.read_only
     def get_users(self, user) :
         users = models.User.get_all()
         return [self.user_as_dict(u) for u in users]
@@ -96,79 +102,89 @@ class BlobsRPC(RPCServable) :
         self.channels = channels
     def blob_as_dict(self, blob, with_content=False) :
         ret = {"uuid" : blob.uuid,
-               "date_created" : httputil.format_timestamp(blob.date_created),
+               "date_created" : httputil.format_timestamp(blob.created_seconds),
                "editor_email" : blob.editor_email,
-               "content_type" : blob.content_type}
-        if blob.content_type.startswith("mime:text/") :
+               "content_type" : blob.content_type,
+               "length" : blob.length}
+        if blob.is_text :
             ret["summary"] = self.blob_summary(blob)
+            ret["line_count"] = blob.line_count
         if with_content :
             ret["content"] = blob.content.stuff
         return ret
     def blob_summary(self, blob) :
-        content = blob.content.stuff
-        summary = content[:min(len(content), 160)]
-        return " ".join(summary.split())
+        """The summary is kept with the blob, but blobs from before that which the
+        'blob_summaries' backfill hasn't reached yet are summarized here."""
+        if blob.summary == None :
+            blob.summary = blob.content.summarize()[0]
+        return blob.summary
     def rel_as_dict(self, rel) :
         return {"uuid" : None if rel.uuid.startswith("pseudo:") else rel.uuid,
-                "date_created" : httputil.format_timestamp(rel.date_created),
+                "date_created" : httputil.format_timestamp(rel.created_seconds),
                 "deleted" : getattr(rel, "deleted", None),
                 "name" : rel.name,
                 "subject" : rel.subject_uuid,
                 "object" : rel.object_uuid,
                 "payload" : rel.payload}
     @rpcmethod
+    @models.read_only
+    @requires(READ)
     def get_blob_metadata(self, user, web_id, uuids) :
-        if web_id not in [w.id for w in models.UserWebAccess.get_for_user(user)] :
-            raise Exception("no such web") # makes sure has explicit access
+        # fetch everything for the whole set at once rather than per uuid
+        found = models.Blob.get_by_uuids(set(uuids))
+        srels = relations.get_inherited_relations_for(web_id, found.keys())
+        orels = relations.CachedRelation.get_for_objects(web_id, found.keys())
         blobs = []
-        for uuid in set(uuids) :
-            b = models.Blob.get_by_uuid(uuid)
-            if b != None :
-                srels = relations.get_inherited_relations(web_id, uuid)
-                orels = relations.CachedRelation.get_for_object(web_id, uuid)
-                blobs.append({"blob" : self.blob_as_dict(b),
-                              "srels" : [self.rel_as_dict(r) for r in srels],
-                              "orels" : [self.rel_as_dict(r) for r in orels]})
+        for uuid, b in found.iteritems() :
+            blobs.append({"blob" : self.blob_as_dict(b),
+                          "srels" : [self.rel_as_dict(r) for r in srels.get(uuid, [])],
+                          "orels" : [self.rel_as_dict(r) for r in orels.get(uuid, [])]})
         return blobs
+    LIST_LIMIT = 200
+    @rpcmethod("list")
+    @models.read_only
+    @requires(READ)
+    def list_blobs(self, user, web_id, cursor=None, limit=50, content_type=None, editor=None, tag=None, deleted=False) :
+        """Lists the blobs of the web a page at a time, newest first.  Gets the blobs
+        (as by blob_as_dict) and the cursor for the next page, which is None after the
+        last page.  The filters are a prefix of the content type (for instance
+        "mime:image/"), the editor's email, a tag, and whether the blobs are deleted
+        (None for both)."""
+        limit = min(self.LIST_LIMIT, max(1, int(limit)))
+        before = None
+        if cursor :
+            date_created, blob_id = cursor.split(".")
+            before = (int(date_created), int(blob_id))
+        blobs = models.WebBlobAccess.list_blobs(web_id, before, limit + 1, content_type, editor, tag, deleted)
+        next_cursor = None
+        if len(blobs) > limit :
+            blobs = blobs[:limit]
+            last = blobs[-1]
+            next_cursor = "%d.%d" % (last.created_seconds, last.id)
+        return {"blobs" : [self.blob_as_dict(b) for b in blobs],
+                "next" : next_cursor}
     @rpcmethod
     def create_blob(self, user, web_id, content, mime_type=None, title=None, tags=[], revises=[]) :
-        if web_id not in [w.id for w in models.UserWebAccess.get_for_user(user)] :
-            raise Exception("no such web") # makes sure has explicit access
+        return self.create_blobs(user, web_id, [{"content" : content, "mime_type" : mime_type,
+                                                 "title" : title, "tags" : tags, "revises" : revises}])[0]
+    @rpcmethod
+    @requires(MEMBER)
+    def create_blobs(self, user, web_id, blobs) :
+        """Creates many blobs at once, each given by a dictionary of the arguments of
+        create_blob (but user and web_id), in one transaction.  Returns their uuids."""
         web = models.Web.get_by_id(web_id)
-        content_type = "mime:" + (mime_type or "plain/text")
-        c = models.Content.get_by_stuff(str(content))
-        b = models.Blob.make_blob(user, content_type, c)
-        models.WebBlobAccess.add_for_blob(web, b)
-        for puuid in revises :
-            parent_blob = models.Blob.get_by_uuid(puuid)
-            if parent_blob :
-                relations.BinaryRelation.make(web, user, "revises", b, parent_blob)
-        # we don't want to just add tags and title; we want to ensure their presence
-        inherited = relations.get_inherited_relations(web, b)
-        if title :
-            inherited_title = [r for r in inherited if not r.deleted and r.name == "title"]
-            for r in inherited_title :
-                if r.payload != title :
-                    relations.BinaryRelation.make(web, user, "deletes", b, r.blob)
-                    print "deleting",r
-            if not any(r.payload == title for r in inherited_title) :
-                relations.BinaryRelation.make(web, user, "title", b, title)
-                print "adding"
-        tags = set([t.strip() for t in tags if t.strip()])
-        inherited_tags = [r for r in inherited if not r.deleted and r.name == "tag"]
-        inherited_tags_payloads = set(r.payload for r in inherited_tags)
-        for r in inherited_tags :
-            if r.payload not in tags :
-                relations.BinaryRelation.make(web, user, "deletes", b, r.blob)
-        for tag in tags :
-            if tag not in inherited_tags_payloads :
-                relations.BinaryRelation.make(web, user, "tag", b, tag)
-        self.channels.broadcast([channel.NewBlobMessage(b)])
-        return b.uuid
+        specs = [{"content" : b["content"],
+                  "content_type" : "mime:" + (b.get("mime_type") or "plain/text"),
+                  "title" : b.get("title"),
+                  "tags" : b.get("tags", []),
+                  "revises" : b.get("revises", [])}
+                 for b in blobs]
+        made = relations.make_blobs(web, user, specs)
+        self.channels.broadcast([channel.NewBlobMessage(b) for b in made])
+        return [b.uuid for b in made]
     @rpcmethod
+    @requires(MEMBER)
     def remove_tag(self, user, web_id, uuid, tag) :
-        if web_id not in [w.id for w in models.UserWebAccess.get_for_user(user)] :
-            raise Exception("no such web") # makes sure has explicit access
         web = models.Web.get_by_id(web_id)
         b = models.Blob.get_by_uuid(uuid)
         inherited = relations.get_inherited_relations(web_id, b)
@@ -178,9 +194,8 @@ class BlobsRPC(RPCServable) :
                 relations.BinaryRelation.make(web, user, "deletes", b, r.blob)
         return True
     @rpcmethod
+    @requires(MEMBER)
     def add_tag(self, user, web_id, uuid, tag) :
-        if web_id not in [w.id for w in models.UserWebAccess.get_for_user(user)] :
-            raise Exception("no such web") # makes sure has explicit access
         tag = tag.strip()
         if not tag : return False
         web = models.Web.get_by_id(web_id)
@@ -193,9 +208,8 @@ class BlobsRPC(RPCServable) :
         relations.BinaryRelation.make(web, user, "tag", b, tag)
         return True
     @rpcmethod
+    @requires(MEMBER)
     def delete(self, user, web_id, deletor, deleted) :
-        if web_id not in [w.id for w in models.UserWebAccess.get_for_user(user)] :
-            raise Exception("no such web") # makes sure has explicit access
         web = models.Web.get_by_id(web_id)
         b1 = models.Blob.get_by_uuid(deletor)
         b2 = models.Blob.get_by_uuid(deleted)
@@ -0,0 +1,117 @@
+# migrations.py
+# versioned schema migrations and resumable data backfills
+
+import os
+import os.path
+import time
+import sqlite3
+
+from tornado.ioloop import IOLoop
+
+import logging
+logger = logging.getLogger(__name__)
+
+import models
+
+SQL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql")
+MIGRATIONS_DIR = os.path.join(SQL_DIR, "migrations")
+
+def create(dbfile) :
+    """Creates a new database file from createdb.sql."""
+    logger.info("Creating database %s", dbfile)
+    db = sqlite3.connect(dbfile)
+    with open(os.path.join(SQL_DIR, "createdb.sql")) as f :
+        db.executescript(f.read())
+    db.close()
+
+def schema_version() :
+    return models.DB.execute("pragma user_version").fetchone()[0]
+
+def get_migrations() :
+    """Gets the list of (number, filename) for the scripts in sql/migrations.  Each
+    script is named NNN_description.sql and brings the schema from version NNN-1 to
+    version NNN."""
+    migrations = []
+    for name in os.listdir(MIGRATIONS_DIR) :
+        if name.endswith(".sql") :
+            migrations.append((int(name.split("_", 1)[0]), name))
+    return sorted(migrations)
+
+def migrate() :
+    """Brings the schema up to date by running each script in sql/migrations whose
+    number is greater than the user_version of the db.  createdb.sql sets
+    user_version to the number of the last migration it already includes.  Schema
+    changes should be quick; anything which touches every row belongs in a
+    backfill, which a migration can start with
+
+      insert into backfills (name, finished) values ('some_backfill', 0);"""
+    version = schema_version()
+    for number, name in get_migrations() :
+        if number > version :
+            logger.info("Migrating schema to version %s (%s)", number, name)
+            with open(os.path.join(MIGRATIONS_DIR, name)) as f :
+                models.DB.executescript(f.read() + "\npragma user_version = %d;" % number)
+
+BACKFILLS = {}
+def backfill(name) :
+    """Registers a backfill under the name.  The function takes the position to start
+    from (None the first time) and the chunk size, does a chunk of work, and returns
+    the position of the next chunk or None when there is nothing left.  A chunk may
+    be run again if the server stops before its position is recorded, so it must be
+    idempotent."""
+    def _backfill(f) :
+        BACKFILLS[name] = f
+        return f
+    return _backfill
+
+def schedule(name) :
+    """Starts (or restarts) the named backfill from the beginning."""
+    if name not in BACKFILLS :
+        raise KeyError(name)
+    with models.DB :
+        models.DB.execute("insert into backfills (name, position, finished) values (?,null,0)", (name,))
+
+def pending() :
+    """Gets the list of (name, position) for the unfinished backfills."""
+    return [(r['name'], r['position'])
+            for r in models.DB.execute("select name, position from backfills where not finished order by rowid")]
+
+def run_chunk(name, position, chunk_size) :
+    """Runs one chunk of the backfill and records where the next one starts.
+    Returns that position, which is None when the backfill has finished."""
+    position = BACKFILLS[name](position, chunk_size)
+    with models.DB :
+        models.DB.execute("update backfills set position=?, finished=? where name=?",
+                          (position, int(position == None), name))
+    return position
+
+def run_all(chunk_size=500) :
+    """Runs the pending backfills to completion without yielding (for use when the
+    server is not running)."""
+    for name, position in pending() :
+        position = run_chunk(name, position, chunk_size)
+        while position != None :
+            position = run_chunk(name, position, chunk_size)
+
+class BackfillRunner(object) :
+    """Runs the pending backfills a chunk at a time on the IOLoop, pausing between
+    chunks so that requests are still handled.  Since the position is stored after
+    each chunk, a backfill resumes where it left off when the server restarts."""
+    def __init__(self, chunk_size=500, pause=0.05) :
+        self.chunk_size = chunk_size
+        self.pause = pause
+    def start(self) :
+        IOLoop.instance().add_callback(self.step)
+    def step(self) :
+        for name, position in pending() :
+            if name not in BACKFILLS :
+                logger.error("No such backfill %s", name)
+                continue
+            try :
+                if run_chunk(name, position, self.chunk_size) == None :
+                    logger.info("Finished backfill %s", name)
+            except Exception :
+                logger.exception("Backfill %s failed at position %r", name, position)
+                return
+            IOLoop.instance().add_timeout(time.time() + self.pause, self.step)
+            return
@@ -3,6 +3,8 @@
 
 import types
 
+from tornado.concurrent import Future, TracebackFuture
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -26,7 +28,11 @@ class RPCServerMetaclass(type) :
 class RPCServable(object) :
     __metaclass__ = RPCServerMetaclass
 
-def handle_request(servable, getMessage) :
+def handle_request(servable, getMessage, caller=None) :
+    """Handles one rpc message.  The caller (by default the servable's
+    __around_rpc__) is given a thunk for the method call.  If it returns a Future
+    (for instance, by running the thunk on a workers.WorkerPool), then so does
+    handle_request."""
     ident = None
     method = None
     args = None
@@ -47,15 +53,50 @@ def handle_request(servable, getMessage) :
             kwargs = message.get("kwargs", {})
             #logger.debug("Handling %s", report_method(method, args, kwargs))
             logger.debug("  id=%r" % ident if ident else "")
-            caller = getattr(servable, "__around_rpc__", lambda f : f())
+            caller = caller or getattr(servable, "__around_rpc__", lambda f : f())
             forResult = lambda : servable.__rpc__[method](servable, *args, **kwargs)
             result = caller(forResult)
+            if isinstance(result, Future) :
+                return render_future(result, ident)
         return {"id" : ident,
                 "result" : result}
     except Exception as x :
         logger.exception("Exception handling rpc call")
         return render_exception(x, ident=ident)
 
+def handle_batch(servables, messages) :
+    """Handles a list of rpc messages, each of which also has a 'module' naming its
+    servable in the dict servables.  The methods are called in order on the current
+    thread, so the caller can run the whole batch in one transaction.  Since the
+    batch is for reading, only methods marked read_only (see models.read_only) may be
+    in it.  Returns a dict from each message's id to its response."""
+    responses = {}
+    for message in messages :
+        ident = message.get("id", None)
+        try :
+            servable = servables[message["module"]]
+            if not getattr(servable.__rpc__[message["method"]], "read_only", False) :
+                raise ValueError("Not a read-only method", message["method"])
+        except Exception as x :
+            responses[ident] = render_exception(x, ident=ident)
+            continue
+        responses[ident] = handle_request(servable, lambda : message,
+                                          caller=lambda f : f())
+    return responses
+
+def render_future(future, ident) :
+    """Gets a future for the response to a call whose result is the future."""
+    response = TracebackFuture()
+    def on_done(future) :
+        try :
+            response.set_result({"id" : ident,
+                                 "result" : future.result()})
+        except Exception as x :
+            logger.exception("Exception handling rpc call")
+            response.set_result(render_exception(x, ident=ident))
+    future.add_done_callback(on_done)
+    return response
+
 def report_method(method, args, kwargs) :
     return "%s(%s)" % (method, ", ".join([repr(a) for a in args]
                                          + ["%s=%r" % (k, v)
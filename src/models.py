@@ -4,22 +4,345 @@ import hashlib
 import time
 import datetime
 import uuid
+import threading
+import functools
+import contextlib
+import Queue
+import io
+import re
+import collections
+import calendar
+
+import logging
+logger = logging.getLogger(__name__)
 
 DB = None
+FILE_STORE = None
 
-def db_connect(dbfile) :
-    """Connects to the db.  Sets the global DB variable because there should be only
-    one connection to the db at a time anyway."""
-    global DB
+def db_connect(dbfile, readers=4, file_store=None) :
+    """Connects to the db, creating it if necessary, and brings its schema up to
+    date.  Sets the global DB variable because there should be only one connection
+    manager for the db at a time anyway.  Large content goes in FILE_STORE, which
+    is the directory file_store (by default next to the db; see filestore.py)."""
+    global DB, FILE_STORE
+    import migrations
+    import filestore
     if not os.path.isfile(dbfile) :
-        raise TypeError("The database file must be created first.")
-    DB = sqlite3.connect(dbfile)
-    DB.executescript("""
-        pragma foreign_keys = ON;
-    """)
-    DB.row_factory = sqlite3.Row
+        migrations.create(dbfile)
+    DB = Database(dbfile, readers)
+    FILE_STORE = filestore.FileStore(file_store or os.path.splitext(dbfile)[0] + "-files")
+    for cache in CACHES.itervalues() :
+        cache.clear()
+    migrations.migrate()
+
+PRAGMAS = """
+    pragma foreign_keys = ON;
+    pragma synchronous = NORMAL; -- durable enough with a write-ahead log
+    pragma cache_size = -16384; -- in KiB
+    pragma mmap_size = 268435456;
+    pragma temp_store = MEMORY;
+"""
+
+_WRITE_ACTIONS = set([sqlite3.SQLITE_INSERT, sqlite3.SQLITE_UPDATE, sqlite3.SQLITE_DELETE,
+                      sqlite3.SQLITE_CREATE_TABLE, sqlite3.SQLITE_CREATE_INDEX,
+                      sqlite3.SQLITE_DROP_TABLE, sqlite3.SQLITE_DROP_INDEX,
+                      sqlite3.SQLITE_ALTER_TABLE])
+
+def _read_only_authorizer(action, arg1, arg2, dbname, source) :
+    """Keeps readers from writing anything but temporary tables."""
+    if action == sqlite3.SQLITE_UPDATE and arg1 == "sqlite_master" :
+        return sqlite3.SQLITE_OK # asked when a virtual table (search_index) is connected
+    if action in _WRITE_ACTIONS and dbname != "temp" :
+        return sqlite3.SQLITE_DENY
+    return sqlite3.SQLITE_OK
+
+def _content_prefix(hash, stored, stuff, length) :
+    """The sql function content_prefix(hash, stored, stuff, length), which is the first
+    length characters of a row of the content table as text, reading them from
+    FILE_STORE if the content is stored there."""
+    if stored :
+        with FILE_STORE.open(hash) as f :
+            stuff = f.read(length)
+    elif isinstance(stuff, unicode) :
+        return stuff[:length]
+    else :
+        stuff = str(stuff)[:length]
+    return stuff.decode("utf-8", "ignore")
+
+class Database(object) :
+    """The connection manager behind DB.  The database is in write-ahead-log mode.
+    Each thread (the IOLoop thread and each worker in workers.WorkerPool) gets its
+    own read-write connection, and write transactions on them are serialized by a
+    lock.  There is also a pool of reader connections, so that readers don't block
+    behind the writer.
+
+    DB.execute and 'with DB' (a transaction) use the connection bound to the
+    current thread, which is the thread's own connection unless the thread is
+    inside reading().  Code which must write from inside reading() uses
+    writing()."""
+    def __init__(self, dbfile, readers=4) :
+        self.dbfile = dbfile
+        self.write_lock = threading.RLock()
+        self.local = threading.local()
+        self.own_connection().execute("pragma journal_mode = WAL")
+        self.readers = Queue.Queue()
+        self.reader_connections = set()
+        for i in xrange(readers) :
+            conn = self.connect(read_only=True)
+            self.reader_connections.add(conn)
+            self.readers.put(conn)
+    def connect(self, read_only=False) :
+        db = sqlite3.connect(self.dbfile, timeout=30, check_same_thread=False)
+        db.executescript(PRAGMAS)
+        db.row_factory = sqlite3.Row
+        db.create_function("content_prefix", 4, _content_prefix)
+        if read_only :
+            db.set_authorizer(_read_only_authorizer)
+        return db
+    def own_connection(self) :
+        """Gets the read-write connection of the current thread."""
+        if not hasattr(self.local, "own") :
+            self.local.own = self.connect()
+            self.local.bound = []
+            self.local.entered = []
+            self.local.snapshots = []
+            self.local.after_snapshot = []
+        return self.local.own
+    def close(self) :
+        """Closes the connection of the current thread and the readers.  This is for
+        before forking, since a connection can't be shared between processes; the
+        Database can't be used afterwards."""
+        if hasattr(self.local, "own") :
+            self.local.own.close()
+            del self.local.own
+        for conn in self.reader_connections :
+            conn.close()
+        self.reader_connections.clear()
+    def connection(self) :
+        own = self.own_connection()
+        return self.local.bound[-1] if self.local.bound else own
+    def execute(self, sql, params=()) :
+        return self.connection().execute(sql, params)
+    def execute_tuples(self, sql, params=()) :
+        """Like execute, but the rows are plain tuples rather than sqlite3.Row, which
+        are cheaper to make, for code which unpacks many rows by position."""
+        c = self.connection().cursor()
+        c.row_factory = None
+        return c.execute(sql, params)
+    def executemany(self, sql, seq) :
+        return self.connection().executemany(sql, seq)
+    def executescript(self, script) :
+        with self.writing() :
+            return self.connection().executescript(script)
+    def commit(self) :
+        self.connection().commit()
+    def __enter__(self) :
+        conn = self.connection()
+        if conn in self.local.snapshots :
+            # a savepoint, since committing would end the snapshot
+            self.local.entered.append(conn)
+            conn.execute("savepoint nested")
+            return conn
+        if conn not in self.reader_connections :
+            self.write_lock.acquire()
+        self.local.entered.append(conn)
+        return conn.__enter__()
+    def __exit__(self, *exc_info) :
+        conn = self.local.entered.pop()
+        if conn in self.local.snapshots :
+            if exc_info[0] != None :
+                conn.execute("rollback to nested")
+            conn.execute("release nested")
+            return False
+        try :
+            return conn.__exit__(*exc_info)
+        finally :
+            if conn not in self.reader_connections :
+                self.write_lock.release()
+    @contextlib.contextmanager
+    def reading(self) :
+        """Runs the block on a connection from the reader pool (or on the connection
+        the thread already has, if it is already reading)."""
+        if self.connection() in self.reader_connections :
+            yield
+            return
+        conn = self.readers.get()
+        self.local.bound.append(conn)
+        try :
+            yield
+        finally :
+            self.local.bound.pop()
+            self.readers.put(conn)
+    @contextlib.contextmanager
+    def snapshot(self) :
+        """Like reading(), but the block runs inside one read transaction, so that all
+        of its queries see the same version of the database (for instance, the calls
+        of a batched rpc request)."""
+        with self.reading() :
+            conn = self.connection()
+            if conn in self.local.snapshots :
+                yield
+                return
+            # sqlite3 would otherwise commit before statements like 'create temp table'
+            conn.isolation_level = None
+            conn.execute("begin")
+            self.local.snapshots.append(conn)
+            try :
+                yield
+            finally :
+                self.local.snapshots.pop()
+                conn.execute("commit") # there are only temporary tables to keep
+                conn.isolation_level = ""
+                deferred, self.local.after_snapshot = self.local.after_snapshot, []
+                for f in deferred :
+                    try :
+                        f()
+                    except Exception :
+                        logger.exception("Could not run %r after a snapshot", f)
+    def after_snapshot(self, f) :
+        """Calls f when the current thread's snapshot() ends, or now if it isn't in
+        one.  This is for writes (such as filling in a cache) which needn't be seen
+        by the snapshot, since a snapshot can't see what is written during it
+        anyway."""
+        self.own_connection()
+        if self.local.snapshots :
+            self.local.after_snapshot.append(f)
+        else :
+            f()
+    def in_transaction(self) :
+        """Whether the current thread is inside 'with DB', writing() or snapshot(),
+        where what it reads might not be committed (or might be out of date)."""
+        own = self.own_connection()
+        return bool(self.local.entered or self.local.snapshots or own in self.local.bound)
+    @contextlib.contextmanager
+    def writing(self) :
+        """Runs the block as a transaction on the thread's own connection."""
+        conn = self.own_connection()
+        with self.write_lock :
+            self.local.bound.append(conn)
+            try :
+                with conn :
+                    yield
+            finally :
+                self.local.bound.pop()
+
+def read_only(f) :
+    """Decorates a function (such as an rpc method) which only reads, so that it runs
+    on a connection from the reader pool.  It is marked read_only, which lets it be
+    part of a batched rpc request (see minirpc.handle_batch)."""
+    @functools.wraps(f)
+    def _read_only(*args, **kwargs) :
+        with DB.reading() :
+            return f(*args, **kwargs)
+    _read_only.read_only = True
+    return _read_only
+
+def load_temp_keys(table, keys) :
+    """Fills the temporary table (which has a single 'key' column) with the keys so
+    that bulk queries can join against it instead of running a query per key.  The
+    temporary table has no statistics, so such queries should use a cross join to
+    make it the outer loop."""
+    with DB :
+        DB.execute("create temp table if not exists %s (key primary key)" % table)
+        DB.execute("delete from temp.%s" % table)
+        DB.executemany("insert or ignore into temp.%s (key) values (?)" % table, ((k,) for k in keys))
+
+class LRUCache(object) :
+    """An identity map of at most size entries, which forgets the least recently
+    used.  The model methods which change what an entry was loaded from invalidate
+    it, and entries also expire after ttl seconds, since other programs (such as
+    metaview.py) can change the db too.  A value loaded inside a transaction, or
+    while something was being invalidated, isn't kept, since it might not be what is
+    committed.  Shared by all threads."""
+    def __init__(self, size=1000, ttl=300) :
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict() # key -> (value, expiry), least recent first
+        self.lock = threading.Lock()
+        self.generation = 0 # bumped by each invalidation
+        self.hits = 0
+        self.misses = 0
+    def get(self, key, load) :
+        """Gets the value for the key, calling load() to get it from the db if it
+        isn't here.  None is never kept."""
+        with self.lock :
+            entry = self.entries.pop(key, None)
+            if entry != None and entry[1] > time.time() :
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self.generation
+        value = load()
+        if value != None and not DB.in_transaction() :
+            with self.lock :
+                if generation == self.generation :
+                    self.entries[key] = (value, time.time() + self.ttl)
+                    if len(self.entries) > self.size :
+                        self.entries.popitem(last=False)
+        return value
+    def peek(self, key) :
+        """Gets the value for the key if it is here, or else None (without loading
+        it)."""
+        with self.lock :
+            entry = self.entries.pop(key, None)
+            if entry != None and entry[1] > time.time() :
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+    def invalidate(self, key) :
+        with self.lock :
+            self.generation += 1
+            self.entries.pop(key, None)
+    def invalidate_if(self, test) :
+        """Drops the entries for which test(key, value) is true."""
+        with self.lock :
+            self.generation += 1
+            for key, (value, expiry) in self.entries.items() :
+                if test(key, value) :
+                    del self.entries[key]
+    def clear(self) :
+        with self.lock :
+            self.generation += 1
+            self.entries.clear()
+    def stats(self) :
+        return {"size" : len(self.entries), "hits" : self.hits, "misses" : self.misses}
+
+# Users by ("id", id) and ("email", email), Webs by id, and the frozenset of the
+# ids of the webs each user can access by user id.  The objects are shared, so
+# they shouldn't be changed except to be passed to update.
+CACHES = {"users" : LRUCache(),
+          "webs" : LRUCache(),
+          "access" : LRUCache()}
+
+def cache_stats() :
+    return dict((name, cache.stats()) for name, cache in CACHES.iteritems())
+
+def timestamp_properties(slot) :
+    """Makes the date_created and created_seconds properties of a class which keeps
+    when it was made in the slot, either as a datetime or as the seconds since the
+    epoch as they come from the db.  Seconds are only made into a datetime when
+    date_created is read (formatting it, with httputil.format_timestamp, can use
+    created_seconds instead)."""
+    def get_datetime(self) :
+        t = getattr(self, slot)
+        if t != None and not isinstance(t, datetime.datetime) :
+            t = datetime.datetime.utcfromtimestamp(t)
+            setattr(self, slot, t)
+        return t
+    def set_datetime(self, t) :
+        setattr(self, slot, t)
+    def get_seconds(self) :
+        t = getattr(self, slot)
+        if isinstance(t, datetime.datetime) :
+            return calendar.timegm(t.utctimetuple())
+        return t
+    return property(get_datetime, set_datetime), property(get_seconds)
 
 class Web(object) :
+    __slots__ = ("id", "name", "public")
     def __init__(self, id=None, name=None, public=None) :
         self.id = id
         self.name = name
@@ -27,58 +350,104 @@ class Web(object) :
     def __repr__(self) :
         return "Web(id=%r, name=%r, public=%r)" % (self.id, self.name, bool(self.public))
     @staticmethod
+    def from_row(row) :
+        return Web(id=row['id'], name=row['web_name'], public=bool(row['public']))
+    @staticmethod
     def update(web) :
-        with DB :
-            if web.id == None :
-                c = DB.execute("insert into webs (web_name, public) values (?,?)", (web.name, web.public))
-                web.id = c.lastrowid
-            else :
-                print "**", (web.name, web.public, web.id)
-                DB.execute("update webs set web_name=?, public=? where id=?", (web.name, web.public, web.id))
+        try :
+            with DB :
+                if web.id == None :
+                    c = DB.execute("insert into webs (web_name, public) values (?,?)", (web.name, web.public))
+                    web.id = c.lastrowid
+                else :
+                    print "**", (web.name, web.public, web.id)
+                    DB.execute("update webs set web_name=?, public=? where id=?", (web.name, web.public, web.id))
+        finally :
+            Web.invalidate(web.id)
+    @staticmethod
+    def invalidate(id) :
+        """Forgets the cached web and who can access webs (which a web being made
+        public or private changes)."""
+        CACHES["webs"].invalidate(id)
+        CACHES["access"].clear()
     @staticmethod
     def get_all() :
-        return [Web(id=row['id'], name=row['web_name'], public=row['public'])
-                for row in DB.execute("select id, web_name, public from webs")]
+        return [Web.from_row(row) for row in DB.execute("select id, web_name, public from webs")]
     @staticmethod
     def get_by_id(id) :
-        for row in DB.execute("select id, web_name, public from webs where id=?", (id,)) :
-            return Web(id=row['id'], name=row['web_name'], public=row['public'])
+        def load() :
+            for row in DB.execute("select id, web_name, public from webs where id=?", (id,)) :
+                return Web.from_row(row)
+            return None
+        return CACHES["webs"].get(id, load)
+    @staticmethod
+    def get_by_name(name) :
+        for row in DB.execute("select id, web_name, public from webs where web_name=?", (name,)) :
+            return Web.from_row(row)
         return None
-    def remove(self) :
-        """Will fail because of foreign keys."""
-        with DB :
-            DB.execute("delete from webs where web_name=?", (self.name,))
-        self.id = None
+    @staticmethod
+    def remove(id) :
+        """Will fail because of foreign keys.  Takes the id rather than a Web since
+        the cached Web is shared."""
+        try :
+            with DB :
+                DB.execute("delete from webs where id=?", (id,))
+        finally :
+            Web.invalidate(id)
 
 
 class UserWebAccess(object) :
     @staticmethod
+    def web_ids_for_user(user) :
+        """Gets the frozenset of the ids of the webs which the user can access, either
+        explicitly or because they are public."""
+        user_id = user.id if isinstance(user, User) else user
+        def load() :
+            return frozenset(row['id'] for row in DB.execute("""
+            select id from webs where public
+            union select web_id from user_web_access where user_id=?""", (user_id,)))
+        return CACHES["access"].get(user_id, load)
+    @staticmethod
     def get_for_user(user) :
-        return [Web(id=row['id'], name=row['web_name'], public=bool(row['public']))
-                for row in DB.execute('select id, web_name, public from webs left join user_web_access on user_web_access.web_id=webs.id where user_web_access.user_id=? or public', (user.id,))]
+        webs = [Web.get_by_id(web_id) for web_id in sorted(UserWebAccess.web_ids_for_user(user))]
+        return [web for web in webs if web != None]
     @staticmethod
     def can_user_access(user, web) :
-        user_id = user.id if isinstance(user, User) else user
         web_id = web.id if isinstance(web, Web) else web
-        return None != DB.execute("select 1 from webs join user_web_access on user_web_access.web_id=webs.id  where (user_web_access.user_id=? or webs.public) and web_id=?", (user_id, web_id)).fetchone()
+        return web_id in UserWebAccess.web_ids_for_user(user)
     @staticmethod
     def users_for_web(web) :
         """Gets all users who have been explicitly granted privileges (not just by 'public')."""
         web_id = web.id if isinstance(web, Web) else web
-        return [User.get_by_id(row['user_id'])
-                for row in DB.execute('select user_id from user_web_access where web_id=?', (web_id,))]
+        return [User.from_row(row)
+                for row in DB.execute("""
+                select users.id, email, first_name, last_name, locale, avatar
+                from user_web_access inner join users on users.id=user_web_access.user_id
+                where web_id=?""", (web_id,))]
+    @staticmethod
+    def user_ids_for_web(web) :
+        """Like users_for_web, but just the ids."""
+        web_id = web.id if isinstance(web, Web) else web
+        return [row['user_id'] for row in DB.execute('select user_id from user_web_access where web_id=?', (web_id,))]
     @staticmethod
     def remove_for_user(web, user) :
-        with DB :
-            DB.execute("delete from user_web_access where web_id=? and user_id=?",
-                         (web.id, user.id))
+        try :
+            with DB :
+                DB.execute("delete from user_web_access where web_id=? and user_id=?",
+                             (web.id, user.id))
+        finally :
+            CACHES["access"].invalidate(user.id)
     @staticmethod
     def add_for_user(web, user) :
-        with DB :
-            DB.execute("insert into user_web_access (web_id, user_id) values (?,?)",
-                         (web.id, user.id))
+        try :
+            with DB :
+                DB.execute("insert into user_web_access (web_id, user_id) values (?,?)",
+                             (web.id, user.id))
+        finally :
+            CACHES["access"].invalidate(user.id)
 
 class User(object) :
+    __slots__ = ("id", "email", "first_name", "last_name", "locale", "avatar")
     def __init__(self, id=None, email=None, first_name=None, last_name=None, locale=None, avatar=None) :
         self.id = id
         self.email = email
@@ -89,44 +458,102 @@ class User(object) :
     def __repr__(self) :
         return "User(id=%r, email=%r, first_name=%r, last_name=%r, locale=%r, avatar=%r)" % (self.id, self.email, self.first_name, self.last_name, self.locale, self.avatar)
     @staticmethod
+    def from_row(row) :
+        return User(id=row['id'], email=row['email'],
+                    first_name=row['first_name'], last_name=row['last_name'],
+                    locale=row['locale'], avatar=row['avatar'])
+    @staticmethod
     def update(user) :
-        with DB :
-            if user.id == None :
-                c = DB.execute("insert into users (email, first_name, last_name, locale, avatar) values (?,?,?,?,?)",
-                                 (user.email, user.first_name, user.last_name, user.locale, user.avatar))
-                user.id = c.lastrowid
-            else :
-                DB.execute("update users set email=?, first_name=?, last_name=?, locale=?, avatar=? where id=?",
-                             (user.email, user.first_name, user.last_name, user.locale, user.avatar, user.id))
+        try :
+            with DB :
+                if user.id == None :
+                    c = DB.execute("insert into users (email, first_name, last_name, locale, avatar) values (?,?,?,?,?)",
+                                     (user.email, user.first_name, user.last_name, user.locale, user.avatar))
+                    user.id = c.lastrowid
+                else :
+                    DB.execute("update users set email=?, first_name=?, last_name=?, locale=?, avatar=? where id=?",
+                                 (user.email, user.first_name, user.last_name, user.locale, user.avatar, user.id))
+        finally :
+            # by id and by email, including an email it had before
+            CACHES["users"].invalidate_if(lambda key, cached : cached.id == user.id or key == ("email", user.email))
     @staticmethod
     def get_by_email(email) :
-        for row in DB.execute("select id, email, first_name, last_name, locale, avatar from users where email=?", (email,)) :
-            return User(id=row['id'], email=row['email'],
-                        first_name=row['first_name'], last_name=row['last_name'],
-                        locale=row['locale'], avatar=row['avatar'])
-        return None
+        def load() :
+            for row in DB.execute("select id, email, first_name, last_name, locale, avatar from users where email=?", (email,)) :
+                return User.from_row(row)
+            return None
+        return CACHES["users"].get(("email", email), load)
     @staticmethod
     def get_by_id(id) :
-        for row in DB.execute("select id, email, first_name, last_name, locale, avatar from users where id=?", (id,)) :
-            return User(id=row['id'], email=row['email'],
-                        first_name=row['first_name'], last_name=row['last_name'],
-                        locale=row['locale'], avatar=row['avatar'])
-        return None
+        def load() :
+            for row in DB.execute("select id, email, first_name, last_name, locale, avatar from users where id=?", (id,)) :
+                return User.from_row(row)
+            return None
+        return CACHES["users"].get(("id", id), load)
     @staticmethod
     def get_all() :
-        users = []
-        for row in DB.execute("select id, email, first_name, last_name, locale, avatar from users") :
-            users.append(User(id=row['id'], email=row['email'],
-                              first_name=row['first_name'], last_name=row['last_name'],
-                              locale=row['locale'], avatar=row['avatar']))
-        return users
+        return [User.from_row(row) for row in DB.execute("select id, email, first_name, last_name, locale, avatar from users")]
 
 class Content(object) :
-    def __init__(self, hash=None, stuff=None) :
+    """Content of at least FILE_THRESHOLD bytes is kept in FILE_STORE rather than in
+    the content table, in which case it is only read when stuff is used (use open
+    to read it a piece at a time)."""
+    FILE_THRESHOLD = 64*1024
+    SUMMARY_LENGTH = 160
+    __slots__ = ("hash", "_stuff", "stored", "_length")
+    def __init__(self, hash=None, stuff=None, stored=False) :
         self.hash = hash
-        self.stuff = stuff
+        self._stuff = stuff
+        self.stored = stored
+        self._length = None
     def __repr__(self) :
         return "Content(hash=%s)" % self.hash
+    @property
+    def stuff(self) :
+        if self._stuff == None and self.stored :
+            with self.open() as f :
+                self._stuff = f.read()
+        return self._stuff
+    @property
+    def length(self) :
+        """The length in bytes."""
+        if self._length == None :
+            if self.stored :
+                self._length = FILE_STORE.size(self.hash)
+            elif isinstance(self._stuff, unicode) :
+                self._length = len(self._stuff.encode("utf-8"))
+            else :
+                self._length = len(self._stuff)
+        return self._length
+    def summarize(self, text=True) :
+        """Gets (summary, length, line_count), where the summary is the first
+        SUMMARY_LENGTH characters with runs of whitespace made into single spaces.
+        These are worked out when a blob is made and kept with it.  Only the length is
+        found for content which isn't text (the others are None); text is read a piece
+        at a time."""
+        if not text :
+            return None, self.length, None
+        head = ""
+        lines = 0
+        last = "\n"
+        with self.open() as f :
+            for chunk in iter(lambda : f.read(64*1024), "") :
+                if len(head) < 4 * Content.SUMMARY_LENGTH : # enough bytes for that many characters
+                    head += chunk[:4 * Content.SUMMARY_LENGTH - len(head)]
+                lines += chunk.count("\n")
+                last = chunk[-1]
+        if last != "\n" :
+            lines += 1
+        summary = " ".join(head.decode("utf-8", "ignore")[:Content.SUMMARY_LENGTH].split())
+        return summary, self.length, lines
+    def open(self) :
+        """Gets a file object for the content."""
+        if self.stored :
+            return FILE_STORE.open(self.hash)
+        stuff = self._stuff
+        if isinstance(stuff, unicode) :
+            stuff = stuff.encode("utf-8")
+        return io.BytesIO(str(stuff))
     @staticmethod
     def make_hash_from_string(s) :
         m = hashlib.sha1()
@@ -137,18 +564,61 @@ class Content(object) :
         """Gets a content object for the string, adding the stuff to the database if
         it is not already present."""
         hash = Content.make_hash_from_string(stuff)
-        r = DB.execute("select hash from content where hash=?", (hash,)).fetchone()
+        r = DB.execute("select stored from content where hash=?", (hash,)).fetchone()
         if r == None :
-            with DB :
-                DB.execute("insert into content (hash, stuff) values (?,?)", (hash, stuff))
-            return Content(hash=hash, stuff=stuff)
+            stored = len(stuff) >= Content.FILE_THRESHOLD
+            if stored :
+                FILE_STORE.put(hash, stuff)
+            with DB : # (or ignore, since another thread may have just added the same stuff)
+                DB.execute("insert or ignore into content (hash, stuff, stored) values (?,?,?)",
+                           (hash, "" if stored else stuff, int(stored)))
+            return Content(hash=hash, stuff=stuff, stored=stored)
         else :
-            return Content(hash=hash, stuff=stuff)
+            return Content(hash=hash, stuff=stuff, stored=bool(r['stored']))
+    @staticmethod
+    def get_by_spill_file(spill) :
+        """Gets a content object for a filestore.SpillFile, adding it if the hash isn't
+        already present.  Large content is moved into FILE_STORE rather than read."""
+        hash = spill.close()
+        if DB.execute("select hash from content where hash=?", (hash,)).fetchone() == None :
+            stored = spill.length >= Content.FILE_THRESHOLD
+            if stored :
+                FILE_STORE.put_file(hash, spill.filename)
+                stuff = ""
+            else :
+                stuff = buffer(spill.read())
+            with DB :
+                DB.execute("insert or ignore into content (hash, stuff, stored) values (?,?,?)",
+                           (hash, stuff, int(stored)))
+        spill.discard()
+        return Content.get_by_hash(hash)
+    @staticmethod
+    def add_many(contents) :
+        """Adds the Content objects whose hashes aren't already present, for use inside
+        a transaction.  Large stuff is written to FILE_STORE first (content which is
+        already stored is expected to be there)."""
+        rows = []
+        for c in contents :
+            stored = c.stored
+            stuff = "" if stored else c.stuff
+            if len(stuff) >= Content.FILE_THRESHOLD :
+                FILE_STORE.put(c.hash, stuff)
+                stored = True
+                stuff = ""
+            elif isinstance(stuff, str) :
+                try :
+                    stuff = stuff.decode("utf-8") # text is kept as text
+                except UnicodeDecodeError :
+                    stuff = buffer(stuff)
+            rows.append((c.hash, stuff, int(stored)))
+        DB.executemany("insert or ignore into content (hash, stuff, stored) values (?,?,?)", rows)
     @staticmethod
     def get_by_hash(hash) :
-        r = DB.execute("select stuff from content where hash=?", (hash,)).fetchone()
+        r = DB.execute("select stuff, stored from content where hash=?", (hash,)).fetchone()
         if r == None :
             return None
+        elif r['stored'] :
+            return Content(hash=hash, stored=True)
         else :
             return Content(hash=hash, stuff=r['stuff'])
     @staticmethod
@@ -164,17 +634,27 @@ class Content(object) :
         return c
 
 class Blob(object) :
-    def __init__(self, id=None, uuid=None, date_created=None, editor_email=None, content_type=None, content_hash=None) :
+    """There can be hundreds of thousands of these in memory at once (for the
+    metadata of a large web), so they have __slots__ and are made from plain tuples
+    (see from_row)."""
+    __slots__ = ("id", "uuid", "_date_created", "editor_email", "_editor", "content_type", "content_hash",
+                 "summary", "length", "line_count", "_content")
+    def __init__(self, id=None, uuid=None, date_created=None, editor_email=None, content_type=None, content_hash=None,
+                 summary=None, length=None, line_count=None) :
         self.id = id
         self.uuid = uuid
-        self.date_created = date_created
+        self._date_created = date_created # a datetime or seconds (see timestamp_properties)
         self.editor_email = editor_email
         self._editor = None
         self.content_type = content_type
         self.content_hash = content_hash
+        self.summary = summary
+        self.length = length
+        self.line_count = line_count
         self._content = None
     def __repr__(self) :
         return "Blob(%r)" % self.uuid
+    date_created, created_seconds = timestamp_properties("_date_created")
     @property
     def content(self) :
         if self._content == None :
@@ -184,15 +664,28 @@ class Blob(object) :
     def editor(self) :
         if self._editor == None :
             self._editor = User.get_by_email(self.editor_email)
+    @property
+    def is_text(self) :
+        return self.content_type.startswith("mime:text/")
+    COLUMNS = "blobs.id, blobs.uuid, blobs.date_created, blobs.editor_email, blobs.content_type, blobs.content_hash, blobs.summary, blobs.length, blobs.line_count"
+    @staticmethod
+    def from_row(r) :
+        """Makes a Blob from a row of COLUMNS, which are in the order of the arguments
+        of __init__ (so the row can be a tuple from DB.execute_tuples)."""
+        return Blob(*r)
     @staticmethod
     def get_by_uuid(uuid) :
-        r = DB.execute("select id, uuid, date_created, editor_email, content_type, content_hash from blobs where uuid=?", (uuid,)).fetchone()
+        r = DB.execute_tuples("select " + Blob.COLUMNS + " from blobs where uuid=?", (uuid,)).fetchone()
         if r == None :
             return None
         else :
-            created = datetime.datetime.utcfromtimestamp(r["date_created"])
-            return Blob(id=r["id"], uuid=r["uuid"], date_created=created,
-                        editor_email=r["editor_email"], content_type=r["content_type"], content_hash=r["content_hash"])
+            return Blob.from_row(r)
+    @staticmethod
+    def get_by_uuids(uuids) :
+        """Gets a dictionary of uuid -> Blob for those uuids which exist."""
+        load_temp_keys("uuid_set", uuids)
+        q = DB.execute_tuples("select " + Blob.COLUMNS + " from temp.uuid_set cross join blobs on blobs.uuid=uuid_set.key")
+        return dict((r[1], Blob.from_row(r)) for r in q)
     @staticmethod
     def get_created_by_uuid(uuid) :
         r = DB.execute("select date_created from blobs where uuid=?", (uuid,)).fetchone()
@@ -201,11 +694,13 @@ class Blob(object) :
         return datetime.datetime.utcfromtimestamp(r["date_created"])
     @staticmethod
     def make_blob(editor, content_type, content) :
-        if isinstance(content, Content) :
-            content = content.hash
+        if not isinstance(content, Content) :
+            content = Content.get_by_hash(content)
+        summary, length, line_count = content.summarize(content_type.startswith("mime:text/"))
         id = uuid.uuid4().hex
         with DB :
-            DB.execute("insert into blobs (uuid, date_created, editor_email, content_type, content_hash) values (?,?,?,?,?)", (id, int(time.time()), editor.email, content_type, content))
+            DB.execute("insert into blobs (uuid, date_created, editor_email, content_type, content_hash, summary, length, line_count) values (?,?,?,?,?,?,?,?)",
+                       (id, int(time.time()), editor.email, content_type, content.hash, summary, length, line_count))
         return Blob.get_by_uuid(id)
 
 class WebBlobAccess(object) :
@@ -221,6 +716,12 @@ class WebBlobAccess(object) :
     def users_can_access(blob) :
         return [User.get_by_id(r['id']) for r in DB.execute("select user_web_access.user_id as id from blobs inner join blobs_web on blobs.id=blobs_web.blob_id inner join user_web_access on blobs_web.web_id=user_web_access.web_id where blobs.id=?", (blob.id,))]
 
+    @staticmethod
+    def get_web_users_for_blob(blob) :
+        """Gets the (web_id, user_id) pairs of the webs the blob is in and the users
+        who can access the blob through them."""
+        return [(r['web_id'], r['user_id']) for r in DB.execute("select blobs_web.web_id, user_web_access.user_id from blobs_web inner join user_web_access on blobs_web.web_id=user_web_access.web_id where blobs_web.blob_id=?", (blob.id,))]
+
     @staticmethod
     def remove_for_web(web, blob) :
         with DB :
@@ -229,9 +730,50 @@ class WebBlobAccess(object) :
     @staticmethod
     def add_for_blob(web, blob) :
         with DB :
-            DB.execute("insert into blobs_web (web_id, blob_id) values (?,?)",
+            DB.execute("insert into blobs_web (web_id, blob_id, date_created) select ?, id, date_created from blobs where id=?",
                          (web.id, blob.id))
     @staticmethod
+    def list_blobs(web, before=None, limit=50, content_type=None, editor_email=None, tag=None, deleted=None) :
+        """Gets a page of the blobs in the web, newest first, as a list of Blobs.
+        before is the (date_created, id) of the last blob of the previous page.  The
+        blobs can be filtered by a prefix of their content type (relations are left
+        out unless content_type asks for them), their editor, a tag they have, and
+        whether they are deleted, where the tags and deletions are those in the
+        inherited relations cache (see relations.InheritedRelationCache)."""
+        web_id = web.id if isinstance(web, Web) else web
+        where = ["bw.web_id=?"]
+        params = [web_id]
+        if before != None :
+            where.append("(bw.date_created, bw.blob_id) < (?,?)")
+            params.extend(before)
+        if content_type :
+            where.append("blobs.content_type like ? escape '\\'")
+            params.append(re.sub(r"([\\%_])", r"\\\1", content_type) + "%")
+        if not (content_type or "").startswith("relation:") :
+            where.append("blobs.content_type not like 'relation:%'")
+        if editor_email :
+            where.append("blobs.editor_email=?")
+            params.append(editor_email)
+        live_relation = """exists (select 1 from inherited_relations as ir
+                                   inner join relations as r on r.id=ir.relation_id
+                                   inner join relation_types as rt on rt.id=r.relation
+                                   where ir.web_id=bw.web_id and ir.blob_id=bw.blob_id and not ir.deleted
+                                     and rt.relation_type_name=? and %s)"""
+        if tag :
+            where.append(live_relation % "r.payload=?")
+            params.extend(["tag", tag])
+        if deleted != None :
+            where.append(("" if deleted else "not ") + live_relation % "r.object_id=bw.blob_id")
+            params.append("deletes")
+        params.append(limit)
+        q = DB.execute_tuples("""
+        select """ + Blob.COLUMNS + """
+        from blobs_web as bw
+        inner join blobs on blobs.id=bw.blob_id
+        where """ + " and ".join(where) + """
+        order by bw.date_created desc, bw.blob_id desc limit ?""", params)
+        return [Blob.from_row(r) for r in q]
+    @staticmethod
     def does_web_have_blobs(web) :
         return None != DB.execute("select 1 from blobs_web where web_id=? limit 1", (web.id,)).fetchone()
     @staticmethod
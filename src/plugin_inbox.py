@@ -1,67 +1,280 @@
 # plugin_inbox.py
 # adds new blobs to the inbox
 
+import threading
+import Queue
+
+import logging
+logger = logging.getLogger(__name__)
+
 import models
+import migrations
 import channel
 import methods
 from rpcmodules import rpc_module
 
 import minirpc
 from minirpc import rpcmethod, RPCServable
+import authorization
 
 class Inbox(object) :
+    """The blobs in each user's inbox for each web, newest first, and which of them
+    the user has read.  The number unread is kept in plugin_inbox_unread by triggers
+    (see sql/createdb.sql) so that it never needs counting."""
     @staticmethod
     def add_to_inbox(user, web, blob) :
         blob_id = blob.id if isinstance(blob, models.Blob) else blob
         with models.DB :
-            models.DB.execute("insert into plugin_inbox (user_id, web_id, blob_id) values (?,?,?)", (user.id, web.id, blob_id))
+            models.DB.execute("""
+            insert into plugin_inbox (user_id, web_id, blob_id, date_created)
+            select ?, ?, id, date_created from blobs where id=?""", (user.id, web.id, blob_id))
+    @staticmethod
+    def add_to_inboxes(blob_ids) :
+        """Adds the blobs to the inbox of every user who has been granted access to a
+        web they are in, with one insert for all of them.  Gets the list of
+        (web_id, uuids, user_ids) of what was added."""
+        models.load_temp_keys("blob_id_set", blob_ids)
+        with models.DB :
+            models.DB.execute("""
+            insert into plugin_inbox (user_id, web_id, blob_id, date_created)
+            select uwa.user_id, bw.web_id, bw.blob_id, bw.date_created
+            from temp.blob_id_set as s
+            cross join blobs_web as bw on bw.blob_id=s.key
+            inner join user_web_access as uwa on uwa.web_id=bw.web_id""")
+            uuids = dict()
+            for r in models.DB.execute("""
+            select bw.web_id, b.uuid
+            from temp.blob_id_set as s
+            cross join blobs_web as bw on bw.blob_id=s.key
+            inner join blobs as b on b.id=bw.blob_id
+            order by bw.blob_id""") :
+                uuids.setdefault(r['web_id'], []).append(r['uuid'])
+            user_ids = dict()
+            for web_id in uuids :
+                user_ids[web_id] = models.UserWebAccess.user_ids_for_web(web_id)
+        return [(web_id, uuids[web_id], user_ids[web_id]) for web_id in sorted(uuids) if user_ids[web_id]]
     @staticmethod
     def remove_from_inbox(user, web, blob) :
         blob_id = blob.id if isinstance(blob, models.Blob) else blob
+        web_id = web.id if isinstance(web, models.Web) else web
+        with models.DB :
+            models.DB.execute("delete from plugin_inbox where user_id=? and web_id=? and blob_id=?", (user.id, web_id, blob_id))
+    @staticmethod
+    def remove_uuids(user, web, uuids) :
+        """Removes the blobs (by uuid) from the user's inbox."""
+        web_id = web.id if isinstance(web, models.Web) else web
         with models.DB :
-            models.DB.execute("delete from plugin_inbox where user_id=? and web_id=? and blob_id=?", (user.id, web.id, blob_id))
+            models.DB.executemany("""
+            delete from plugin_inbox where user_id=? and web_id=? and blob_id=(select id from blobs where uuid=?)""",
+                                  [(user.id, web_id, uuid) for uuid in uuids])
+    @staticmethod
+    def get_page(user, web, before=None, limit=50, unread_only=False) :
+        """Gets a page of the user's inbox for the web, newest first, as a list of
+        (uuid, date_created, blob_id, read).  before is the (date_created, blob_id) of
+        the last blob of the previous page."""
+        web_id = web.id if isinstance(web, models.Web) else web
+        where = ["pi.user_id=?", "pi.web_id=?"]
+        params = [user.id, web_id]
+        if before != None :
+            where.append("(pi.date_created, pi.blob_id) < (?,?)")
+            params.extend(before)
+        if unread_only :
+            where.append("pi.read=0")
+        params.append(limit)
+        return [(r['uuid'], r['date_created'], r['blob_id'], bool(r['read']))
+                for r in models.DB.execute("""
+                select b.uuid, pi.date_created, pi.blob_id, pi.read
+                from plugin_inbox as pi
+                inner join blobs as b on b.id=pi.blob_id
+                where """ + " and ".join(where) + """
+                order by pi.date_created desc, pi.blob_id desc limit ?""", params)]
+    @staticmethod
+    def get_position(user, web, uuid) :
+        """Gets the (date_created, blob_id) of the blob in the user's inbox, or None if
+        it isn't there."""
+        web_id = web.id if isinstance(web, models.Web) else web
+        r = models.DB.execute("""
+        select date_created, blob_id from plugin_inbox
+        where user_id=? and web_id=? and blob_id=(select id from blobs where uuid=?)""", (user.id, web_id, uuid)).fetchone()
+        return None if r == None else (r['date_created'], r['blob_id'])
     @staticmethod
-    def get_inbox_uuids(user, web) :
+    def unread_count(user, web) :
         web_id = web.id if isinstance(web, models.Web) else web
-        return [r["uuid"] for r in models.DB.execute("select uuid from blobs inner join plugin_inbox pi on blobs.id=pi.blob_id where pi.user_id=? and web_id=?", (user.id, web_id,))]
+        r = models.DB.execute("select unread from plugin_inbox_unread where user_id=? and web_id=?",
+                              (user.id, web_id)).fetchone()
+        return 0 if r == None else r['unread']
+    @staticmethod
+    def mark_read(user, web, through=None) :
+        """Marks the blobs in the user's inbox read, up to and including the one at
+        through, a (date_created, blob_id), or all of them if it is None.  Only the
+        unread ones are looked at.  Gets the number still unread."""
+        web_id = web.id if isinstance(web, models.Web) else web
+        where = ["user_id=?", "web_id=?", "read=0"]
+        params = [user.id, web_id]
+        if through != None :
+            where.append("(date_created, blob_id) <= (?,?)")
+            params.extend(through)
+        with models.DB :
+            models.DB.execute("update plugin_inbox set read=1 where " + " and ".join(where), params)
+            return Inbox.unread_count(user, web_id)
+
+@migrations.backfill("inbox_dates")
+def backfill_inbox_dates(position, chunk_size) :
+    """Copies the date each blob was created into the inbox rows which don't have it,
+    and recounts the unread rows, chunk_size user ids at a time."""
+    start = position or 0
+    with models.DB :
+        models.DB.execute("""
+        update plugin_inbox set date_created=(select date_created from blobs where id=plugin_inbox.blob_id)
+        where user_id>? and user_id<=? and date_created is null""", (start, start + chunk_size))
+        models.DB.execute("""
+        insert or replace into plugin_inbox_unread (user_id, web_id, unread)
+        select user_id, web_id, sum(read=0) from plugin_inbox
+        where user_id>? and user_id<=? group by user_id, web_id""", (start, start + chunk_size))
+    if models.DB.execute("select 1 from users where id>? limit 1", (start + chunk_size,)).fetchone() == None :
+        return None
+    return start + chunk_size
 
 @rpc_module("inbox")
 class InboxRPC(RPCServable) :
     def __init__(self, handler, channels) :
         self.handler = handler
         self.channels = channels
+    INBOX_LIMIT = 200
     @rpcmethod
-    def get_inbox(self, user, webid) :
-        if models.UserWebAccess.can_user_access(user, webid) :
-            return Inbox.get_inbox_uuids(user, webid)
-        else :
+    @models.read_only
+    def get_inbox(self, user, webid, cursor=None, limit=50, unread_only=False) :
+        """Gets a page of the user's inbox for the web, newest first, as {"items" :
+        [{uuid, read}], "next" : the cursor of the next page (None after the last),
+        "unread" : the number unread in the whole inbox}, or None if the user can't
+        access the web."""
+        if not authorization.can_read(user, webid) :
             return None
+        limit = min(self.INBOX_LIMIT, max(1, int(limit)))
+        before = None
+        if cursor :
+            date_created, blob_id = cursor.split(".")
+            before = (int(date_created), int(blob_id))
+        page = Inbox.get_page(user, webid, before, limit + 1, unread_only)
+        next_cursor = None
+        if len(page) > limit :
+            page = page[:limit]
+            next_cursor = "%d.%d" % page[-1][1:3]
+        return {"items" : [{"uuid" : uuid, "read" : read} for uuid, date_created, blob_id, read in page],
+                "next" : next_cursor,
+                "unread" : Inbox.unread_count(user, webid)}
+    @rpcmethod
+    @authorization.requires(authorization.READ, web="webid")
+    def mark_read(self, user, webid, uuid=None) :
+        """Marks the blob with the uuid and every older one in the user's inbox read (or
+        the whole inbox, if uuid is None).  Gets the number still unread."""
+        through = None
+        if uuid != None :
+            through = Inbox.get_position(user, webid, uuid)
+            if through == None :
+                raise Exception("not in the inbox")
+        unread = Inbox.mark_read(user, webid, through)
+        self.channels.broadcast([InboxReadMessage(webid, user.id, uuid, unread)])
+        return unread
+    @rpcmethod
+    @authorization.requires(authorization.READ, web="webid")
+    def remove(self, user, webid, uuids) :
+        """Removes the blobs (by uuid) from the user's inbox."""
+        Inbox.remove_uuids(user, webid, uuids)
+        self.channels.broadcast([InboxMessage(webid, uuids, [user.id], adding=False)])
 
+@channel.message_type
 class InboxMessage(channel.Message) :
-    def __init__(self, user, web, blob, adding=True) :
-        self.user = user
-        self.web = web
-        self.blob = blob
+    """Tells the users (by id) of a web that the blobs (by uuid) were added to or
+    removed from their inboxes there."""
+    batch = True
+    def __init__(self, web_id, uuids, user_ids, adding=True) :
+        self.web_id = web_id
+        self.uuids = uuids
+        self._user_ids = set(user_ids)
         self.adding = adding
-    def appropriate_for(self, user) :
-        return self.user.id == user.id
+    def to_wire(self) :
+        return {"type" : "InboxMessage", "seq" : self.seq,
+                "web_id" : self.web_id, "uuids" : self.uuids,
+                "user_ids" : list(self._user_ids), "adding" : self.adding}
+    @staticmethod
+    def from_wire(wire) :
+        return InboxMessage(wire["web_id"], wire["uuids"], wire["user_ids"], wire["adding"])
+    def web_ids(self) :
+        return [self.web_id]
+    def user_ids(self) :
+        return self._user_ids
     def serialize(self) :
         return {"type" : "InboxMessage",
-                "args" : {"uuid" : self.blob.uuid,
-                          "web_id" : self.web.id,
+                "args" : {"uuids" : self.uuids,
+                          "web_id" : self.web_id,
                           "adding" : self.adding}}
 
+@channel.message_type
+class InboxReadMessage(channel.Message) :
+    """Tells a user that their inbox for a web was read up to the blob with the uuid
+    (or all of it, if uuid is None), leaving unread blobs unread."""
+    def __init__(self, web_id, user_id, uuid, unread) :
+        self.web_id = web_id
+        self.user_id = user_id
+        self.uuid = uuid
+        self.unread = unread
+    def to_wire(self) :
+        return {"type" : "InboxReadMessage", "seq" : self.seq,
+                "web_id" : self.web_id, "user_id" : self.user_id,
+                "uuid" : self.uuid, "unread" : self.unread}
+    @staticmethod
+    def from_wire(wire) :
+        return InboxReadMessage(wire["web_id"], wire["user_id"], wire["uuid"], wire["unread"])
+    def web_ids(self) :
+        return [self.web_id]
+    def user_ids(self) :
+        return set([self.user_id])
+    def serialize(self) :
+        return {"type" : "InboxReadMessage",
+                "args" : {"web_id" : self.web_id,
+                          "uuid" : self.uuid,
+                          "unread" : self.unread}}
+
+class InboxFanout(object) :
+    """Adds new blobs to inboxes on a thread of its own, so that a broadcast doesn't
+    wait on it.  The blobs which arrive while a batch is being added make up the
+    next batch (of at most MAX_BATCH), which is added by Inbox.add_to_inboxes and
+    announced with one InboxMessage per web."""
+    MAX_BATCH = 1000
+    def __init__(self, channels) :
+        self.channels = channels
+        self.queue = Queue.Queue()
+        self.thread = None
+    def add(self, blob_ids) :
+        if self.thread == None : # started here rather than before the server forks
+            self.thread = threading.Thread(target=self._work, name="inbox-fanout")
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put(blob_ids)
+    def _work(self) :
+        while True :
+            blob_ids = list(self.queue.get())
+            try :
+                while len(blob_ids) < self.MAX_BATCH :
+                    blob_ids.extend(self.queue.get_nowait())
+            except Queue.Empty :
+                pass
+            try :
+                added = Inbox.add_to_inboxes(blob_ids)
+            except Exception :
+                logger.exception("Could not add %d blobs to inboxes", len(blob_ids))
+                continue
+            if added :
+                self.channels.broadcast([InboxMessage(web_id, uuids, user_ids)
+                                         for web_id, uuids, user_ids in added])
+
 def add_inbox_plugin(channels) :
+    fanout = InboxFanout(channels)
     def inbox_channel_callback(messages) :
-        newBlobMessages = [m for m in messages if isinstance(m, channel.NewBlobMessage)]
-        if not newBlobMessages :
-            return
-        myMessages = []
-        for m in newBlobMessages :
-            for web in models.WebBlobAccess.get_webs_for_blob(m.blob) :
-                for user in models.UserWebAccess.users_for_web(web) :
-                    Inbox.add_to_inbox(user, web, m.blob)
-                    myMessages.append(InboxMessage(user, web, m.blob, True))
-        channels.broadcast(myMessages)
+        blob_ids = [m.blob.id for m in messages if isinstance(m, channel.NewBlobMessage)]
+        if blob_ids :
+            fanout.add(blob_ids)
     channels.add_firehose_listener(inbox_channel_callback)
+    return fanout
 
@@ -8,8 +8,13 @@ from rpcmodules import rpc_module
 
 import minirpc
 from minirpc import rpcmethod, RPCServable
+import migrations
+import search
 
 import datetime
+import time
+import uuid
+import re
 
 class Relation(object) :
     _cached_relation_types = {}
@@ -49,10 +54,12 @@ class Relation(object) :
         try :
             return Relation._cached_relation_types_by_id[id]
         except KeyError :
-            for row in models.DB.execute("select relation_type_name as name from relation_types where id=?", (id,)) :
-                Relation._cached_relation_types[row['name']] = id
-                Relation._cached_relation_types_by_id[id] = row['name']
-                return row['name']
+            # there are few relation types, so load all of them at once
+            for row in models.DB.execute("select id, relation_type_name as name from relation_types") :
+                Relation._cached_relation_types[row['name']] = row['id']
+                Relation._cached_relation_types_by_id[row['id']] = row['name']
+            if id in Relation._cached_relation_types_by_id :
+                return Relation._cached_relation_types_by_id[id]
             else :
                 raise KeyError(id)
 
@@ -106,12 +113,19 @@ class BinaryRelation(Relation) :
         with models.DB :
             models.DB.execute("insert into relations (web_id, blob_id, subject_id, relation, object_id, payload) values (?,?,?,?,?,?)",
                               (web.id, b.id, subject.id, relid, object_id, payload_text))
+        InheritedRelationCache.refresh(web, subject)
         return b
 
 class CachedRelation(object) :
-    def __init__(self, uuid, date_created, name, subject_uuid, object_uuid=None, payload=None) :
+    """A row of the relations cache.  Like models.Blob, these have __slots__ and are
+    made from plain tuples, and date_created is only made into a datetime when it is
+    read."""
+    __slots__ = ("rel_id", "uuid", "_date_created", "name", "subject_uuid", "object_uuid", "payload",
+                 "deleted", "_blob", "_subject", "_object")
+    def __init__(self, uuid, date_created, name, subject_uuid, object_uuid=None, payload=None, rel_id=None) :
+        self.rel_id = rel_id # id in the relations table (None for pseudo-relations)
         self.uuid = uuid
-        self.date_created = date_created
+        self._date_created = date_created # a datetime or seconds (see models.timestamp_properties)
         self.name = name
         self.subject_uuid = subject_uuid
         self.object_uuid = object_uuid
@@ -120,6 +134,7 @@ class CachedRelation(object) :
         self._blob = None
         self._subject = None
         self._object = None
+    date_created, created_seconds = models.timestamp_properties("_date_created")
     pseudo_counter = 0
     @staticmethod
     def make_pseudo(date_created, name, subject_uuid, payload) :
@@ -144,76 +159,125 @@ class CachedRelation(object) :
     def __repr__(self) :
         return "CachedRelation(uuid=%r,deleted=%r,date_created=%r,name=%r,subject_uuid=%r,object_uuid=%r,payload=%r)" \
             % (self.uuid, self.deleted, self.date_created, self.name, self.subject_uuid, self.object_uuid, self.payload)
+    COLUMNS = "r.id, rblob.uuid, rblob.date_created, r.relation, sblob.uuid as subject_uuid, oblob.uuid as object_uuid, r.payload"
+    @staticmethod
+    def from_rows(rows) :
+        """Makes a list of CachedRelations from rows of COLUMNS (tuples from
+        models.DB.execute_tuples).  The names of the relation types are looked up in
+        Relation's cache directly, since there are few of them."""
+        names = Relation._cached_relation_types_by_id
+        rels = []
+        for id, uuid, created, relation, subject_uuid, object_uuid, payload in rows :
+            name = names.get(relation) or Relation.get_relation_name(relation)
+            rels.append(CachedRelation(uuid, created, name, subject_uuid, object_uuid, payload, id))
+        return rels
     @staticmethod
     def get_for_subject(web_id, blob_uuid) :
         if isinstance(web_id, models.Web) :
             web_id = web_id.id
         if isinstance(blob_uuid, models.Blob) :
             blob_uuid = blob_uuid.uuid
-        q = models.DB.execute("""
-        select rblob.uuid, rblob.date_created, r.relation, r.object_id, oblob.uuid as object_uuid, r.payload
+        return CachedRelation.from_rows(models.DB.execute_tuples("""
+        select """ + CachedRelation.COLUMNS + """
         from relations as r
         inner join blobs as rblob on rblob.id=r.blob_id
         inner join blobs as sblob on sblob.id=r.subject_id
         left join blobs as oblob on oblob.id=r.object_id
-        where r.web_id=? and sblob.uuid=?""", (web_id, blob_uuid))
-        rels = []
-        for row in q :
-            rels.append(CachedRelation(uuid=row['uuid'],
-                                       date_created=datetime.datetime.utcfromtimestamp(row["date_created"]),
-                                       name=Relation.get_relation_name(row['relation']),
-                                       subject_uuid=blob_uuid,
-                                       object_uuid=row['object_uuid'],
-                                       payload=row['payload']))
-        return rels
+        where r.web_id=? and sblob.uuid=?""", (web_id, blob_uuid)))
     @staticmethod
     def get_for_object(web_id, blob_uuid) :
         if isinstance(web_id, models.Web) :
             web_id = web_id.id
         if isinstance(blob_uuid, models.Blob) :
             blob_uuid = blob_uuid.uuid
-        q = models.DB.execute("""
-        select rblob.uuid, rblob.date_created, r.relation, sblob.uuid as subject_uuid, oblob.uuid as object_uuid, r.payload
+        return CachedRelation.from_rows(models.DB.execute_tuples("""
+        select """ + CachedRelation.COLUMNS + """
         from relations as r
         inner join blobs as rblob on rblob.id=r.blob_id
         inner join blobs as sblob on sblob.id=r.subject_id
         inner join blobs as oblob on oblob.id=r.object_id
-        where r.web_id=? and oblob.uuid=?""", (web_id, blob_uuid))
-        rels = []
-        for row in q :
-            rels.append(CachedRelation(uuid=row['uuid'],
-                                       date_created=datetime.datetime.utcfromtimestamp(row["date_created"]),
-                                       name=Relation.get_relation_name(row['relation']),
-                                       subject_uuid=row['subject_uuid'],
-                                       object_uuid=row['object_uuid'],
-                                       payload=row['payload']))
+        where r.web_id=? and oblob.uuid=?""", (web_id, blob_uuid)))
+    @staticmethod
+    def get_for_subjects(web_id, blob_uuids) :
+        """Like get_for_subject, but gets a dictionary of uuid -> relations for many
+        blobs in one query."""
+        if isinstance(web_id, models.Web) :
+            web_id = web_id.id
+        models.load_temp_keys("uuid_set", blob_uuids)
+        q = models.DB.execute_tuples("""
+        select """ + CachedRelation.COLUMNS + """
+        from temp.uuid_set as u
+        cross join blobs as sblob on sblob.uuid=u.key
+        cross join relations as r on r.web_id=? and r.subject_id=sblob.id
+        inner join blobs as rblob on rblob.id=r.blob_id
+        left join blobs as oblob on oblob.id=r.object_id""", (web_id,))
+        rels = {}
+        for rel in CachedRelation.from_rows(q) :
+            rels.setdefault(rel.subject_uuid, []).append(rel)
+        return rels
+    @staticmethod
+    def get_for_objects(web_id, blob_uuids) :
+        """Like get_for_object, but gets a dictionary of uuid -> relations for many
+        blobs in one query."""
+        if isinstance(web_id, models.Web) :
+            web_id = web_id.id
+        models.load_temp_keys("uuid_set", blob_uuids)
+        q = models.DB.execute_tuples("""
+        select """ + CachedRelation.COLUMNS + """
+        from temp.uuid_set as u
+        cross join blobs as oblob on oblob.uuid=u.key
+        cross join relations as r on r.web_id=? and r.object_id=oblob.id
+        inner join blobs as rblob on rblob.id=r.blob_id
+        inner join blobs as sblob on sblob.id=r.subject_id""", (web_id,))
+        rels = {}
+        for rel in CachedRelation.from_rows(q) :
+            rels.setdefault(rel.object_uuid, []).append(rel)
         return rels
 
-def get_inherited_relations(web_id, blob_uuid) :
-    """Returns a list of CachedRelation objects which are inherited by the blob (these are subject relations)."""
-    if isinstance(web_id, models.Web) :
-        web_id = web_id.id
-    if isinstance(blob_uuid, models.Blob) :
-        blob_uuid = blob_uuid.uuid
-
-    def sane_revises(r) :
+class RevisionGraph(object) :
+    """An in-memory copy of the part of a web's revises graph which is reachable from
+    some blobs.  load() fetches the blobs and their subject relations a level at a
+    time, so resolving many blobs takes a number of queries proportional to the
+    longest revision chain rather than to the number of blobs."""
+    def __init__(self, web_id) :
+        if isinstance(web_id, models.Web) :
+            web_id = web_id.id
+        self.web_id = web_id
+        self.blobs = {} # uuid -> Blob
+        self.subject_rels = {} # uuid -> [CachedRelation]
+        self.memo = {} # uuid -> [[Maybe date(revises), CachedRelation]]
+    def load(self, uuids) :
+        frontier = set(uuids) - set(self.subject_rels)
+        while frontier :
+            self.blobs.update(models.Blob.get_by_uuids(frontier))
+            rels = CachedRelation.get_for_subjects(self.web_id, frontier)
+            revised = set()
+            for uuid in frontier :
+                self.subject_rels[uuid] = rels.get(uuid, [])
+                revised.update(r.object_uuid for r in self.subject_rels[uuid] if r.name == "revises")
+            frontier = set(u for u in revised if u != None and u not in self.subject_rels)
+    def created(self, uuid) :
+        blob = self.blobs.get(uuid)
+        return blob.date_created if blob != None else None
+    def sane_revises(self, r) :
         """Enforce arrow of time!"""
         if r.name != "revises" :
             return False
-        subject_created = models.Blob.get_created_by_uuid(r.subject_uuid)
-        object_created = models.Blob.get_created_by_uuid(r.object_uuid)
+        subject_created = self.created(r.subject_uuid)
+        object_created = self.created(r.object_uuid)
         return subject_created != None and object_created != None and subject_created > object_created
-
-    inher_rels = {}
-    def _get_rels(uuid) :
-        if uuid in inher_rels :
-            return inher_rels[uuid]
-        rels = CachedRelation.get_for_subject(web_id, uuid)
+    def ancestry(self, uuid) :
+        """Returns a list of [date, CachedRelation] for the subject relations of the
+        blob and of every blob it (transitively) revises, along with an 'editor'
+        pseudo-relation for each of these blobs."""
+        if uuid in self.memo :
+            return self.memo[uuid]
+        rels = self.subject_rels[uuid]
         # step 1: inherit
-        revs = [r for r in rels if sane_revises(r)]
+        revs = [r for r in rels if self.sane_revises(r)]
         got = {} # uuid -> (Maybe date(revises), r)  (date is none to mean non-inherited)
         for rev in revs :
-            rrels = _get_rels(rev.object_uuid)
+            rrels = self.ancestry(rev.object_uuid)
             for t, r in rrels :
                 if r.uuid in got :
                     if  got[r.uuid][0] > rev.date_created :
@@ -225,25 +289,373 @@ def get_inherited_relations(web_id, blob_uuid) :
             got[r.uuid] = [None, r]
         my_inher_rels = got.values()
         # step 3: add pseudo-relation (for author list)
-        blob = models.Blob.get_by_uuid(uuid)
+        blob = self.blobs[uuid]
         def make_pseudo(name, value) :
             return [blob.date_created, CachedRelation.make_pseudo(blob.date_created, name, uuid, value)]
         my_inher_rels.append(make_pseudo("editor", blob.editor_email))
         # cache
-        inher_rels[uuid] = my_inher_rels
+        self.memo[uuid] = my_inher_rels
         return my_inher_rels
-    # don't need to keep track of which r[0] are None because inherited <=> rel.subject_uuid != blob_uuid
-    rels = [r[1] for r in _get_rels(blob_uuid)]
-    # mark deletions
+    def resolve(self, uuid) :
+        """Returns a list of (CachedRelation, deleted) pairs, newest first, for the
+        relations which the (loaded) blob inherits."""
+        # don't need to keep track of which r[0] are None because inherited <=> rel.subject_uuid != blob_uuid
+        rels = [r[1] for r in self.ancestry(uuid)]
+        # mark deletions
+        rels.sort(key=lambda r : r.date_created, reverse=True)
+        deleted = set()
+        marked = []
+        for rel in rels :
+            if rel.uuid and rel.uuid not in deleted and rel.name == "deletes" :
+                deleted.add(rel.object_uuid)
+            marked.append((rel, rel.uuid in deleted))
+        return marked
+
+def compute_inherited_relations(web_id, blob_uuids) :
+    """Resolves the relations inherited by the blobs by walking the revises graph in
+    memory.  Returns a dictionary of uuid -> list of (CachedRelation, deleted) pairs
+    for those blobs which exist.  This is the slow path which fills the
+    inherited_relations table; use get_inherited_relations."""
+    graph = RevisionGraph(web_id)
+    graph.load(blob_uuids)
+    return dict((uuid, graph.resolve(uuid)) for uuid in blob_uuids if uuid in graph.blobs)
+
+class InheritedRelationCache(object) :
+    """The inherited_relations table holds, for each (web, blob), the resolved list of
+    relations the blob inherits along with their deletion flags.  Rows with a null
+    relation_id stand for the 'editor' pseudo-relation of the source blob."""
+    columns = """
+        select tblob.uuid as blob_uuid, ir.relation_id, ir.deleted, rblob.uuid, rblob.date_created, r.relation,
+               oblob.uuid as object_uuid, r.payload,
+               src.uuid as source_uuid, src.date_created as source_created, src.editor_email"""
+    joins = """
+        inner join blobs as src on src.id=ir.source_id
+        left join relations as r on r.id=ir.relation_id
+        left join blobs as rblob on rblob.id=r.blob_id
+        left join blobs as oblob on oblob.id=r.object_id"""
+    @staticmethod
+    def get(web_id, blob_uuid) :
+        """Gets the list of CachedRelation objects for the blob, or None if the blob
+        has not been resolved yet."""
+        q = models.DB.execute_tuples(InheritedRelationCache.columns + """
+        from blobs as tblob
+        inner join inherited_relations as ir on ir.blob_id=tblob.id""" + InheritedRelationCache.joins + """
+        where ir.web_id=? and tblob.uuid=?
+        order by coalesce(rblob.date_created, src.date_created) desc""", (web_id, blob_uuid))
+        rels = [rel for blob_uuid, rel in InheritedRelationCache.from_rows(q)]
+        return rels or None
+    @staticmethod
+    def get_many(web_id, blob_uuids) :
+        """Gets a dictionary of uuid -> list of CachedRelation objects for those blobs
+        which have been resolved."""
+        models.load_temp_keys("uuid_set", blob_uuids)
+        q = models.DB.execute_tuples(InheritedRelationCache.columns + """
+        from temp.uuid_set as u
+        cross join blobs as tblob on tblob.uuid=u.key
+        cross join inherited_relations as ir on ir.web_id=? and ir.blob_id=tblob.id""" + InheritedRelationCache.joins + """
+        order by coalesce(rblob.date_created, src.date_created) desc""", (web_id,))
+        rels = {}
+        for blob_uuid, rel in InheritedRelationCache.from_rows(q) :
+            rels.setdefault(blob_uuid, []).append(rel)
+        return rels
+    @staticmethod
+    def resolved(web_id, blob_uuids) :
+        """Gets the set of the blobs which have been resolved."""
+        models.load_temp_keys("uuid_set", blob_uuids)
+        return set(row[0] for row in models.DB.execute_tuples("""
+        select u.key from temp.uuid_set as u
+        cross join blobs as tblob on tblob.uuid=u.key
+        where exists (select 1 from inherited_relations as ir where ir.web_id=? and ir.blob_id=tblob.id)""", (web_id,)))
+    @staticmethod
+    def from_rows(rows) :
+        """Gets a list of (blob uuid, CachedRelation) for rows of columns (tuples from
+        models.DB.execute_tuples), as CachedRelation.from_rows does."""
+        names = Relation._cached_relation_types_by_id
+        rels = []
+        for (blob_uuid, relation_id, deleted, uuid, created, relation, object_uuid, payload,
+             source_uuid, source_created, editor_email) in rows :
+            if relation_id == None :
+                rel = CachedRelation.make_pseudo(source_created, "editor", source_uuid, editor_email)
+            else :
+                name = names.get(relation) or Relation.get_relation_name(relation)
+                rel = CachedRelation(uuid, created, name, source_uuid, object_uuid, payload, relation_id)
+            rel.deleted = bool(deleted)
+            rels.append((blob_uuid, rel))
+        return rels
+    @staticmethod
+    def store(web_id, resolved) :
+        """Replaces the cached rows for the blobs with the output of
+        compute_inherited_relations, and brings their titles and tags in the search
+        index up to date."""
+        rows = [(web_id, rel.rel_id, int(deleted), blob_uuid, rel.subject_uuid)
+                for blob_uuid, marked in resolved.iteritems()
+                for rel, deleted in marked]
+        with models.DB.writing() : # (this may be called while reading)
+            models.DB.executemany("delete from inherited_relations where web_id=? and blob_id=(select id from blobs where uuid=?)",
+                                  [(web_id, blob_uuid) for blob_uuid in resolved])
+            models.DB.executemany("""
+            insert into inherited_relations (web_id, blob_id, source_id, relation_id, deleted)
+            select ?, tblob.id, src.id, ?, ? from blobs as tblob, blobs as src
+            where tblob.uuid=? and src.uuid=?""", rows)
+            search.SearchIndex.update(web_id, dict((blob_uuid, [rel for rel, deleted in marked if not deleted])
+                                                   for blob_uuid, marked in resolved.iteritems()))
+    @staticmethod
+    def refresh(web_id, subject) :
+        """Re-resolves the subject and every blob which inherits from it.  Called
+        whenever a relation with this subject is cached."""
+        if isinstance(web_id, models.Web) :
+            web_id = web_id.id
+        uuids = set(row['uuid'] for row in models.DB.execute("""
+        select distinct tblob.uuid from inherited_relations as ir
+        inner join blobs as tblob on tblob.id=ir.blob_id
+        where ir.web_id=? and ir.source_id=?""", (web_id, subject.id)))
+        uuids.add(subject.uuid)
+        InheritedRelationCache.store(web_id, compute_inherited_relations(web_id, uuids))
+
+def get_inherited_relations(web_id, blob_uuid) :
+    """Returns a list of CachedRelation objects which are inherited by the blob (these are subject relations)."""
+    if isinstance(web_id, models.Web) :
+        web_id = web_id.id
+    if isinstance(blob_uuid, models.Blob) :
+        blob_uuid = blob_uuid.uuid
+    rels = InheritedRelationCache.get(web_id, blob_uuid)
+    if rels == None :
+        rels = resolve_and_store(web_id, [blob_uuid]).get(blob_uuid)
+    return rels
+
+def get_inherited_relations_for(web_id, blob_uuids) :
+    """Like get_inherited_relations, but gets a dictionary of uuid -> relations for
+    many blobs.  Takes a fixed number of queries for blobs which are already
+    resolved."""
+    if isinstance(web_id, models.Web) :
+        web_id = web_id.id
+    rels = InheritedRelationCache.get_many(web_id, blob_uuids)
+    missing = [uuid for uuid in blob_uuids if uuid not in rels]
+    if missing :
+        rels.update(resolve_and_store(web_id, missing))
+    return rels
+
+def resolve_and_store(web_id, blob_uuids) :
+    """Resolves the blobs with compute_inherited_relations and gets the result as
+    InheritedRelationCache.get_many would.  The result isn't read back from the
+    inherited_relations table, since inside models.DB.snapshot() the rows aren't
+    visible (and so aren't stored until the snapshot ends)."""
+    resolved = compute_inherited_relations(web_id, blob_uuids)
+    def store() :
+        # a blob may have been resolved (say, by refresh) since this snapshot began
+        stored = InheritedRelationCache.resolved(web_id, resolved.keys())
+        InheritedRelationCache.store(web_id, dict((uuid, marked) for uuid, marked in resolved.iteritems()
+                                                  if uuid not in stored))
+    models.DB.after_snapshot(store)
+    rels = {}
+    for blob_uuid, marked in resolved.iteritems() :
+        # copies, since the graph shares a relation between the blobs which inherit it
+        copies = []
+        for rel, deleted in marked :
+            copy = CachedRelation(rel.uuid, rel._date_created, rel.name, rel.subject_uuid,
+                                  rel.object_uuid, rel.payload, rel.rel_id)
+            copy.deleted = deleted
+            copies.append(copy)
+        rels[blob_uuid] = copies
+    return rels
+
+def inherit_from(rel_lists) :
+    """Combines the inherited relations of the blobs which a new blob revises into the
+    relations the new blob inherits, marking deletions as RevisionGraph.resolve
+    does."""
+    rels = dict((r.uuid, r) for rels in rel_lists for r in rels).values()
     rels.sort(key=lambda r : r.date_created, reverse=True)
     deleted = set()
     for rel in rels :
-        if rel.uuid and rel.uuid not in deleted and rel.name == "deletes" :
+        if rel.uuid not in deleted and rel.name == "deletes" :
             deleted.add(rel.object_uuid)
-        if rel.uuid in deleted :
-            rel.deleted = True
+        rel.deleted = rel.uuid in deleted
     return rels
 
+def _to_bytes(s) :
+    return s.encode("utf-8") if isinstance(s, unicode) else str(s)
+
+def make_blobs(web, editor, specs) :
+    """Creates many blobs in the web along with their relations, writing all of them
+    in one transaction.  Each spec is a dict with the content (a string or a
+    models.Content), and optionally the content_type (by default mime:plain/text), a
+    filename, a title, a list of tags, and a list of uuids of existing blobs which
+    it revises.  As with BlobsRPC.create_blob, the
+    title and tags are ensured rather than added: inherited ones which differ are
+    deleted.  Returns the list of new Blobs."""
+    now = int(time.time())
+    created = datetime.datetime.utcfromtimestamp(now)
+    # everything which is read is read before the transaction
+    parents = models.Blob.get_by_uuids(set(p for spec in specs for p in spec.get("revises", [])))
+    older = [p for p, b in parents.iteritems() if b.date_created < created] # see RevisionGraph.sane_revises
+    parent_rels = get_inherited_relations_for(web.id, older) if older else {}
+    relation_ids = dict((name, Relation.get_relation_type_id(name))
+                        for name in ("revises", "filename", "deletes", "title", "tag"))
+    contents = {} # hash -> Content
+    blob_rows = []
+    relation_rows = []
+    def add_blob(content_type, content) :
+        if not isinstance(content, models.Content) :
+            stuff = _to_bytes(content)
+            content = models.Content(hash=models.Content.make_hash_from_string(stuff), stuff=stuff)
+        contents[content.hash] = content
+        blob_uuid = uuid.uuid4().hex
+        blob_rows.append((blob_uuid, now, editor.email, content_type, content.hash)
+                         + content.summarize(content_type.startswith("mime:text/")))
+        return blob_uuid
+    def add_relation(name, subject_uuid, object_uuid=None, payload=None) :
+        rel_uuid = add_blob("relation:" + name, "%s\n%s" % (subject_uuid, object_uuid or _to_bytes(payload)))
+        relation_rows.append((web.id, relation_ids[name], payload, object_uuid, rel_uuid, subject_uuid))
+    uuids = []
+    for spec in specs :
+        b = add_blob(spec.get("content_type") or "mime:plain/text", spec["content"])
+        uuids.append(b)
+        revises = [p for p in spec.get("revises", []) if p in parents]
+        for p in revises :
+            add_relation("revises", b, object_uuid=p)
+        if spec.get("filename") :
+            add_relation("filename", b, payload=spec["filename"])
+        inherited = inherit_from([parent_rels.get(p, []) for p in revises])
+        title = spec.get("title")
+        if title :
+            inherited_title = [r for r in inherited if not r.deleted and r.name == "title"]
+            for r in inherited_title :
+                if r.payload != title :
+                    add_relation("deletes", b, object_uuid=r.uuid)
+            if not any(r.payload == title for r in inherited_title) :
+                add_relation("title", b, payload=title)
+        tags = set([t.strip() for t in spec.get("tags", []) if t.strip()])
+        inherited_tags = [r for r in inherited if not r.deleted and r.name == "tag"]
+        for r in inherited_tags :
+            if r.payload not in tags :
+                add_relation("deletes", b, object_uuid=r.uuid)
+        for tag in tags - set(r.payload for r in inherited_tags) :
+            add_relation("tag", b, payload=tag)
+    with models.DB :
+        models.Content.add_many(contents.itervalues())
+        models.DB.executemany("insert into blobs (uuid, date_created, editor_email, content_type, content_hash, summary, length, line_count) values (?,?,?,?,?,?,?,?)", blob_rows)
+        models.DB.executemany("insert into blobs_web (web_id, blob_id, date_created) select ?, id, date_created from blobs where uuid=?",
+                              [(web.id, row[0]) for row in blob_rows])
+        models.DB.executemany("""
+        insert into relations (web_id, blob_id, subject_id, relation, object_id, payload)
+        select ?, rblob.id, sblob.id, ?, oblob.id, ?
+        from blobs as rblob cross join blobs as sblob left join blobs as oblob on oblob.uuid=?
+        where rblob.uuid=? and sblob.uuid=?""", relation_rows)
+    # the new blobs are the subjects of all of the new relations, and nothing inherits from them yet
+    InheritedRelationCache.store(web.id, compute_inherited_relations(web.id, uuids))
+    blobs = models.Blob.get_by_uuids(uuids)
+    return [blobs[b] for b in uuids]
+
+def import_blobs(web, records) :
+    """Adds blobs as they were exported from a web (see metaview.py), keeping their
+    uuids, dates and editors, in one transaction.  Each record is a dict with the
+    uuid, date_created (in seconds), editor_email, content_type and content (a
+    models.Content).  Relation blobs are cached in the relations table as
+    backfill_relations would, and the inherited relations they change are resolved
+    again (or, for blobs which inherit from their subjects, when next needed).  Blobs which are already in the web are
+    skipped, so importing an archive twice is harmless."""
+    relation_ids = {}
+    relation_rows = []
+    for r in records :
+        if r["content_type"].startswith("relation:") :
+            name = r["content_type"][len("relation:"):]
+            if name not in relation_ids :
+                relation_ids[name] = Relation.get_relation_type_id(name)
+            subject_uuid, content = _to_bytes(r["content"].stuff).decode("utf-8").split("\n", 1)
+            object_uuid = content if re.match("^[0-9a-f]{32}$", content) else None
+            relation_rows.append((web.id, relation_ids[name], content, object_uuid, r["uuid"], subject_uuid, web.id))
+    with models.DB :
+        models.DB.executemany("insert or ignore into users (email) values (?)",
+                              [(email,) for email in set(r["editor_email"] for r in records)])
+        models.Content.add_many(r["content"] for r in records)
+        models.DB.executemany("insert or ignore into blobs (uuid, date_created, editor_email, content_type, content_hash, summary, length, line_count) values (?,?,?,?,?,?,?,?)",
+                              [(r["uuid"], r["date_created"], r["editor_email"], r["content_type"], r["content"].hash)
+                               + r["content"].summarize(r["content_type"].startswith("mime:text/"))
+                               for r in records])
+        models.DB.executemany("insert into blobs_web (web_id, blob_id, date_created) select ?, id, date_created from blobs where uuid=?",
+                              [(web.id, r["uuid"]) for r in records])
+        models.DB.executemany("""
+        insert into relations (web_id, blob_id, subject_id, relation, object_id, payload)
+        select ?, rblob.id, sblob.id, ?, oblob.id, case when oblob.id is null then ? end
+        from blobs as rblob cross join blobs as sblob left join blobs as oblob on oblob.uuid=?
+        where rblob.uuid=? and sblob.uuid=?
+          and not exists (select 1 from relations as r where r.blob_id=rblob.id and r.web_id=?)""", relation_rows)
+        models.DB.executemany("""
+        delete from inherited_relations where web_id=? and blob_id in
+          (select blob_id from inherited_relations where web_id=? and source_id=(select id from blobs where uuid=?))""",
+                              set((web.id, web.id, row[5]) for row in relation_rows))
+    # resolve the new blobs and the subjects of the new relations again, which indexes them
+    get_inherited_relations_for(web.id, set([r["uuid"] for r in records if not r["content_type"].startswith("relation:")]
+                                            + [row[5] for row in relation_rows]))
+
+@migrations.backfill("blobs_web_dates")
+def backfill_blobs_web_dates(position, chunk_size) :
+    """Copies the date each blob was created into its rows of blobs_web, chunk_size
+    blob ids at a time."""
+    start = position or 0
+    with models.DB :
+        models.DB.execute("""
+        update blobs_web set date_created=(select date_created from blobs where id=blobs_web.blob_id)
+        where blob_id>? and blob_id<=? and date_created is null""", (start, start + chunk_size))
+    if models.DB.execute("select 1 from blobs where id>? limit 1", (start + chunk_size,)).fetchone() == None :
+        return None
+    return start + chunk_size
+
+@migrations.backfill("blob_summaries")
+def backfill_blob_summaries(position, chunk_size) :
+    """Works out the summary, length and line count of blobs which don't have them,
+    chunk_size blob ids at a time."""
+    start = position or 0
+    rows = models.DB.execute("select id, content_type, content_hash from blobs where id>? and id<=? and length is null",
+                             (start, start + chunk_size)).fetchall()
+    updates = []
+    for r in rows :
+        content = models.Content.get_by_hash(r['content_hash'])
+        if content != None :
+            updates.append(content.summarize(r['content_type'].startswith("mime:text/")) + (r['id'],))
+    with models.DB :
+        models.DB.executemany("update blobs set summary=?, length=?, line_count=? where id=?", updates)
+    if models.DB.execute("select 1 from blobs where id>? limit 1", (start + chunk_size,)).fetchone() == None :
+        return None
+    return start + chunk_size
+
+@migrations.backfill("relations")
+def backfill_relations(position, chunk_size) :
+    """Rebuilds the rows of the relations cache which are missing for relation:*
+    blobs, looking at chunk_size blob ids at a time, and re-resolves the inherited
+    relations of their subjects."""
+    start = position or 0
+    rows = models.DB.execute("""
+    select b.id, b.content_type, b.content_hash, bw.web_id
+    from blobs as b
+    inner join blobs_web as bw on bw.blob_id=b.id
+    where b.id>? and b.id<=? and b.content_type like 'relation:%'
+      and not exists (select 1 from relations as r where r.blob_id=b.id and r.web_id=bw.web_id)""",
+                             (start, start + chunk_size)).fetchall()
+    refresh = {}
+    for row in rows :
+        subject_uuid, content = models.Content.get_by_hash(row['content_hash']).stuff.split('\n', 1)
+        subject = models.Blob.get_by_uuid(subject_uuid)
+        if subject == None :
+            continue
+        object_id = None
+        payload_text = content
+        if re.match("^[0-9a-f]{32}$", content) :
+            obj = models.Blob.get_by_uuid(content)
+            if obj != None :
+                object_id = obj.id
+                payload_text = None
+        relid = Relation.get_relation_type_id(row['content_type'][len("relation:"):])
+        with models.DB :
+            models.DB.execute("insert into relations (web_id, blob_id, subject_id, relation, object_id, payload) values (?,?,?,?,?,?)",
+                              (row['web_id'], row['id'], subject.id, relid, object_id, payload_text))
+        refresh[(row['web_id'], subject.id)] = subject
+    for (web_id, subject_id), subject in refresh.iteritems() :
+        InheritedRelationCache.refresh(web_id, subject)
+    if models.DB.execute("select 1 from blobs where id>? limit 1", (start + chunk_size,)).fetchone() == None :
+        return None
+    return start + chunk_size
+
 @rpc_module("relations")
 class RelationsRPC(RPCServable) :
     def __init__(self, handler, channels) :
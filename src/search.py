@@ -0,0 +1,141 @@
+# search.py
+# a full-text index of the blobs of each web, and the rpc module which
+# searches it
+
+from tornado import escape
+
+import models
+import migrations
+from rpcmodules import rpc_module
+
+import minirpc
+from minirpc import rpcmethod, RPCServable
+from authorization import requires, READ
+
+class SearchIndex(object) :
+    """Each blob (other than relations) in each web has a row of search_index with the
+    titles and tags which it inherits and, for mime:text/* blobs, up to BODY_LENGTH
+    characters of its content.  The titles and tags are brought up to date whenever
+    the blob's inherited relations are resolved (see
+    relations.InheritedRelationCache.store), and the content never changes."""
+    BODY_LENGTH = 1 << 20
+    @staticmethod
+    def update(web_id, resolved) :
+        """Indexes the blobs given by a dictionary of uuid -> the relations (which
+        aren't deleted) that the blob inherits.  Run inside a transaction."""
+        docs = []
+        for uuid, rels in resolved.iteritems() :
+            titles = " ".join(r.payload for r in rels if r.name == "title" and r.payload)
+            tags = " ".join(r.payload for r in rels if r.name == "tag" and r.payload)
+            docs.append((titles, tags, web_id, uuid))
+        models.DB.executemany("""
+        update search_index set title=?, tags=?
+        where rowid=(select d.id from blobs as b inner join search_docs as d on d.blob_id=b.id and d.web_id=?
+                     where b.uuid=?)""", docs)
+        models.DB.executemany("""
+        insert into search_docs (web_id, blob_id)
+        select ?, id from blobs where uuid=? and content_type not like 'relation:%'""",
+                              [(web_id, uuid) for uuid in resolved])
+        models.DB.executemany("""
+        insert into search_index (rowid, title, tags, body)
+        select d.id, ?, ?, case when b.content_type like 'mime:text/%'
+                                then content_prefix(c.hash, c.stored, c.stuff, ?) else '' end
+        from blobs as b
+        inner join search_docs as d on d.blob_id=b.id and d.web_id=?
+        inner join content as c on c.hash=b.content_hash
+        where b.uuid=? and not exists (select 1 from search_index where rowid=d.id)""",
+                              [(titles, tags, SearchIndex.BODY_LENGTH, web_id, uuid)
+                               for titles, tags, web_id, uuid in docs])
+    @staticmethod
+    def match_expression(query) :
+        """Turns what someone typed into an fts5 query: each word is a phrase (so that
+        punctuation can't be a syntax error) which must appear, and a word ending in
+        * matches as a prefix."""
+        terms = []
+        for word in query.split() :
+            prefix = word.endswith("*")
+            word = word.rstrip("*")
+            if word :
+                terms.append('"%s"%s' % (word.replace('"', '""'), "*" if prefix else ""))
+        return " ".join(terms)
+    @staticmethod
+    def search(web_id, query, offset=0, limit=20, deleted=False, latest_only=True) :
+        """Gets (total, results) for the blobs of the web which match the query, best
+        first, where each result is (uuid, title, snippet).  The snippet is HTML with
+        the matching words in <b> tags.  As with models.WebBlobAccess.list_blobs,
+        deleted is whether the blobs are deleted (None for both), and latest_only
+        leaves out blobs which a newer blob revises."""
+        match = SearchIndex.match_expression(query)
+        if not match :
+            return 0, []
+        params = [match, web_id]
+        where = """
+        from search_index
+        inner join search_docs as d on d.id=search_index.rowid
+        inner join blobs as b on b.id=d.blob_id
+        where search_index match ? and d.web_id=?
+          and exists (select 1 from blobs_web as bw where bw.web_id=d.web_id and bw.blob_id=d.blob_id)"""
+        if deleted != None :
+            where += """
+          and %sexists (select 1 from inherited_relations as ir
+                         inner join relations as r on r.id=ir.relation_id
+                         inner join relation_types as rt on rt.id=r.relation
+                         where ir.web_id=d.web_id and ir.blob_id=d.blob_id and not ir.deleted
+                           and rt.relation_type_name=? and r.object_id=d.blob_id)""" % ("" if deleted else "not ")
+            params.append("deletes")
+        if latest_only :
+            # (a revision is only one if it is newer; see relations.RevisionGraph.sane_revises)
+            where += """
+          and not exists (select 1 from relations as r
+                          inner join relation_types as rt on rt.id=r.relation
+                          inner join blobs as s on s.id=r.subject_id
+                          where r.web_id=d.web_id and r.object_id=d.blob_id
+                            and rt.relation_type_name=? and s.date_created>b.date_created)"""
+            params.append("revises")
+        total = models.DB.execute("select count(*)" + where, params).fetchone()[0]
+        q = models.DB.execute("""
+        select b.uuid, search_index.title, snippet(search_index, -1, '\x01', '\x02', '...', 16) as snippet""" + where + """
+        order by bm25(search_index, 10.0, 5.0, 1.0) limit ? offset ?""", params + [limit, offset])
+        results = [(r['uuid'], r['title'], SearchIndex.snippet_html(r['snippet'])) for r in q]
+        return total, results
+    @staticmethod
+    def snippet_html(snippet) :
+        return escape.xhtml_escape(snippet).replace("\x01", "<b>").replace("\x02", "</b>")
+
+@migrations.backfill("search")
+def backfill_search(position, chunk_size) :
+    """Indexes the blobs in every web, chunk_size blob ids at a time."""
+    import relations
+    start = position or 0
+    by_web = {}
+    for r in models.DB.execute("""
+    select bw.web_id, b.uuid from blobs as b inner join blobs_web as bw on bw.blob_id=b.id
+    where b.id>? and b.id<=? and b.content_type not like 'relation:%'""", (start, start + chunk_size)) :
+        by_web.setdefault(r['web_id'], []).append(r['uuid'])
+    for web_id, uuids in by_web.iteritems() :
+        rels = relations.get_inherited_relations_for(web_id, uuids)
+        with models.DB :
+            SearchIndex.update(web_id, dict((uuid, [r for r in rels.get(uuid, []) if not r.deleted])
+                                            for uuid in uuids))
+    if models.DB.execute("select 1 from blobs where id>? limit 1", (start + chunk_size,)).fetchone() == None :
+        return None
+    return start + chunk_size
+
+@rpc_module("search")
+class SearchRPC(RPCServable) :
+    def __init__(self, handler, channels) :
+        self.handler = handler
+        self.channels = channels
+    @rpcmethod
+    @models.read_only
+    @requires(READ)
+    def search(self, user, web_id, query, offset=0, limit=20, deleted=False, latest_only=True) :
+        """Searches the titles, tags and text of the blobs in the web.  Gets the total
+        number of matches and a page of {uuid, title, snippet}, best first.  By
+        default deleted blobs and blobs which have been revised are left out (see
+        SearchIndex.search)."""
+        total, results = SearchIndex.search(web_id, query, max(0, int(offset)), min(100, max(1, int(limit))),
+                                            deleted, latest_only)
+        return {"total" : total,
+                "results" : [{"uuid" : uuid, "title" : title, "snippet" : snippet}
+                             for uuid, title, snippet in results]}
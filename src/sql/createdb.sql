@@ -29,10 +29,12 @@ create table user_web_access (
   foreign key(user_id) references users(id),
   unique(web_id, user_id) on conflict ignore
 );
+create index user_web_access_user on user_web_access(user_id);
 
 create table content (
   hash text not null,
-  stuff blob not null,
+  stuff blob not null, -- empty if stored
+  stored integer not null default 0, -- 1 if stuff is in the file store instead
   unique(hash)
 );
 
@@ -43,6 +45,9 @@ create table blobs (
   editor_email text not null,
   content_type text not null,
   content_hash text,
+  summary text, -- for text, the start of the content (see models.Content.summarize)
+  length integer, -- of the content, in bytes
+  line_count integer, -- for text
   unique(uuid),
   foreign key(editor_email) references users(email),
   foreign key(content_hash) references content(hash)
@@ -51,10 +56,13 @@ create table blobs (
 create table blobs_web (
   web_id integer not null,
   blob_id integer not null,
+  date_created integer, -- that of the blob, for listing a web in order
   foreign key(web_id) references webs(id),
   foreign key(blob_id) references blobs(id),
   unique(web_id, blob_id) on conflict ignore
 );
+create index blobs_web_blob on blobs_web(blob_id);
+create index blobs_web_date on blobs_web(web_id, date_created, blob_id);
 
 --- cached
 
@@ -77,6 +85,24 @@ create table relations (
   foreign key(object_id) references blobs(id),
   foreign key(relation) references relation_types(id)
 );
+create index relations_subject on relations(web_id, subject_id);
+create index relations_object on relations(web_id, object_id);
+
+-- the relations each blob inherits through 'revises', resolved (see
+-- relations.InheritedRelationCache)
+create table inherited_relations (
+  web_id integer not null,
+  blob_id integer not null, -- the blob which inherits
+  source_id integer not null, -- blob_id itself or a blob it revises
+  relation_id integer, -- null for the 'editor' pseudo-relation of source_id
+  deleted integer not null,
+  foreign key(web_id) references webs(id),
+  foreign key(blob_id) references blobs(id),
+  foreign key(source_id) references blobs(id),
+  foreign key(relation_id) references relations(id)
+);
+create index inherited_relations_blob on inherited_relations(web_id, blob_id);
+create index inherited_relations_source on inherited_relations(web_id, source_id);
 
 --- drafts
 
@@ -86,12 +112,65 @@ create table plugin_inbox (
   user_id integer not null,
   web_id integer not null,
   blob_id integer not null,
+  date_created integer, -- that of the blob, for reading an inbox in order
+  read integer not null default 0,
+  foreign key(user_id) references users(id),
+  foreign key(web_id) references webs(id),
+  foreign key(blob_id) references blobs(id),
+  unique(user_id, web_id, blob_id) on conflict ignore
+);
+create index plugin_inbox_date on plugin_inbox(user_id, web_id, date_created, blob_id);
+create index plugin_inbox_unread_date on plugin_inbox(user_id, web_id, date_created, blob_id) where read=0;
+
+-- the number of unread rows of plugin_inbox for each user and web, kept
+-- up to date by the triggers
+create table plugin_inbox_unread (
+  user_id integer not null,
+  web_id integer not null,
+  unread integer not null,
   foreign key(user_id) references users(id),
   foreign key(web_id) references webs(id),
+  unique(user_id, web_id)
+);
+
+create trigger plugin_inbox_added after insert on plugin_inbox when new.read=0 begin
+  insert or ignore into plugin_inbox_unread (user_id, web_id, unread) values (new.user_id, new.web_id, 0);
+  update plugin_inbox_unread set unread=unread+1 where user_id=new.user_id and web_id=new.web_id;
+end;
+create trigger plugin_inbox_removed after delete on plugin_inbox when old.read=0 begin
+  update plugin_inbox_unread set unread=unread-1 where user_id=old.user_id and web_id=old.web_id;
+end;
+create trigger plugin_inbox_marked after update of read on plugin_inbox when new.read!=old.read begin
+  insert or ignore into plugin_inbox_unread (user_id, web_id, unread) values (new.user_id, new.web_id, 0);
+  update plugin_inbox_unread set unread=unread+(case when new.read then -1 else 1 end)
+  where user_id=new.user_id and web_id=new.web_id;
+end;
+
+--- search
+
+-- a document for each blob in each web, with the titles and tags it
+-- inherits and its text (see search.py)
+create table search_docs (
+  id integer primary key, -- the rowid in search_index
+  web_id integer not null,
+  blob_id integer not null,
+  foreign key(web_id) references webs(id),
   foreign key(blob_id) references blobs(id),
   unique(web_id, blob_id) on conflict ignore
 );
+create virtual table search_index using fts5(title, tags, body, tokenize='unicode61 remove_diacritics 2');
+
+--- migrations
+
+create table backfills (
+  name text not null,
+  position integer, -- where the next chunk starts (null to start from the beginning)
+  finished integer not null,
+  unique(name) on conflict replace
+);
 
+-- the number of the last file in sql/migrations which this schema includes
+pragma user_version = 8;
 
 --- testing
 insert into users (email, first_name, last_name) values ("kmill31415@gmail.com", "Kyle", "Miller");
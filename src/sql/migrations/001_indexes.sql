@@ -0,0 +1,24 @@
+-- 001_indexes.sql
+--
+-- Secondary indexes for the lookups in models.py, relations.py and
+-- plugin_inbox.py which otherwise scan whole tables.
+
+create table if not exists inherited_relations (
+  web_id integer not null,
+  blob_id integer not null, -- the blob which inherits
+  source_id integer not null, -- blob_id itself or a blob it revises
+  relation_id integer, -- null for the 'editor' pseudo-relation of source_id
+  deleted integer not null,
+  foreign key(web_id) references webs(id),
+  foreign key(blob_id) references blobs(id),
+  foreign key(source_id) references blobs(id),
+  foreign key(relation_id) references relations(id)
+);
+create index if not exists inherited_relations_blob on inherited_relations(web_id, blob_id);
+create index if not exists inherited_relations_source on inherited_relations(web_id, source_id);
+
+create index if not exists user_web_access_user on user_web_access(user_id);
+create index if not exists blobs_web_blob on blobs_web(blob_id);
+create index if not exists relations_subject on relations(web_id, subject_id);
+create index if not exists relations_object on relations(web_id, object_id);
+create index if not exists plugin_inbox_user on plugin_inbox(user_id, web_id);
@@ -0,0 +1,10 @@
+-- 002_backfills.sql
+--
+-- Progress of the data backfills run by migrations.BackfillRunner.
+
+create table if not exists backfills (
+  name text not null,
+  position integer, -- where the next chunk starts (null to start from the beginning)
+  finished integer not null,
+  unique(name) on conflict replace
+);
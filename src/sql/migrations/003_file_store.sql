@@ -0,0 +1,6 @@
+-- 003_file_store.sql
+--
+-- Large content lives in the file store (see filestore.py).  Existing
+-- content is moved there by the 'filestore' backfill.
+
+alter table content add column stored integer not null default 0;
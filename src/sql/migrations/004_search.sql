@@ -0,0 +1,16 @@
+-- 004_search.sql
+--
+-- The full-text index of blobs (see search.py).  The blobs which are
+-- already there are indexed by the 'search' backfill.
+
+create table if not exists search_docs (
+  id integer primary key, -- the rowid in search_index
+  web_id integer not null,
+  blob_id integer not null,
+  foreign key(web_id) references webs(id),
+  foreign key(blob_id) references blobs(id),
+  unique(web_id, blob_id) on conflict ignore
+);
+create virtual table if not exists search_index using fts5(title, tags, body, tokenize='unicode61 remove_diacritics 2');
+
+insert into backfills (name, position, finished) values ('search', null, 0);
@@ -0,0 +1,11 @@
+-- 005_blob_listing.sql
+--
+-- blobs_web keeps the date each blob was created so that the blobs of a
+-- web can be listed a page at a time in order (see
+-- models.WebBlobAccess.list_blobs).  The 'blobs_web_dates' backfill
+-- fills it in for the rows which are already there.
+
+alter table blobs_web add column date_created integer;
+create index if not exists blobs_web_date on blobs_web(web_id, date_created, blob_id);
+
+insert into backfills (name, position, finished) values ('blobs_web_dates', null, 0);
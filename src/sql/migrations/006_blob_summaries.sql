@@ -0,0 +1,12 @@
+-- 006_blob_summaries.sql
+--
+-- Each blob keeps its summary, length and line count (see
+-- models.Content.summarize) so that metadata doesn't need the content.
+-- The 'blob_summaries' backfill computes them for the blobs which are
+-- already there.
+
+alter table blobs add column summary text;
+alter table blobs add column length integer;
+alter table blobs add column line_count integer;
+
+insert into backfills (name, position, finished) values ('blob_summaries', null, 0);
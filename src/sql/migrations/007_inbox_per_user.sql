@@ -0,0 +1,19 @@
+-- 007_inbox_per_user.sql
+--
+-- plugin_inbox was unique on (web_id, blob_id), so only the first user of
+-- a web got a blob in their inbox.  It is now unique per user, which
+-- also covers the lookups by (user_id, web_id) that plugin_inbox_user
+-- was for.
+
+create table plugin_inbox_new (
+  user_id integer not null,
+  web_id integer not null,
+  blob_id integer not null,
+  foreign key(user_id) references users(id),
+  foreign key(web_id) references webs(id),
+  foreign key(blob_id) references blobs(id),
+  unique(user_id, web_id, blob_id) on conflict ignore
+);
+insert into plugin_inbox_new (user_id, web_id, blob_id) select user_id, web_id, blob_id from plugin_inbox;
+drop table plugin_inbox;
+alter table plugin_inbox_new rename to plugin_inbox;
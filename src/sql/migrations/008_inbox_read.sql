@@ -0,0 +1,37 @@
+-- 008_inbox_read.sql
+--
+-- Each inbox row keeps the date its blob was created, so that an inbox
+-- can be read a page at a time, newest first, and whether the user has
+-- read it.  plugin_inbox_unread counts the unread rows of each user and
+-- web, and the triggers keep it up to date however rows are added,
+-- marked read or removed (see plugin_inbox.Inbox).  The 'inbox_dates'
+-- backfill fills in the dates and counts for the rows already there.
+
+alter table plugin_inbox add column date_created integer;
+alter table plugin_inbox add column read integer not null default 0;
+create index if not exists plugin_inbox_date on plugin_inbox(user_id, web_id, date_created, blob_id);
+create index if not exists plugin_inbox_unread_date on plugin_inbox(user_id, web_id, date_created, blob_id) where read=0;
+
+create table plugin_inbox_unread (
+  user_id integer not null,
+  web_id integer not null,
+  unread integer not null,
+  foreign key(user_id) references users(id),
+  foreign key(web_id) references webs(id),
+  unique(user_id, web_id)
+);
+
+create trigger plugin_inbox_added after insert on plugin_inbox when new.read=0 begin
+  insert or ignore into plugin_inbox_unread (user_id, web_id, unread) values (new.user_id, new.web_id, 0);
+  update plugin_inbox_unread set unread=unread+1 where user_id=new.user_id and web_id=new.web_id;
+end;
+create trigger plugin_inbox_removed after delete on plugin_inbox when old.read=0 begin
+  update plugin_inbox_unread set unread=unread-1 where user_id=old.user_id and web_id=old.web_id;
+end;
+create trigger plugin_inbox_marked after update of read on plugin_inbox when new.read!=old.read begin
+  insert or ignore into plugin_inbox_unread (user_id, web_id, unread) values (new.user_id, new.web_id, 0);
+  update plugin_inbox_unread set unread=unread+(case when new.read then -1 else 1 end)
+  where user_id=new.user_id and web_id=new.web_id;
+end;
+
+insert into backfills (name, position, finished) values ('inbox_dates', null, 0);
@@ -0,0 +1,39 @@
+# workers.py
+# runs blocking model calls on a pool of threads so that the IOLoop
+# only has to multiplex I/O
+
+import sys
+import threading
+import Queue
+
+from tornado.ioloop import IOLoop
+from tornado.concurrent import TracebackFuture
+
+class WorkerPool(object) :
+    """A fixed number of worker threads which run functions from a queue.  Each
+    worker uses its own connection to the db (see models.Database), and results
+    are delivered back on the IOLoop through futures."""
+    def __init__(self, num_workers=4, io_loop=None) :
+        self.io_loop = io_loop or IOLoop.instance()
+        self.queue = Queue.Queue()
+        self.threads = []
+        for i in xrange(num_workers) :
+            t = threading.Thread(target=self._work, name="worker-%d" % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+    def submit(self, f, *args, **kwargs) :
+        """Runs f(*args, **kwargs) on a worker.  Returns a future for the result,
+        which is resolved on the IOLoop."""
+        future = TracebackFuture()
+        self.queue.put((future, f, args, kwargs))
+        return future
+    def _work(self) :
+        while True :
+            future, f, args, kwargs = self.queue.get()
+            try :
+                result = f(*args, **kwargs)
+            except Exception :
+                self.io_loop.add_callback(future.set_exc_info, sys.exc_info())
+            else :
+                self.io_loop.add_callback(future.set_result, result)
@@ -567,13 +567,27 @@ var mvui = (function (mvui) {
     render : function () {
       var that = this;
       if (that.table === undefined) {
-        that.el.empty().append($("<h1/>").text("Inbox"));
+        that.el.empty().append($("<h1/>").text("Inbox ")
+                               .append($('<span class="inbox-unread-count"/>')));
+        $('<a href="#" class="inbox-mark-read">Mark all read</a>')
+          .on("click", function (e) {
+            e.preventDefault();
+            mv.InboxModel.markRead(that.web.id);
+          })
+          .appendTo(that.el);
         that.el.append($('<p class="removeWhenLoaded"><em>Loading</em></p>'));
         that.table = $('<table class="inbox-table"/>').appendTo(that.el);
         that.table.append($('<colgroup/>')
                           .append($('<col class="inbox-editor"/>'))
                           .append($('<col class="inbox-summary"/>'))
                           .append($('<col class="inbox-time"/>')));
+        that.more = $('<a href="#" class="inbox-more">More</a>')
+          .on("click", function (e) {
+            e.preventDefault();
+            mv.InboxModel.loadMore(that.web.id);
+          })
+          .hide()
+          .appendTo(that.el);
       }
       var table = that.table;
       _.seq(
@@ -603,8 +617,13 @@ var mvui = (function (mvui) {
             row.row.remove();
           });
           _.each(sorted, function (uuid) {
+            that.rows[uuid].row.toggleClass("inbox-unread", !mv.InboxModel.isRead(that.web.id, uuid));
             table.append(that.rows[uuid].row);
           });
+          var unread = mv.InboxModel.getUnread(that.web.id);
+          that.el.find(".inbox-unread-count").text(unread ? "(" + unread + " unread)" : "");
+          that.el.find(".inbox-mark-read").toggle(unread > 0);
+          that.more.toggle(mv.InboxModel.hasMore(that.web.id));
         }
       )();
     },
@@ -651,14 +670,18 @@ jQuery(function ($) {
     mvui.templates[$(this).attr("template-name")] = _.template($(this).html());
   });
 
-  mv.initConnection($('#poll_info_form').find('input[name="channel_id"]').val());
+  mv.initConnection($('#poll_info_form').find('input[name="channel_id"]').val(),
+                    $('#poll_info_form').find('input[name="last_seq"]').val());
 
   mv.Connection.on("badChannel", function () {
     window.location.reload();
   });
+  mv.Connection.on("resync", function () {
+    window.location.reload();
+  });
 
-  mv.Connection.longPoll(function (error) {
-    console.log("long poll error: " + error);
+  mv.Connection.connect(function (error) {
+    console.log("connection error: " + error);
     return true;
   });
 
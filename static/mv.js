@@ -94,19 +94,68 @@ var mv = (function (mv, $) {
             dataType : "json",
             timeout : 5000,
             success : function (res) {
-              if ("result" in res) {
-                onSuccess(res["result"]);
-              } else if ("error" in res) {
-                onError("exception", res["error"]);
-              } else {
-                onError("malformed");
-              }
+              mv.rpcResponse(res, onSuccess, onError);
             },
             error : function (hjXHR, textStatus, errorThrown) {
               onError(textStatus);
             }
            });
   };
+  mv.rpcResponse = function (res, onSuccess, onError) {
+    if (res && "result" in res) {
+      onSuccess(res["result"]);
+    } else if (res && "error" in res) {
+      onError("exception", res["error"]);
+    } else {
+      onError("malformed");
+    }
+  };
+
+  // Like mv.rpc, but for a method which only reads (see
+  // models.read_only).  The calls made before control returns to the
+  // browser are sent together in one request, which the server
+  // answers from one version of the database.
+  mv.rpcBatched = function (module, method, args, onSuccess, onError) {
+    onSuccess = onSuccess || function () {};
+    onError = onError || function (err, exc) { console.log("rpc error: " + err + "\n" + JSON.stringify(exc)); };
+    if (!mv.rpcBatch) {
+      mv.rpcBatch = [];
+      _.defer(mv.sendRpcBatch);
+    }
+    mv.rpcBatch.push({id : mv.rpcBatch.length,
+                      module : module,
+                      method : method,
+                      kwargs : args || {},
+                      onSuccess : onSuccess,
+                      onError : onError});
+  };
+  mv.sendRpcBatch = function () {
+    var batch = mv.rpcBatch;
+    mv.rpcBatch = undefined;
+    var messages = _.map(batch, function (call) {
+      return _.pick(call, "id", "module", "method", "kwargs");
+    });
+    $.ajax({url : "/ajax/rpc",
+            type : "POST",
+            data : {_xsrf : mv.getCookie("_xsrf"), messages : JSON.stringify(messages)},
+            dataType : "json",
+            timeout : 5000,
+            success : function (res) {
+              _.each(batch, function (call) {
+                if ("responses" in res) {
+                  mv.rpcResponse(res["responses"][call.id], call.onSuccess, call.onError);
+                } else {
+                  mv.rpcResponse(res, call.onSuccess, call.onError);
+                }
+              });
+            },
+            error : function (hjXHR, textStatus, errorThrown) {
+              _.each(batch, function (call) {
+                call.onError(textStatus);
+              });
+            }
+           });
+  };
   
   // Events
   // ------
@@ -189,33 +238,132 @@ var mv = (function (mv, $) {
   };
   mv.messageHandlers = {};
 
-  // this should be restructured with long polling, but I just want
-  // to get the interface right first.
+  // Receives the messages of a channel, over a WebSocket, server-sent
+  // events or long polling (see 'connect').
   var _Connection = _.create(_Model, {
-    _init : function (channel_id) {
+    _init : function (channel_id, last_seq) {
       _Model._init.call(this);
       this.channel_id = channel_id; // The id of the polling channel for this client
+      // The highest seq received (messages from different server
+      // processes may arrive a little out of order)
+      this.last_seq = last_seq === undefined ? undefined : Number(last_seq);
       this.addEventType("badChannel"); // when the channel id isn't right.
+      this.addEventType("resync"); // when messages were missed and can't be replayed
+    },
+    // Calls the message handlers on each message.
+    handleMessages : function (messages) {
+      var that = this;
+      _.each(messages, function (message) {
+        if (message["seq"] != null && !(message["seq"] <= that.last_seq)) {
+          that.last_seq = message["seq"];
+        }
+        if (message["type"] === "ResyncMessage") {
+          that.trigger("resync");
+          return;
+        }
+        // a run of messages of one type may come as one, with 'batch'
+        // holding the args of each
+        var batch = _.has(message, "batch") ? message["batch"] : [message["args"]];
+        var handled = false;
+        _.each(mv.messageHandlers[message["type"]], function (handler) {
+          handled = true;
+          _.each(batch, function (args) {
+            handler[0].call(handler[1], args);
+          });
+        });
+        if (!handled) {
+          console.log("Unknown message type: " + message["type"]);
+        }
+      });
+    },
+    // Handles the data of one message from a WebSocket or an event
+    // source, which is like the response to a long poll.
+    handleStreamData : function (data) {
+      if (_.has(data, "channel_id")) {
+        // the channel was resumed under a new id
+        this.channel_id = data["channel_id"];
+      }
+      if (_.has(data, "error")) {
+        this.handleError(data.error);
+        return false;
+      }
+      if (_.has(data, "messages")) {
+        this.handleMessages(data["messages"]);
+      }
+      return true;
+    },
+    handleError : function (error) {
+      if (error === "no such channel") {
+        this.trigger("badChannel");
+      } else if (error === "resync required") {
+        this.trigger("resync");
+      }
+    },
+    // The query string which lets the server resume a channel which is
+    // gone from the last message received.
+    resumeQuery : function () {
+      return this.last_seq === undefined ? "" : "?last_seq=" + this.last_seq;
+    },
+    // Starts receiving messages with the best transport the browser
+    // has: a WebSocket, else server-sent events, else long polling.
+    // If a WebSocket can't be opened at all (e.g., because of a
+    // proxy), it falls back to the next one.  The 'onError' callback
+    // decides whether to reconnect, as with longPollDriver.
+    connect : function (onError) {
+      onError = onError || function () {};
+      if (window.WebSocket) {
+        this.webSocketDriver(onError);
+      } else if (window.EventSource) {
+        this.eventSourceDriver(onError);
+      } else {
+        this.longPoll(onError);
+      }
+    },
+    webSocketDriver : function (onError) {
+      var that = this;
+      var opened = false;
+      var scheme = window.location.protocol === "https:" ? "wss://" : "ws://";
+      var socket = new WebSocket(scheme + window.location.host + "/ajax/channel/" + this.channel_id + "/socket" + this.resumeQuery());
+      socket.onopen = function () {
+        opened = true;
+      };
+      socket.onmessage = function (e) {
+        if (!that.handleStreamData(JSON.parse(e.data))) {
+          socket.close();
+        }
+      };
+      socket.onclose = function () {
+        if (!opened) {
+          if (window.EventSource) {
+            that.eventSourceDriver(onError);
+          } else {
+            that.longPoll(onError);
+          }
+        } else if (onError("socket closed")) {
+          _.delay(function () { that.webSocketDriver(onError); }, 2000);
+        }
+      };
+    },
+    eventSourceDriver : function (onError) {
+      var that = this;
+      var source = new EventSource("/ajax/channel/" + this.channel_id + "/events" + this.resumeQuery());
+      source.onmessage = function (e) {
+        if (!that.handleStreamData(JSON.parse(e.data))) {
+          source.close();
+        }
+      };
+      source.onerror = function () {
+        // the browser reconnects by itself unless it has given up
+        if (source.readyState === EventSource.CLOSED && onError("event source closed")) {
+          _.delay(function () { that.eventSourceDriver(onError); }, 2000);
+        }
+      };
     },
     // Starts a long poll which calls message handlers on each message
     // which comes by.  Uses longPollDriver to do this, and the
     // 'onError' callback is passed right on to it.
     longPoll : function (onError) {
-      var that = this;
-      this.longPollDriver(
-        function (messages) {
-          _.each(messages, function (message) {
-            var handled = false;
-            _.each(mv.messageHandlers[message["type"]], function (handler) {
-              handled = true;
-              handler[0].call(handler[1], message["args"]);
-            });
-            if (!handled) {
-              console.log("Unknown message type: " + message["type"]);
-            }
-          });
-        },
-        onError);
+      this.longPollDriver(_.im(this, "handleMessages"), onError);
     },
 
     // Makes a long polling loop. Calls 'handler' on any list of
@@ -231,16 +379,18 @@ var mv = (function (mv, $) {
                 type : "POST",
                 dataType : "json",
                 data : {_xsrf : _xsrf,
-                        channel_id : that.channel_id},
+                        channel_id : that.channel_id,
+                        last_seq : that.last_seq},
                 timeout : 30000,
                 success : function (data) {
+                  if (_.has(data, "channel_id")) {
+                    that.channel_id = data["channel_id"];
+                  }
                   if (_.has(data, "messages")) {
                     handler(data["messages"]);
                     loop();
                   } else {
-                    if (data.error === "no such channel") {
-                      that.trigger("badChannel");
-                    }
+                    that.handleError(data["error"]);
                     if (onError(data["error"])) {
                       _.delay(loop, 500);
                     }
@@ -268,8 +418,8 @@ var mv = (function (mv, $) {
 
   // Since we need a channel id to create the connection model, we
   // have this constructor to defer its creation
-  mv.initConnection = function (channel_id) {
-    mv.Connection = _.build(_Connection, channel_id);
+  mv.initConnection = function (channel_id, last_seq) {
+    mv.Connection = _.build(_Connection, channel_id, last_seq);
   };
 
   // Fragment model
@@ -435,7 +585,7 @@ var mv = (function (mv, $) {
     pullWebs : function () {
       var that = this;
       that.getWebsCallbacks = that.getWebsCallbacks || [];
-      mv.rpc("webs", "get_webs", {},
+      mv.rpcBatched("webs", "get_webs", {},
              function (webs) {
                var oldKnownWebs = that.knownWebs || {};
                that.knownWebs = {};
@@ -558,7 +708,7 @@ var mv = (function (mv, $) {
     pullUsers : function () {
       var that = this;
       that.pullUsersCallbacks = that.pullUsersCallbacks || {};
-      mv.rpc("users", "get_users", {},
+      mv.rpcBatched("users", "get_users", {},
              function (users) {
                var oldUsers = that.knownUsers || {};
                that.knownUsers = {};
@@ -702,7 +852,7 @@ var mv = (function (mv, $) {
       var knownWebBlobs = this.knownBlobs[web_id];
 
       uuids = _.filter(uuids, function (uuid) { return !_.has(knownWebBlobs, uuid); });
-      mv.rpc("blobs", "get_blob_metadata", {"web_id" : +web_id, "uuids" : uuids},
+      mv.rpcBatched("blobs", "get_blob_metadata", {"web_id" : +web_id, "uuids" : uuids},
              function (blobs) {
                // incorporate new data
                _.each(blobs, function (meta) {
@@ -867,14 +1017,12 @@ var mv = (function (mv, $) {
       this.inProgress[fileId] = state;
       this.numInProgress++;
       this.trigger("numChanged", this.numInProgress);
-      var formData = new FormData();
-      formData.append('files', file);
-      formData.append('_xsrf', mv.getCookie('_xsrf'));
       state.jqXHR = $.ajax({
-        url : "/upload/" + webId,
-        type : "POST",
-        data : formData,
-        contentType : false,
+        url : "/upload/" + webId + "/stream?filename=" + encodeURIComponent(file.name),
+        type : "PUT",
+        data : file,
+        headers : {"X-Xsrftoken" : mv.getCookie('_xsrf')},
+        contentType : file.type || "application/octet-stream",
         processData : false,
         cache : false,
         xhr : function () {
@@ -944,14 +1092,20 @@ var mv = (function (mv, $) {
   var _InboxModel = _.create(_Model, {
     _init : function () {
       _Model._init.call(this);
+      // web_id -> {uuids (newest first), read (uuid -> true), unread, next}
+      // for the pages of the inbox loaded so far
       this.currentInboxes = {};
       this.addEventType("updated"); // for when anything changes in the inbox (args: web)
       this.addEventType("added"); // for when a blob gets added (args: web,uuid)
       this.addEventType("removed"); // for when a blob gets removed (args: web,uuid)
-      _.bindAll(this, 'InboxMessageHandler');
+      _.bindAll(this, 'InboxMessageHandler', 'InboxReadMessageHandler');
       mv.addMessageHandler('InboxMessage', this.InboxMessageHandler);
+      mv.addMessageHandler('InboxReadMessage', this.InboxReadMessageHandler);
     },
+    // args.uuids are the blobs which were added to (or removed from)
+    // the inbox of args.web_id
     InboxMessageHandler : function (args) {
+      var self = this;
       var inbox = this.currentInboxes[args.web_id];
       if (inbox === undefined) {
         // we don't track this one yet, so no use modifying currentInboxes
@@ -959,38 +1113,109 @@ var mv = (function (mv, $) {
           this.pullInbox(mv.WebModel.currentWebId);
         }
         if (args.adding) {
-          this.trigger("added", args.web_id, args.uuid);
+          _.each(args.uuids, function (uuid) {
+            self.trigger("added", args.web_id, uuid);
+          });
         }
       } else {
         if (args.adding) {
-          if (!_.has(inbox, args.uuid)) {
-            inbox.push(args.uuid);
-            this.trigger("added", args.web_id, args.uuid);
-          }
+          _.each(args.uuids, function (uuid) {
+            if (!_.contains(inbox.uuids, uuid)) {
+              inbox.uuids.unshift(uuid);
+              inbox.unread++;
+              self.trigger("added", args.web_id, uuid);
+            }
+          });
         } else {
-          this.currentInboxes[args.web_id] = _.without(inbox, args.uuid);
-          this.trigger("removed", args.web_id, args.uuid);
+          _.each(args.uuids, function (uuid) {
+            if (_.contains(inbox.uuids, uuid)) {
+              inbox.uuids = _.without(inbox.uuids, uuid);
+              if (!inbox.read[uuid]) {
+                inbox.unread--;
+              }
+              delete inbox.read[uuid];
+              self.trigger("removed", args.web_id, uuid);
+            }
+          });
         }
         this.trigger("updated", args.web_id);
       }
     },
-    pullInbox : function (webid, callback) {
+    // the inbox of args.web_id was read up to args.uuid (or all of it
+    // if it is null), leaving args.unread unread
+    InboxReadMessageHandler : function (args) {
+      var inbox = this.currentInboxes[args.web_id];
+      if (inbox !== undefined) {
+        var from = args.uuid === null ? 0 : _.indexOf(inbox.uuids, args.uuid);
+        if (from !== -1) {
+          _.each(inbox.uuids.slice(from), function (uuid) {
+            inbox.read[uuid] = true;
+          });
+        }
+        inbox.unread = args.unread;
+        this.trigger("updated", args.web_id);
+      }
+    },
+    // Gets a page of the inbox, after the one with the cursor (the
+    // first page if it is undefined), and adds it to currentInboxes.
+    loadPage : function (webid, cursor, callback) {
       var self = this;
-      mv.rpc("inbox", "get_inbox", {"webid" : +webid},
-             function (uuids) {
-               if (uuids !== null) {
-                 self.currentInboxes[webid] = uuids;
-                 callback(self.currentInboxes[webid]);
+      mv.rpcBatched("inbox", "get_inbox", {"webid" : +webid, "cursor" : cursor || null},
+             function (page) {
+               if (page !== null) {
+                 var inbox = self.currentInboxes[webid];
+                 if (inbox === undefined || !cursor) {
+                   inbox = self.currentInboxes[webid] = {uuids : [], read : {}};
+                 }
+                 _.each(page.items, function (item) {
+                   if (!_.contains(inbox.uuids, item.uuid)) {
+                     inbox.uuids.push(item.uuid);
+                   }
+                   if (item.read) {
+                     inbox.read[item.uuid] = true;
+                   }
+                 });
+                 inbox.unread = page.unread;
+                 inbox.next = page.next;
+                 (callback || function () {})(inbox.uuids);
                  self.trigger("updated", webid);
                }
              });
     },
+    pullInbox : function (webid, callback) {
+      this.loadPage(webid, undefined, callback);
+    },
+    // Loads the next page of the inbox, if there is one.
+    loadMore : function (webid, callback) {
+      var inbox = this.currentInboxes[webid];
+      if (inbox !== undefined && inbox.next) {
+        this.loadPage(webid, inbox.next, callback);
+      }
+    },
     getInbox : function (webid, callback) {
       if (_.has(this.currentInboxes, webid)) {
-        callback(this.currentInboxes[webid]);
+        callback(this.currentInboxes[webid].uuids);
       } else {
         this.pullInbox(webid, callback);
       }
+    },
+    isRead : function (webid, uuid) {
+      var inbox = this.currentInboxes[webid];
+      return inbox !== undefined && _.has(inbox.read, uuid);
+    },
+    getUnread : function (webid) {
+      var inbox = this.currentInboxes[webid];
+      return inbox === undefined ? 0 : inbox.unread;
+    },
+    hasMore : function (webid) {
+      var inbox = this.currentInboxes[webid];
+      return inbox !== undefined && !!inbox.next;
+    },
+    // Marks the blob with the uuid and the ones older than it read (or
+    // all of them if uuid is undefined).  The InboxReadMessage which
+    // comes back updates currentInboxes.
+    markRead : function (webid, uuid) {
+      mv.rpc("inbox", "mark_read", {"webid" : +webid, "uuid" : uuid || null});
     }
   });
 